@@ -0,0 +1,142 @@
+import os
+import hashlib
+import logging
+import threading
+import subprocess
+
+DEFAULT_ADB_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+
+
+def shard_port(device_id, ports):
+    """Стабильное распределение устройства по adb server (rendezvous hashing):
+    при добавлении/удалении порта переезжают только устройства этого порта."""
+    return max(ports, key=lambda port: hashlib.md5(f'{port}|{device_id}'.encode()).hexdigest())
+
+
+def is_network_device(device_id):
+    return ':' in device_id
+
+
+class AdbShard:
+    """Один adb server (порт ANDROID_ADB_SERVER_PORT) и его состояние."""
+    def __init__(self, port, adb_path='adb'):
+        self.port = port
+        self.adb_path = adb_path
+        self.connected = False
+        self.restarts = 0
+        self.last_error = None
+        self.network_devices = set()
+        self.lock = threading.Lock()
+
+    def env(self):
+        return dict(os.environ, ANDROID_ADB_SERVER_PORT=str(self.port))
+
+    def run(self, *args, timeout=30):
+        return subprocess.run([self.adb_path, *args], env=self.env(), stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, text=True, timeout=timeout)
+
+    def start_server(self):
+        """Запустить adb server шарда и подключить его сетевые устройства."""
+        try:
+            self.run('start-server')
+            for device_id in sorted(self.network_devices):
+                self.run('connect', device_id, timeout=15)
+        except Exception as e:
+            self.last_error = str(e)
+            logging.error(f'[adb:{self.port}] Не удалось запустить adb server: {e}')
+
+    def reconnect(self, device_id):
+        """Переподключить одно устройство, не трогая остальные транспорты adb server."""
+        if is_network_device(device_id):
+            self.network_devices.add(device_id)
+            self.run('disconnect', device_id, timeout=15)
+            self.run('connect', device_id, timeout=15)
+        else:
+            self.run('-s', device_id, 'reconnect', timeout=15)
+
+    def restart(self):
+        """Перезапуск только этого adb server — устройства других шардов не затрагиваются."""
+        with self.lock:
+            logging.warning(f'[adb:{self.port}] Перезапуск adb server')
+            self.restarts += 1
+            try:
+                self.run('kill-server')
+            except Exception as e:
+                self.last_error = str(e)
+            self.start_server()
+
+    def status(self):
+        return {'port': self.port, 'connected': self.connected, 'restarts': self.restarts,
+                'last_error': self.last_error, 'network_devices': sorted(self.network_devices)}
+
+
+class AdbShardPool:
+    """
+    Набор adb server на разных портах; устройство всегда обслуживается своим шардом.
+    USB-устройство или эмулятор, которого не видит шард по хешу, закрепляется (pin) за шардом, который его видит:
+    перенести такое устройство командой connect нельзя.
+    """
+    def __init__(self, ports=None, adb_path='adb'):
+        ports = ports or [DEFAULT_ADB_PORT]
+        self.shards = {int(port): AdbShard(int(port), adb_path) for port in ports}
+        self.pinned = {}
+
+    def shard_for(self, device_id):
+        port = self.pinned.get(device_id)
+        return self.shards[port if port is not None else shard_port(device_id, list(self.shards))]
+
+    def pin(self, device_id, port):
+        """Закрепить локальное устройство за шардом port."""
+        logging.info(f'[adb] {device_id}: не виден на adb:{self.shard_for(device_id).port}, закреплён за adb:{port}')
+        self.pinned[device_id] = port
+
+    def owns(self, port, device_id):
+        return self.shard_for(device_id).port == port
+
+    def env_for(self, device_id):
+        return self.shard_for(device_id).env()
+
+    def assign(self, device_ids):
+        """Закрепить сетевые устройства (ip:port) за шардами, чтобы шард подключал их после (пере)запуска."""
+        for device_id in device_ids:
+            if is_network_device(device_id):
+                self.shard_for(device_id).network_devices.add(device_id)
+
+    def migrate(self, device_id, from_port):
+        """Сетевое устройство подключено не к своему шарду — переподключить к владельцу."""
+        owner = self.shard_for(device_id)
+        owner.network_devices.add(device_id)
+        logging.info(f'[adb] {device_id}: перенос с adb:{from_port} на adb:{owner.port}')
+        try:
+            self.shards[from_port].run('disconnect', device_id, timeout=15)
+            owner.run('connect', device_id, timeout=15)
+        except Exception as e:
+            logging.error(f'[adb] Ошибка переноса {device_id}: {e}')
+
+    def start(self):
+        for shard in self.shards.values():
+            shard.start_server()
+
+    def restart_all(self):
+        for shard in self.shards.values():
+            shard.restart()
+
+    def status(self):
+        return [shard.status() for shard in self.shards.values()]
+
+
+# Пул по умолчанию (один adb server); настраивается configure() при старте агента
+pool = AdbShardPool()
+
+
+def configure(cfg):
+    global pool
+    ports = cfg.get('adb_server_ports') or [cfg.get('adb_port', DEFAULT_ADB_PORT)]
+    pool = AdbShardPool(ports, cfg.get('adb_path', 'adb'))
+    pool.assign(d['id'] for d in cfg.get('devices', []))
+    return pool
+
+
+def adb_env(device_id):
+    """Окружение для вызова adb по конкретному устройству (ANDROID_ADB_SERVER_PORT его шарда)."""
+    return pool.env_for(device_id)
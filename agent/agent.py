@@ -8,10 +8,28 @@ import schedule
 from pathlib import Path
 from datetime import datetime
 import threading
+import queue
 import json
+from collections import OrderedDict
 import hashlib
-from device_session import DeviceSession
+import atexit
+import socket
+import uuid
+import subprocess
+from device_session import DeviceSession, metadata_cache
+from device_registry import ShardedRegistry
+from health import HealthMonitor
+import adb_shards
 from scenario_runner import ScenarioRunner
+from encoder import encode_screenshot, get_profile
+from channel import AgentChannel
+from targets import load_targets
+from dedupe import DedupeStore
+from frame_buffer import FrameBuffer
+from telemetry import TelemetryBatcher, parse_metrics
+from leases import LeaseClient
+from planner import CapturePlan
+from chunked import file_sha256, make_upload_id
 import integrations
 
 CONFIG_PATH = Path(__file__).parent / 'config_agent.yaml'
@@ -29,33 +47,131 @@ def setup_logging(level):
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
-# --- Watchdog ---
-def watchdog_loop():
-    while True:
-        try:
-            out = os.popen('adb devices').read()
-            if 'device' not in out:
-                logging.warning('ADB не видит ни одного устройства! Перезапуск...')
-                os.system('adb kill-server')
-                time.sleep(2)
-                os.system('adb start-server')
-        except Exception as e:
-            logging.error(f'Watchdog error: {e}')
-        time.sleep(30)
-
-def start_watchdog():
-    t = threading.Thread(target=watchdog_loop, daemon=True)
-    t.start()
-
-# --- Автосканирование ADB-устройств ---
-def scan_adb_devices():
-    out = os.popen('adb devices').read().splitlines()
-    devices = []
-    for line in out:
-        if '\tdevice' in line:
-            dev_id = line.split('\t')[0].strip()
-            devices.append(dev_id)
-    return devices
+# --- Реестр устройств: события host:track-devices вместо опроса `adb devices` ---
+registry = None
+device_events = queue.Queue()
+
+def start_registry(cfg):
+    global registry
+    pool = adb_shards.configure(cfg)
+    pool.start()
+    registry = ShardedRegistry(pool)
+    registry.subscribe(lambda event, serial, state, old_state: device_events.put((serial, state)))
+    registry.start()
+    return registry
+
+# --- Здоровье ADB: пробы по устройствам и точечное восстановление вместо kill-server ---
+health = None
+
+def start_health(cfg):
+    global health
+    h_cfg = cfg.get('health', {}) or {}
+    health = HealthMonitor(
+        adb_shards.pool, registry,
+        expected=lambda: [d['id'] for d in cfg.get('devices', []) if d.get('enabled', True)],
+        interval=h_cfg.get('interval', 30),
+        timeout=h_cfg.get('timeout', 5),
+        failures=h_cfg.get('failures', 2),
+        shard_cooldown=h_cfg.get('shard_cooldown', 300),
+        global_cooldown=h_cfg.get('global_cooldown', 1800),
+        on_action=lambda dev_id, step, error: send_message(cfg, dev_id, 'error', f'ADB: {error}, восстановление: {step}')
+    )
+    health.start()
+    return health
+
+# --- Аренда устройств: при нескольких агентах сервер решает, кто снимает устройство ---
+leases = None
+AGENT_ID_PATH = Path(__file__).parent / '.agent_id'
+
+def agent_id(cfg):
+    """
+    id агента для аренды и плана съёмки: leasing.agent_id из конфига или <hostname>-<uuid>,
+    сохранённый в .agent_id (один server_id обычно у нескольких агентов, поэтому он как id не годится).
+    """
+    configured = (cfg.get('leasing', {}) or {}).get('agent_id')
+    if configured:
+        return configured
+    try:
+        return AGENT_ID_PATH.read_text().strip()
+    except OSError:
+        pass
+    generated = f'{socket.gethostname()}-{uuid.uuid4().hex[:8]}'
+    try:
+        AGENT_ID_PATH.write_text(generated)
+    except OSError as e:
+        logging.warning(f'[leases] Не удалось сохранить agent_id: {e}')
+    return generated
+
+def start_leases(cfg):
+    global leases
+    l_cfg = cfg.get('leasing', {}) or {}
+    if not l_cfg.get('enabled', False):
+        return None
+    def candidates():
+        online = registry.online() if registry is not None else []
+        return [dev_id for dev_id in online if device_config(cfg, dev_id).get('enabled', True)]
+    leases = LeaseClient(
+        command_target(cfg), agent_id(cfg), candidates,
+        capacity=l_cfg.get('capacity', 50),
+        interval=l_cfg.get('interval', 20),
+        keep_on_offline=l_cfg.get('keep_on_offline', True),
+        server_id=cfg.get('server_id', ''),
+        host=socket.gethostname()
+    )
+    leases.start()
+    return leases
+
+def may_capture(dev_id):
+    """Устройство онлайн и (при включённой аренде) арендовано этим агентом."""
+    if registry is not None and not registry.is_online(dev_id):
+        return False
+    return leases is None or leases.holds(dev_id)
+
+# --- План съёмки: фазы устройств от сервера, чтобы загрузки парка шли равномерно ---
+planner = None
+
+def start_planner(cfg):
+    global planner
+    p_cfg = cfg.get('capture_plan', {}) or {}
+    if not p_cfg.get('enabled', True):
+        return None
+    def devices():
+        online = registry.online() if registry is not None else [d['id'] for d in cfg['devices']]
+        return {dev_id: device_config(cfg, dev_id).get('interval', 60) for dev_id in online
+                if device_config(cfg, dev_id).get('enabled', True) and may_capture(dev_id)}
+    planner = CapturePlan(
+        command_target(cfg), agent_id(cfg), devices,
+        refresh=p_cfg.get('refresh', 300),
+        server_id=cfg.get('server_id', ''),
+        host=socket.gethostname()
+    )
+    planner.start()
+    return planner
+
+# --- Телеметрия: числовые метрики устройств пачками на /api/telemetry ---
+telemetry = None
+
+def start_telemetry(cfg):
+    global telemetry
+    t_cfg = cfg.get('telemetry', {}) or {}
+    if not t_cfg.get('enabled', True):
+        return None
+    telemetry = TelemetryBatcher(
+        lambda samples, batch_id: enqueue(cfg, 'telemetry', {'server_id': cfg.get('server_id', ''), 'batch_id': batch_id, 'samples': samples}),
+        flush_interval=t_cfg.get('flush_interval', 60)
+    )
+    telemetry.start()
+    schedule.every(t_cfg.get('interval', 60)).seconds.do(
+        lambda: threading.Thread(target=telemetry_job, args=(cfg,), daemon=True).start())
+    return telemetry
+
+def telemetry_job(cfg):
+    """Сэмпл метрик по онлайн-устройствам (метаданные — из кэша, ADB вызывается только по TTL)."""
+    for dev_id in (registry.online() if registry is not None else []):
+        for metric, value in parse_metrics(metadata_cache.get(dev_id, cfg)).items():
+            telemetry.add(dev_id, metric, value)
+        if health is not None and health.latency(dev_id) is not None:
+            telemetry.add(dev_id, 'adb_latency_ms', health.latency(dev_id))
 
 # --- last.png и отправка только новых скринов ---
 def get_file_hash(path):
@@ -68,63 +184,266 @@ def get_file_hash(path):
             h.update(chunk)
     return h.hexdigest()
 
-last_hashes = {}
+# Хэши последних кадров и статус их отправки переживают перезапуск агента (в т.ч. update_agent)
+dedupe = None
+
+def get_dedupe(cfg):
+    global dedupe
+    if dedupe is None:
+        dedupe = DedupeStore(cfg.get('dedupe_state', 'dedupe_state.json'))
+    return dedupe
+
+def on_delivered(target, item, delivered):
+    """Итог доставки скриншота: подтверждение (или потеря) кадра для детектора изменений."""
+    if item['kind'] == 'screenshot' and dedupe is not None:
+        payload = item['payload']
+        dedupe.ack(f"{payload['device_id']}:{payload['section']}", target.name, item['id'], delivered)
+
+# --- Буфер кадров перед событием: окно кадров отправляется по команде upload_frames ---
+frame_buffer = None
+_frame_buffer_lock = threading.Lock()
+
+def get_frame_buffer(cfg):
+    global frame_buffer
+    fb_cfg = cfg.get('frame_buffer', {}) or {}
+    if not fb_cfg.get('enabled', True):
+        return None
+    with _frame_buffer_lock:
+        if frame_buffer is None:
+            frame_buffer = FrameBuffer(
+                fb_cfg.get('dir', 'frames'),
+                max_frames=fb_cfg.get('max_frames', 120),
+                max_age=fb_cfg.get('max_age', 600),
+                max_bytes=int(fb_cfg.get('max_mb', 200)) * 1024 * 1024,
+                profile=fb_cfg.get('profile')
+            )
+    return frame_buffer
+
+def buffer_job(cfg, device):
+    """Съёмка только в буфер (frame_buffer.capture_interval): кадры чаще, чем отправки на сервер."""
+    buffer = get_frame_buffer(cfg)
+    screenshot_path = DeviceSession(device, cfg).take_screenshot()
+    if not screenshot_path:
+        return
+    try:
+        buffer.add(device['id'], 'buffer', screenshot_path, get_file_hash(screenshot_path))
+    finally:
+        os.remove(screenshot_path)
+
+def frame_window(params):
+    """Интервал из параметров команды: число секунд или {"seconds": N} / {"from": ts, "to": ts}."""
+    if isinstance(params, (int, float)):
+        return time.time() - params, None
+    params = params if isinstance(params, dict) else {}
+    if 'from' in params or 'to' in params:
+        return params.get('from'), params.get('to')
+    return time.time() - float(params.get('seconds', 60)), None
+
+def upload_frames(cfg, device, cmd):
+    buffer = get_frame_buffer(cfg)
+    if buffer is None:
+        return 'error', 'Буфер кадров отключён'
+    since, until = frame_window(cmd.get('params'))
+    archive, count = buffer.pack(device['id'], since, until)
+    if archive is None:
+        return 'done', 'Нет кадров за указанный интервал'
+    data = {
+        'server_id': cfg.get('server_id', ''),
+        'device_id': device['id'],
+        'command_id': cmd['id'],
+        'frames': count
+    }
+    try:
+        command_target(cfg).put('frames', data, archive)
+    finally:
+        os.remove(archive)
+    return 'done', f'Кадров в буфере: {count}, поставлены в очередь отправки'
+
+# --- Артефакты устройства (logcat, файлы): возобновляемая загрузка частями ---
+def pull_artifact(cfg, device, cmd):
+    """Команда pull: params — 'logcat' (по умолчанию), путь файла на устройстве или {"source": ...}."""
+    params = cmd.get('params')
+    source = (params.get('source') if isinstance(params, dict) else params) or 'logcat'
+    a_cfg = cfg.get('artifacts', {}) or {}
+    session = DeviceSession(device, cfg)
+    try:
+        path = session.pull(source, a_cfg.get('dir', 'artifacts'))
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        return 'error', f'Не удалось снять {source}: {e}'
+    sha256 = file_sha256(path)
+    data = {
+        'upload_id': make_upload_id(device['id'], cmd['id'], sha256),
+        'server_id': cfg.get('server_id', ''),
+        'device_id': device['id'],
+        'command_id': cmd['id'],
+        'kind': 'logcat' if source == 'logcat' else 'file',
+        'filename': Path(path).name,
+        'sha256': sha256
+    }
+    size = os.path.getsize(path)
+    try:
+        command_target(cfg).put('artifact', data, path)
+    finally:
+        os.remove(path)
+    return 'done', f'{source}: {size} байт, поставлено в очередь отправки'
 
 def device_job(cfg, device, section='default'):
     if not device.get('enabled', True):
         return
     session = DeviceSession(device, cfg)
-    meta = session.get_metadata()
     # 1. Снять скриншот
+    started = time.monotonic()
     screenshot_path = session.take_screenshot()
+    if telemetry is not None and screenshot_path:
+        telemetry.add(device['id'], 'capture_ms', (time.monotonic() - started) * 1000)
     if screenshot_path:
         # 2. last.png + отправка только новых скринов
         hash_now = get_file_hash(screenshot_path)
+        buffer = get_frame_buffer(cfg)
+        if buffer is not None:
+            buffer.add(device['id'], section, screenshot_path, hash_now)
         key = f"{device['id']}:{section}"
-        if last_hashes.get(key) == hash_now:
+        store = get_dedupe(cfg)
+        if store.is_duplicate(key, hash_now):
             logging.info(f"[{device['id']}] Скриншот не изменился, не отправляю.")
             os.remove(screenshot_path)
             return
-        last_hashes[key] = hash_now
+        store.record(key, hash_now, targets=[t.name for t in get_targets(cfg)])
         # last.png (перезапись)
         last_dir = Path(cfg.get('screenshot_dir', 'screenshots')) / device['id'].replace(':', '_') / section
         last_dir.mkdir(parents=True, exist_ok=True)
         last_path = last_dir / 'last.png'
         os.replace(screenshot_path, last_path)
-        # 3. Отправить скриншот с метаданными и секцией
-        upload_screenshot(cfg, device, last_path, meta, section)
+        # 3. Перекодировать по профилю секции и отправить с метаданными (из кэша, только для реальных отправок)
+        meta = session.get_metadata()
+        if health is not None and health.latency(device['id']) is not None:
+            meta = dict(meta, adb_latency_ms=health.latency(device['id']))
+        upload_path, _ = encode_screenshot(last_path, get_profile(cfg, section))
+        # запись очереди отмечается в dedupe до того, как её увидит поток отправки: быстрое
+        # подтверждение или удаление записи не теряется
+        upload_screenshot(cfg, device, upload_path, meta, section,
+                          on_queued=lambda target_name, item_id: store.pending(key, target_name, item_id))
         send_message(cfg, device['id'], 'log', f'Скриншот отправлен: {last_path}')
     else:
+        # устройство могло перезагрузиться — метаданные перечитаем при следующей отправке
+        metadata_cache.invalidate(device['id'])
         send_message(cfg, device['id'], 'error', 'Ошибка снятия скриншота')
-    # 4. Получить и выполнить команды
-    commands = get_commands(cfg, device)
-    for cmd in commands:
-        status = 'done'
-        result = ''
-        try:
-            if cmd['command'] == 'screencap':
-                device_job(cfg, device, section=cmd.get('section', 'default'))
-                result = 'Скриншот обновлён'
-            elif cmd['command'] == 'echo':
-                result = f'echo: {cmd["params"]}'
-            elif cmd['command'] == 'update_agent':
-                result = update_agent()
-            elif cmd['command'] == 'custom':
-                # TODO: кастомные бинды/действия
-                result = f'custom: {cmd["params"]}'
-            else:
-                status = 'error'
-                result = f'Неизвестная команда: {cmd["command"]}'
-        except Exception as e:
+    # 4. Получить и выполнить команды (опрос — только если нет WebSocket-канала)
+    if channel is None or not channel.connected:
+        for cmd in get_commands(cfg, device):
+            run_command(cfg, device, cmd)
+
+# --- Выполнение команд (из WebSocket-канала или опроса) ---
+channel = None
+_seen_commands = OrderedDict()
+_seen_lock = threading.Lock()
+
+def claim_command(command_id):
+    """Команда может прийти и по каналу, и опросом — выполняем один раз."""
+    with _seen_lock:
+        if command_id in _seen_commands:
+            return False
+        _seen_commands[command_id] = True
+        while len(_seen_commands) > 1000:
+            _seen_commands.popitem(last=False)
+        return True
+
+def execute_command(cfg, device, cmd):
+    status = 'done'
+    result = ''
+    try:
+        if cmd['command'] == 'screencap':
+            device_job(cfg, device, section=cmd.get('section', 'default'))
+            result = 'Скриншот обновлён'
+        elif cmd['command'] == 'upload_frames':
+            status, result = upload_frames(cfg, device, cmd)
+        elif cmd['command'] == 'pull':
+            status, result = pull_artifact(cfg, device, cmd)
+        elif cmd['command'] == 'echo':
+            result = f'echo: {cmd["params"]}'
+        elif cmd['command'] == 'update_agent':
+            result = update_agent()
+        elif cmd['command'] == 'custom':
+            # TODO: кастомные бинды/действия
+            result = f'custom: {cmd["params"]}'
+        else:
             status = 'error'
-            result = str(e)
-        confirm_command(cfg, cmd['id'], status, result)
+            result = f'Неизвестная команда: {cmd["command"]}'
+    except Exception as e:
+        status = 'error'
+        result = str(e)
+    return status, result
+
+def run_command(cfg, device, cmd):
+    if not claim_command(cmd['id']):
+        return
+    finish_command(cfg, device, cmd)
+
+def finish_command(cfg, device, cmd):
+    status, result = execute_command(cfg, device, cmd)
+    confirm_command(cfg, cmd['id'], status, result)
 
-def upload_screenshot(cfg, device, screenshot_path, meta=None, section='default'):
-    url = cfg['server_url'].rstrip('/') + '/upload_screenshot'
-    headers = {'Authorization': f'Bearer {cfg["api_key"]}'}
+def on_channel_command(cfg, cmd):
+    """
+    Команда из канала. Канал рассылает её всем агентам server_id: выполняет только арендатор устройства.
+    True — команда забрана (claim) и выполняется: только тогда канал отправляет ack (сервер помечает её delivered).
+    """
+    if leases is not None and not leases.holds(cmd['device_id']):
+        return False
+    if not claim_command(cmd['id']):
+        return False
+    device = device_config(cfg, cmd['device_id'])
+    threading.Thread(target=finish_command, args=(cfg, device, cmd), daemon=True).start()
+    return True
+
+def start_channel(cfg):
+    global channel
+    ch_cfg = cfg.get('channel', {}) or {}
+    if not ch_cfg.get('enabled', True):
+        return None
+    target = command_target(cfg)
+    channel = AgentChannel(target.url, target.api_key, target.server_id,
+                           lambda cmd: on_channel_command(cfg, cmd),
+                           heartbeat=ch_cfg.get('heartbeat', 20))
+    channel.start()
+    return channel
+
+# --- Серверы-получатели: у каждого своя очередь отправок (spool) и свой поток отправки ---
+targets = []
+_targets_lock = threading.Lock()
+
+def get_targets(cfg):
+    with _targets_lock:
+        if not targets:
+            targets.extend(load_targets(cfg, on_done=on_delivered))
+            for target in targets:
+                target.start()
+    return targets
+
+def command_target(cfg):
+    """Сервер, от которого агент принимает команды (канал, опрос) и которому отвечает."""
+    return next(t for t in get_targets(cfg) if t.commands)
+
+def enqueue(cfg, kind, payload, file_path=None, on_queued=None):
+    """Поставить отправку в очереди всех серверов: файл один, в очереди он попадает hardlink-ом.
+    Возвращает {имя сервера: id записи в его очереди}; on_queued(имя сервера, id) — до начала отправки записи."""
+    return {target.name: target.put(kind, payload, file_path,
+                                    on_queued=(lambda item_id, name=target.name: on_queued(name, item_id)) if on_queued else None)
+            for target in get_targets(cfg)}
+
+def flush_spool(timeout=60):
+    """Дождаться опустошения очередей всех серверов (для CLI-режима test)."""
+    deadline = time.time() + timeout
+    while any(len(t.spool) for t in targets) and time.time() < deadline:
+        time.sleep(0.5)
+
+def server_online():
+    commander = next((t for t in targets if t.commands), None)
+    return commander is None or commander.online
+
+def upload_screenshot(cfg, device, screenshot_path, meta=None, section='default', on_queued=None):
     data = {
-        'server_id': cfg['server_id'],
+        'server_id': cfg.get('server_id', ''),
         'window': device.get('window', 'main'),
         'device_id': device['id'],
         'device_name': device.get('name', device['id']),
@@ -133,38 +452,28 @@ def upload_screenshot(cfg, device, screenshot_path, meta=None, section='default'
         'section': section,
         'meta': json.dumps(meta or {})
     }
-    files = {'image': open(screenshot_path, 'rb')}
-    resp = requests.post(url, headers=headers, data=data, files=files, timeout=30)
-    if resp.ok:
-        logging.info(f'[{device["id"]}] Скриншот отправлен: {resp.json().get("path")}')
-    else:
-        logging.error(f'[{device["id"]}] Ошибка отправки скриншота: {resp.text}')
-    files['image'].close()
+    item_ids = enqueue(cfg, 'screenshot', data, screenshot_path, on_queued=on_queued)
+    logging.info(f'[{device["id"]}] Скриншот поставлен в очередь отправки')
+    return item_ids
 
 def send_message(cfg, device_id, msg_type, message):
-    url = cfg['server_url'].rstrip('/') + '/api/send_message'
-    headers = {'Authorization': f'Bearer {cfg["api_key"]}'}
     data = {
-        'server_id': cfg['server_id'],
+        'server_id': cfg.get('server_id', ''),
         'device_id': device_id,
         'type': msg_type,
-        'message': message
+        'message': message,
+        'timestamp': datetime.now().isoformat()
     }
-    try:
-        resp = requests.post(url, headers=headers, json=data, timeout=15)
-        if resp.ok:
-            logging.info(f'[{device_id}] Сообщение отправлено: {msg_type}')
-        else:
-            logging.error(f'[{device_id}] Ошибка отправки сообщения: {resp.text}')
-    except Exception as e:
-        logging.error(f'[{device_id}] Ошибка HTTP: {e}')
+    enqueue(cfg, 'message', data)
 
 def get_commands(cfg, device):
-    url = cfg['server_url'].rstrip('/') + '/api/get_commands'
-    headers = {'Authorization': f'Bearer {cfg["api_key"]}'}
-    params = {'server_id': cfg['server_id'], 'device_id': device['id']}
+    # Пока сервер недоступен, не блокируем цикл устройства ожиданием таймаута
+    if not server_online():
+        return []
+    target = command_target(cfg)
+    params = {'server_id': target.server_id, 'device_id': device['id']}
     try:
-        resp = requests.get(url, headers=headers, params=params, timeout=15)
+        resp = requests.get(target.url + '/api/get_commands', headers=target.headers, params=params, timeout=5)
         if resp.ok:
             return resp.json().get('commands', [])
         else:
@@ -174,37 +483,76 @@ def get_commands(cfg, device):
     return []
 
 def confirm_command(cfg, command_id, status, result=None):
-    url = cfg['server_url'].rstrip('/') + '/api/command_result'
-    headers = {'Authorization': f'Bearer {cfg["api_key"]}'}
     data = {'command_id': command_id, 'status': status}
     if result:
         data['result'] = result
+    if channel is not None and channel.send(dict(data, type='result')):
+        logging.info(f'[cmd:{command_id}] Результат отправлен по каналу: {status}')
+        return
+    command_target(cfg).put('command_result', data)
+    logging.info(f'[cmd:{command_id}] Подтверждение поставлено в очередь: {status}')
+
+# --- Планировщик: задания существуют только для устройств в состоянии device ---
+def device_config(cfg, dev_id):
+    # Поиск в конфиге, если нет — дефолтные параметры
+    device = next((d for d in cfg['devices'] if d['id'] == dev_id), None)
+    return device or {'id': dev_id, 'enabled': True, 'window': 'main', 'interval': 60}
+
+def schedule_device(cfg, dev_id, state):
+    schedule.clear(dev_id)
+    if state != 'device':
+        logging.warning(f'[{dev_id}] Устройство {state or "отключено"}, задания сняты')
+        return
+    device = device_config(cfg, dev_id)
+    if not device.get('enabled', True):
+        return
+    interval = device.get('interval', 60)
+    def job(dev=device):
+        if not may_capture(dev['id']):
+            return
+        threading.Thread(target=device_job, args=(cfg, dev, 'default'), daemon=True).start()
+    if planner is None:
+        schedule.every(interval).seconds.do(job).tag(dev_id)
+    else:
+        # Съёмка в фазе, назначенной сервером; при обновлении плана момент пересчитывается
+        if not planner.has(dev_id):
+            planner.poke()
+        due = {'at': planner.next_due(dev_id, interval), 'version': planner.version}
+        def aligned_tick():
+            if due['version'] != planner.version:
+                due['at'], due['version'] = planner.next_due(dev_id, interval), planner.version
+            if time.time() >= due['at']:
+                due['at'] = planner.next_due(dev_id, interval)
+                job()
+        schedule.every(1).seconds.do(aligned_tick).tag(dev_id)
+    capture_interval = (cfg.get('frame_buffer', {}) or {}).get('capture_interval', 0)
+    if capture_interval and get_frame_buffer(cfg) is not None:
+        def buffer_tick(dev=device):
+            if may_capture(dev['id']):
+                threading.Thread(target=buffer_job, args=(cfg, dev), daemon=True).start()
+        schedule.every(capture_interval).seconds.do(buffer_tick).tag(dev_id)
+    if planner is None:
+        logging.info(f'[{dev_id}] Устройство онлайн, съёмка каждые {interval} сек')
+        job()
+    else:
+        logging.info(f'[{dev_id}] Устройство онлайн, съёмка по плану сервера, ближайшая через {max(0, due["at"] - time.time()):.0f} сек')
+
+def apply_device_events(cfg, timeout=1.0):
+    """Применить события реестра к расписанию (в главном потоке: schedule не потокобезопасен)."""
     try:
-        resp = requests.post(url, headers=headers, json=data, timeout=10)
-        if resp.ok:
-            logging.info(f'[cmd:{command_id}] Подтверждение отправлено: {status}')
-        else:
-            logging.error(f'[cmd:{command_id}] Ошибка подтверждения: {resp.text}')
-    except Exception as e:
-        logging.error(f'[cmd:{command_id}] Ошибка HTTP: {e}')
-
-def schedule_jobs(cfg):
-    def job_for_dynamic():
-        # Автосканирование устройств
-        found = scan_adb_devices()
-        for dev_id in found:
-            # Поиск в конфиге, если нет — добавить с дефолтными параметрами
-            device = next((d for d in cfg['devices'] if d['id'] == dev_id), None)
-            if not device:
-                device = {'id': dev_id, 'enabled': True, 'window': 'main', 'interval': 60}
-            threading.Thread(target=device_job, args=(cfg, device, 'default'), daemon=True).start()
-    schedule.every(30).seconds.do(job_for_dynamic)
-    # Также планировщик по конфигу (для кастомных секций/биндов)
-    for device in cfg['devices']:
-        interval = device.get('interval', 60)
-        def job(dev=device):
-            threading.Thread(target=device_job, args=(cfg, dev, 'default'), daemon=True).start()
-        schedule.every(interval).seconds.do(job)
+        events = [device_events.get(timeout=timeout)]
+    except queue.Empty:
+        return
+    while True:
+        try:
+            events.append(device_events.get_nowait())
+        except queue.Empty:
+            break
+    latest = {}
+    for dev_id, state in events:
+        latest[dev_id] = state
+    for dev_id, state in latest.items():
+        schedule_device(cfg, dev_id, state)
 
 def update_agent():
     try:
@@ -213,6 +561,8 @@ def update_agent():
         if r.ok:
             with open(__file__, 'wb') as f:
                 f.write(r.content)
+            if dedupe is not None:
+                dedupe.close()
             os.execv(sys.executable, ['python'] + sys.argv)
             return 'Агент обновлён и перезапущен'
         else:
@@ -224,22 +574,38 @@ def main():
     cfg = load_config()
     setup_logging(cfg.get('log_level', 'INFO'))
     logging.info('Агент запущен')
-    start_watchdog()
+    atexit.register(lambda: dedupe.close() if dedupe is not None else None)
+    atexit.register(lambda: telemetry.stop() if telemetry is not None else None)
+    get_dedupe(cfg)
+    get_targets(cfg)
     if len(sys.argv) > 1:
         if sys.argv[1] == 'status':
+            pool = adb_shards.configure(cfg)
+            for shard in pool.status():
+                print(f"adb:{shard['port']}: {shard}")
+            probes = HealthMonitor(pool, None, expected=lambda: [d['id'] for d in cfg['devices']]).check_all()
+            for dev_id, probe in probes.items():
+                print(f"{dev_id} health: {probe}")
             for device in cfg['devices']:
                 session = DeviceSession(device, cfg)
                 meta = session.get_metadata()
-                print(f"{device['id']}: {meta}")
+                print(f"{device['id']} (adb:{pool.shard_for(device['id']).port}): {meta}")
             sys.exit(0)
         if sys.argv[1] == 'test':
+            adb_shards.configure(cfg)
             for device in cfg['devices']:
                 device_job(cfg, device, 'default')
+            flush_spool()
             sys.exit(0)
-    schedule_jobs(cfg)
+    start_channel(cfg)
+    start_registry(cfg)
+    start_leases(cfg)
+    start_planner(cfg)
+    start_health(cfg)
+    start_telemetry(cfg)
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        apply_device_events(cfg, timeout=1.0)
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,106 @@
+import json
+import random
+import logging
+import threading
+from urllib.parse import urlencode
+
+try:
+    from websockets.sync.client import connect as ws_connect
+except ImportError:  # websockets не установлен — агент работает через опрос /api/get_commands
+    ws_connect = None
+
+
+def ws_url(server_url, server_id):
+    base = server_url.rstrip('/')
+    if base.startswith('https://'):
+        base = 'wss://' + base[len('https://'):]
+    elif base.startswith('http://'):
+        base = 'ws://' + base[len('http://'):]
+    return f'{base}/ws/agent?{urlencode({"server_id": server_id})}'
+
+
+class AgentChannel(threading.Thread):
+    """
+    Постоянный WebSocket-канал агента к серверу (/ws/agent).
+    - сервер присылает команды сразу после создания: {"type": "command", "command": {...}}
+    - агент подтверждает получение (ack) только принятой к выполнению команды: on_command(cmd) вернул True
+      (устройство арендовано этим агентом и команда забрана) — сервер переводит её в delivered,
+      поэтому ack агента, который команду пропустил, отнял бы её у арендатора
+    - отправляет результат (result) и heartbeat
+    - при обрыве — переподключение с backoff; пока канала нет, агент опрашивает /api/get_commands
+    """
+    def __init__(self, server_url, api_key, server_id, on_command, heartbeat=20, reconnect_max=60):
+        super().__init__(daemon=True)
+        self.url = ws_url(server_url, server_id)
+        self.api_key = api_key
+        self.on_command = on_command
+        self.heartbeat = heartbeat
+        self.reconnect_max = reconnect_max
+        self.ws = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    @property
+    def connected(self):
+        return self.ws is not None
+
+    def stop(self):
+        self.stopped.set()
+        ws = self.ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def send(self, msg):
+        """Отправить сообщение серверу. False — канала нет (вызывающий использует HTTP/очередь)."""
+        with self.lock:
+            if self.ws is None:
+                return False
+            try:
+                self.ws.send(json.dumps(msg, ensure_ascii=False))
+                return True
+            except Exception as e:
+                logging.warning(f'[channel] Ошибка отправки: {e}')
+                return False
+
+    def run(self):
+        if ws_connect is None:
+            logging.warning('[channel] Пакет websockets не установлен, команды получаются опросом')
+            return
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                with ws_connect(self.url, additional_headers={'Authorization': f'Bearer {self.api_key}'},
+                                open_timeout=10, close_timeout=2) as ws:
+                    self.ws = ws
+                    failures = 0
+                    logging.info('[channel] Канал с сервером установлен')
+                    self.listen(ws)
+            except Exception as e:
+                if not self.stopped.is_set():
+                    logging.warning(f'[channel] Канал недоступен: {e}')
+            finally:
+                self.ws = None
+            failures += 1
+            delay = min(self.reconnect_max, 2 ** min(failures, 6)) * random.uniform(0.5, 1.0)
+            self.stopped.wait(delay)
+
+    def listen(self, ws):
+        while not self.stopped.is_set():
+            try:
+                raw = ws.recv(timeout=self.heartbeat)
+            except TimeoutError:
+                self.send({'type': 'heartbeat'})
+                continue
+            msg = json.loads(raw)
+            if msg.get('type') == 'command':
+                cmd = msg['command']
+                try:
+                    accepted = self.on_command(cmd)
+                except Exception as e:
+                    logging.error(f'[channel] Ошибка обработки команды {cmd.get("id")}: {e}')
+                    continue
+                if accepted:
+                    self.send({'type': 'ack', 'command_id': cmd['id']})
@@ -0,0 +1,98 @@
+import os
+import time
+import hashlib
+import logging
+import requests
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Сколько раз подряд сервер может ответить 409 (другое смещение, незавершённый файл, неверный sha256),
+# прежде чем загрузка будет прервана
+MAX_CONFLICTS = 5
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_upload_id(device_id, command_id, sha256):
+    """Стабильный id загрузки: повторная отправка того же файла продолжает ту же загрузку на сервере."""
+    return hashlib.sha256(f'{device_id}|{command_id}|{sha256}'.encode()).hexdigest()[:32]
+
+
+class ChunkedUploader:
+    """
+    Возобновляемая загрузка файла частями (/api/artifacts):
+    init сообщает размер и sha256 файла и возвращает смещение, уже принятое сервером; части отправляются
+    с этого смещения (у каждой — sha256 в X-Chunk-Sha256), complete проверяет файл целиком и фиксирует его.
+    Обрыв связи: до retries повторов части с паузой, затем исключение — запись остаётся в очереди (spool),
+    и следующая попытка продолжает с последнего подтверждённого смещения, а не с нуля.
+    """
+    def __init__(self, url, headers, chunk_size=DEFAULT_CHUNK_SIZE, retries=3, timeout=60):
+        self.url = url
+        self.headers = headers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+
+    def _request(self, method, path, extra_headers=None, **kwargs):
+        # заголовки собираются один раз: повтор части уходит с тем же X-Chunk-Sha256
+        headers = dict(self.headers, **(extra_headers or {}))
+        for attempt in range(self.retries + 1):
+            try:
+                return requests.request(method, self.url + path, headers=headers, timeout=self.timeout, **kwargs)
+            except requests.RequestException:
+                if attempt == self.retries:
+                    raise
+                time.sleep(min(2 ** attempt, 10))
+
+    def upload(self, path, meta):
+        """meta: upload_id, server_id, device_id, command_id, kind, filename, sha256. Возвращает ответ complete."""
+        size = os.path.getsize(path)
+        resp = self._request('POST', '/api/artifacts/init', json=dict(meta, size=size))
+        if not resp.ok:
+            return resp
+        upload_id = meta['upload_id']
+        offset = resp.json()['offset']
+        if offset:
+            logging.info(f'[chunked] {upload_id}: продолжение загрузки с {offset} из {size} байт')
+        conflicts = 0
+        with open(path, 'rb') as f:
+            while True:
+                while offset < size:
+                    f.seek(offset)
+                    chunk = f.read(self.chunk_size)
+                    resp = self._request('PUT', f'/api/artifacts/{upload_id}/chunk', params={'offset': offset}, data=chunk,
+                                         extra_headers={'X-Chunk-Sha256': hashlib.sha256(chunk).hexdigest(),
+                                                        'Content-Type': 'application/octet-stream'})
+                    if resp.status_code == 409:
+                        # сервер принял другое смещение (например, повтор после потерянного ответа)
+                        conflicts += 1
+                        if conflicts > MAX_CONFLICTS:
+                            return resp
+                        offset = self._server_offset(resp, size)
+                        continue
+                    if not resp.ok:
+                        return resp
+                    offset = resp.json()['offset']
+                resp = self._request('POST', f'/api/artifacts/{upload_id}/complete')
+                if resp.status_code != 409:
+                    return resp
+                # загрузка не завершена или sha256 не совпал (сервер сбросил смещение в 0) — догрузить/начать заново
+                conflicts += 1
+                if conflicts > MAX_CONFLICTS:
+                    return resp
+                offset = self._server_offset(resp, size)
+                logging.warning(f'[chunked] {upload_id}: сервер не принял файл ({resp.text}), продолжение с {offset}')
+
+    @staticmethod
+    def _server_offset(resp, size):
+        """Смещение из ответа 409; без него или за пределами файла — с нуля."""
+        try:
+            offset = int(resp.json().get('offset', 0))
+        except (ValueError, TypeError, AttributeError):
+            return 0
+        return offset if 0 <= offset <= size else 0
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+
+# Состояние отправки кадра
+PENDING = 'pending'  # в очереди отправки (очередь персистентна — повторно не отправляем)
+ACKED = 'acked'      # сервер принял кадр
+FAILED = 'failed'    # сервер отверг кадр или очередь его удалила — такой же кадр нужно отправить снова
+
+
+class DedupeStore:
+    """
+    Состояние детектора изменений по ключу устройство:секция — хэш последнего кадра и статус его
+    отправки. Хранится в небольшом JSON-файле: загружается при старте, записывается фоновым
+    потоком не чаще раза в flush_interval секунд (цикл устройства не ждёт диска).
+    Благодаря этому после перезапуска агента неизменившиеся кадры повторно не отправляются.
+    """
+    def __init__(self, path='dedupe_state.json', flush_interval=2.0):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.stopped = threading.Event()
+        self.entries = self.load()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f'[dedupe] Не удалось прочитать {self.path}: {e}, начинаю с пустого состояния')
+            return {}
+
+    def is_duplicate(self, key, frame_hash):
+        """Кадр совпадает с последним и тот не потерялся при отправке."""
+        with self.lock:
+            entry = self.entries.get(key)
+            return bool(entry) and entry['hash'] == frame_hash and entry['status'] != FAILED
+
+    def record(self, key, frame_hash, targets=()):
+        """Новый кадр; targets — серверы, куда он уйдёт: кадр ACKED, только когда подтвердят все."""
+        with self.lock:
+            self.entries[key] = {'hash': frame_hash, 'status': PENDING, 'pending': {t: None for t in targets}, 'updated_at': time.time()}
+        self.dirty.set()
+
+    def pending(self, key, target, item_id):
+        """Запомнить запись очереди сервера target, в которой ушёл кадр."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry['pending'][target] = item_id
+        self.dirty.set()
+
+    def ack(self, key, target, item_id, ok):
+        """Результат доставки записи очереди; подтверждения старых кадров игнорируются."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or entry['pending'].get(target) != item_id:
+                return
+            del entry['pending'][target]
+            if not ok:
+                entry['status'] = FAILED
+            elif entry['status'] == PENDING and not entry['pending']:
+                entry['status'] = ACKED
+            entry['updated_at'] = time.time()
+        self.dirty.set()
+
+    def flush(self):
+        """Записать состояние на диск (tmp + os.replace)."""
+        with self.lock:
+            data = json.dumps(self.entries, ensure_ascii=False)
+            self.dirty.clear()
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.error(f'[dedupe] Ошибка записи {self.path}: {e}')
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.dirty.wait()
+            if self.stopped.wait(self.flush_interval):
+                break
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.dirty.set()
+        self.flush()
@@ -0,0 +1,196 @@
+import socket
+import logging
+import threading
+from adb_shards import AdbShard, DEFAULT_ADB_PORT, is_network_device
+
+
+def parse_devices(payload):
+    """Разбор списка устройств из ответа adb: строки 'serial<TAB>state'."""
+    devices = {}
+    for line in payload.splitlines():
+        if '\t' in line:
+            serial, state = line.split('\t', 1)
+            devices[serial.strip()] = state.strip()
+    return devices
+
+
+class DeviceRegistry:
+    """
+    Реестр устройств ADB, который обновляется потоком событий host:track-devices
+    (постоянное соединение с adb server, без периодического опроса `adb devices`).
+    Подписчики получают события: callback(event, serial, state, old_state),
+    event — 'added', 'removed' или 'changed'; state — 'device', 'offline', 'unauthorized', ... или None.
+    accept(serial) — фильтр устройств (при шардировании шард видит только свои устройства),
+    on_foreign(serial, state, port) — вызывается для появившихся чужих устройств; True — шард берёт устройство себе.
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_ADB_PORT, shard=None, accept=None, on_foreign=None, reconnect_delay=2.0):
+        self.host = host
+        self.shard = shard or AdbShard(port)
+        self.port = self.shard.port
+        self.accept = accept
+        self.on_foreign = on_foreign
+        self.foreign = set()
+        self.reconnect_delay = reconnect_delay
+        self.devices = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sock = None
+        self.thread = None
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def state(self, serial):
+        with self.lock:
+            return self.devices.get(serial)
+
+    def is_online(self, serial):
+        return self.state(serial) == 'device'
+
+    def online(self):
+        with self.lock:
+            return [s for s, st in self.devices.items() if st == 'device']
+
+    def all(self):
+        """Все устройства шарда с состояниями."""
+        with self.lock:
+            return dict(self.devices)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.track()
+            except (OSError, ConnectionError) as e:
+                if self.stopped.is_set():
+                    break
+                logging.warning(f'[adb:{self.port}] Соединение с adb server потеряно: {e}')
+                self.shard.last_error = str(e)
+            # adb server недоступен — все транспорты этого шарда потеряны
+            self.shard.connected = False
+            self.update({})
+            if self.stopped.wait(self.reconnect_delay):
+                break
+            self.shard.start_server()
+
+    def track(self):
+        with socket.create_connection((self.host, self.port), timeout=10) as sock:
+            self.sock = sock
+            request = b'host:track-devices'
+            sock.sendall(b'%04x' % len(request) + request)
+            status = self.recv_exact(sock, 4)
+            if status != b'OKAY':
+                length = int(self.recv_exact(sock, 4), 16)
+                raise ConnectionError(f'adb server: {self.recv_exact(sock, length).decode(errors="replace")}')
+            sock.settimeout(None)
+            self.shard.connected = True
+            logging.info(f'[adb:{self.port}] Подписка на события устройств (track-devices)')
+            while not self.stopped.is_set():
+                length = int(self.recv_exact(sock, 4), 16)
+                payload = self.recv_exact(sock, length).decode(errors='replace') if length else ''
+                self.update(parse_devices(payload))
+
+    @staticmethod
+    def recv_exact(sock, n):
+        buf = b''
+        while len(buf) < n:
+            chunk = sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError('соединение закрыто adb server')
+            buf += chunk
+        return buf
+
+    def update(self, devices):
+        """Применить новый список устройств и разослать события об изменениях."""
+        if self.accept is not None:
+            own = {s: st for s, st in devices.items() if self.accept(s)}
+            foreign = set(devices) - set(own)
+            for serial in sorted(foreign - self.foreign):
+                if self.on_foreign is not None and self.on_foreign(serial, devices[serial], self.port):
+                    own[serial] = devices[serial]
+            self.foreign = foreign - set(own)
+            devices = own
+        events = []
+        with self.lock:
+            old = self.devices
+            for serial, state in devices.items():
+                if serial not in old:
+                    events.append(('added', serial, state, None))
+                elif old[serial] != state:
+                    events.append(('changed', serial, state, old[serial]))
+            for serial, state in old.items():
+                if serial not in devices:
+                    events.append(('removed', serial, None, state))
+            self.devices = dict(devices)
+        for event in events:
+            logging.info(f'[adb:{self.port}] {event[1]}: {event[0]} ({event[3]} -> {event[2]})')
+            for callback in self.listeners:
+                try:
+                    callback(*event)
+                except Exception as e:
+                    logging.error(f'[adb:{self.port}] Ошибка обработчика события {event}: {e}')
+
+
+class ShardedRegistry:
+    """
+    Реестр устройств по всем adb server пула (AdbShardPool): по потоку track-devices на каждый шард.
+    Шард сообщает только о своих устройствах; сетевое устройство, подключённое к чужому adb server,
+    переносится на свой шард. USB-устройство или эмулятор, которого не видит свой шард, закрепляется
+    за шардом, который его видит (иначе агент его бы не увидел вовсе).
+    """
+    def __init__(self, pool, host='127.0.0.1', reconnect_delay=2.0):
+        self.pool = pool
+        self.registries = {
+            port: DeviceRegistry(host, shard=shard, accept=lambda serial, port=port: pool.owns(port, serial),
+                                 on_foreign=self.on_foreign, reconnect_delay=reconnect_delay)
+            for port, shard in pool.shards.items()
+        }
+
+    def on_foreign(self, serial, state, port):
+        if is_network_device(serial):
+            threading.Thread(target=self.pool.migrate, args=(serial, port), daemon=True).start()
+            return False
+        owner = self.pool.shard_for(serial).port
+        if self.registries[owner].state(serial) is not None:
+            return False  # свой шард устройство видит — на этом шарде оно лишнее
+        self.pool.pin(serial, port)
+        return True
+
+    def subscribe(self, callback):
+        for registry in self.registries.values():
+            registry.subscribe(callback)
+
+    def state(self, serial):
+        return self.registries[self.pool.shard_for(serial).port].state(serial)
+
+    def is_online(self, serial):
+        return self.state(serial) == 'device'
+
+    def online(self):
+        return [s for registry in self.registries.values() for s in registry.online()]
+
+    def all(self):
+        devices = {}
+        for registry in self.registries.values():
+            devices.update(registry.all())
+        return devices
+
+    def start(self):
+        for registry in self.registries.values():
+            registry.start()
+
+    def stop(self):
+        for registry in self.registries.values():
+            registry.stop()
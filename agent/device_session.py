@@ -3,6 +3,108 @@ import logging
 from pathlib import Path
 from datetime import datetime
 import subprocess
+import time
+import uuid
+from adb_shards import adb_env
+
+# Маркер-разделитель вывода команд в одном вызове adb shell
+META_SEPARATOR = '__META_SEP__'
+
+class MetadataCache:
+    """
+    Кэш метаданных устройств с TTL по полям (секунды, 0 — бессрочно).
+    - adb_version — общая для хоста, запрашивается один раз на процесс
+    - uptime, free_space и battery собираются одним вызовом adb shell; uptime между запросами
+      досчитывается по часам хоста, поэтому его TTL может быть большим
+    """
+    DEFAULT_TTL = {'adb_version': 0, 'uptime': 600, 'free_space': 300, 'battery': 300}
+    DEVICE_FIELDS = ('uptime', 'free_space', 'battery')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.host = {}      # поле -> (значение, время получения)
+        self.devices = {}   # device_id -> {поле: (значение, время получения)}
+
+    @staticmethod
+    def expired(entry, ttl, now):
+        if entry is None:
+            return True
+        return bool(ttl) and now - entry[1] > ttl
+
+    def get(self, device_id, cfg=None):
+        ttl = dict(self.DEFAULT_TTL)
+        ttl.update((cfg or {}).get('metadata_ttl', {}) or {})
+        now = time.monotonic()
+        meta = {}
+        with self.lock:
+            version = self.host.get('adb_version')
+        if self.expired(version, ttl['adb_version'], now):
+            version = (self.fetch_adb_version(), now)
+            if not version[0].startswith('error:'):
+                with self.lock:
+                    self.host['adb_version'] = version
+        meta['adb_version'] = version[0]
+        with self.lock:
+            fields = dict(self.devices.get(device_id, {}))
+        if any(self.expired(fields.get(f), ttl[f], now) for f in self.DEVICE_FIELDS):
+            fetched = self.fetch_device_fields(device_id)
+            if fetched is None:
+                meta['uptime'] = meta['free_space'] = meta['battery'] = 'error: adb shell failed'
+                return meta
+            fields = {f: (fetched[f], now) for f in self.DEVICE_FIELDS}
+            with self.lock:
+                self.devices[device_id] = fields
+        uptime, fetched_at = fields['uptime']
+        try:
+            meta['uptime'] = f'{float(uptime) + (now - fetched_at):.2f}'
+        except ValueError:
+            meta['uptime'] = uptime
+        meta['free_space'] = fields['free_space'][0]
+        meta['battery'] = fields['battery'][0]
+        return meta
+
+    def invalidate(self, device_id):
+        with self.lock:
+            self.devices.pop(device_id, None)
+
+    @staticmethod
+    def fetch_adb_version():
+        try:
+            out = subprocess.check_output(['adb', 'version'], stderr=subprocess.STDOUT, text=True)
+            return out.strip().splitlines()[0]
+        except Exception as e:
+            return f'error: {e}'
+
+    @staticmethod
+    def fetch_device_fields(device_id):
+        """Uptime, свободное место на /data и уровень батареи одним вызовом adb shell."""
+        script = f'cat /proc/uptime; echo {META_SEPARATOR}; df /data; echo {META_SEPARATOR}; dumpsys battery'
+        try:
+            out = subprocess.check_output(['adb', '-s', device_id, 'shell', script], stderr=subprocess.STDOUT, text=True, env=adb_env(device_id))
+        except Exception as e:
+            logging.error(f'[{device_id}] Ошибка получения метаданных: {e}')
+            return None
+        uptime_part, _, rest = out.partition(META_SEPARATOR)
+        df_part, _, battery_part = rest.partition(META_SEPARATOR)
+        uptime = uptime_part.strip().split()
+        df_lines = df_part.strip().splitlines()
+        level = next((line.split(':', 1)[1].strip() for line in battery_part.splitlines()
+                      if line.strip().startswith('level:')), None)
+        return {
+            'uptime': uptime[0] if uptime else 'error: empty output',
+            'free_space': (df_lines[1] if len(df_lines) > 1 else df_lines[0]) if df_lines else 'error: empty output',
+            'battery': level if level is not None else 'error: no battery info',
+        }
+
+metadata_cache = MetadataCache()
+
+def capture_stamp():
+    """
+    Метка имени снимка/артефакта: время до миллисекунд и случайный суффикс. Съёмка в буфер и обычная
+    съёмка одного устройства могут совпасть по времени — у каждой свой файл и на устройстве, и локально.
+    """
+    now = datetime.now()
+    return f"{now.strftime('%Y-%m-%d_%H-%M-%S')}-{now.microsecond // 1000:03d}_{uuid.uuid4().hex[:6]}"
 
 class DeviceSession:
     def __init__(self, device, cfg):
@@ -14,7 +116,7 @@ class DeviceSession:
         self.lock = threading.Lock()
 
     def take_screenshot(self):
-        ts = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        ts = capture_stamp()
         safe_device = self.device_id.replace(':', '_').replace('/', '_')
         filename = f'{safe_device}_{ts}.png'
         local_path = Path(self.screenshot_dir) / filename
@@ -22,40 +124,34 @@ class DeviceSession:
         cmd_cap = ['adb', '-s', self.device_id, 'shell', 'screencap', '-p', remote_path]
         cmd_pull = ['adb', '-s', self.device_id, 'pull', remote_path, str(local_path)]
         cmd_rm = ['adb', '-s', self.device_id, 'shell', 'rm', remote_path]
+        env = adb_env(self.device_id)
         try:
-            subprocess.run(cmd_cap, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            subprocess.run(cmd_pull, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            subprocess.run(cmd_rm, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            subprocess.run(cmd_cap, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            subprocess.run(cmd_pull, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            subprocess.run(cmd_rm, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
             if local_path.exists() and local_path.stat().st_size > 1000:
                 return str(local_path)
         except Exception as e:
             logging.error(f'[{self.device_id}] Ошибка снятия скриншота: {e}')
         return None
 
+    def pull(self, source, dst_dir):
+        """Снять артефакт устройства: source='logcat' — дамп logcat (-d), иначе путь файла на устройстве."""
+        ts = capture_stamp()
+        safe_device = self.device_id.replace(':', '_').replace('/', '_')
+        Path(dst_dir).mkdir(parents=True, exist_ok=True)
+        env = adb_env(self.device_id)
+        if source == 'logcat':
+            local_path = Path(dst_dir) / f'{safe_device}_{ts}_logcat.txt'
+            with open(local_path, 'wb') as f:
+                subprocess.run(['adb', '-s', self.device_id, 'logcat', '-d'], check=True, stdout=f, stderr=subprocess.PIPE, env=env, timeout=120)
+        else:
+            local_path = Path(dst_dir) / f'{safe_device}_{ts}_{Path(source).name}'
+            subprocess.run(['adb', '-s', self.device_id, 'pull', source, str(local_path)], check=True,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, timeout=600)
+        return str(local_path)
+
     def get_metadata(self):
-        meta = {}
-        # Версия ADB
-        try:
-            out = subprocess.check_output(['adb', 'version'], stderr=subprocess.STDOUT, text=True)
-            meta['adb_version'] = out.strip().splitlines()[0]
-        except Exception as e:
-            meta['adb_version'] = f'error: {e}'
-        # Uptime устройства
-        try:
-            out = subprocess.check_output(['adb', '-s', self.device_id, 'shell', 'cat', '/proc/uptime'], stderr=subprocess.STDOUT, text=True)
-            meta['uptime'] = out.strip().split()[0]
-        except Exception as e:
-            meta['uptime'] = f'error: {e}'
-        # Свободное место
-        try:
-            out = subprocess.check_output(['adb', '-s', self.device_id, 'shell', 'df', '/data'], stderr=subprocess.STDOUT, text=True)
-            lines = out.strip().splitlines()
-            if len(lines) > 1:
-                meta['free_space'] = lines[1]
-            else:
-                meta['free_space'] = lines[0]
-        except Exception as e:
-            meta['free_space'] = f'error: {e}'
-        return meta
+        return metadata_cache.get(self.device_id, self.cfg)
 
     # Метаданные, расширяемые методы, интеграции и т.д. будут добавлены далее 
\ No newline at end of file
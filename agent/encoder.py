@@ -0,0 +1,81 @@
+import os
+import logging
+from pathlib import Path
+
+try:
+    import cv2
+except ImportError:  # opencv не установлен — отправляем PNG как есть
+    cv2 = None
+
+# формат -> (расширение, content-type)
+FORMATS = {
+    'png': ('.png', 'image/png'),
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'jpg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+}
+
+DEFAULT_PROFILE = {'format': 'png'}
+
+
+def content_type_for(path):
+    suffix = Path(path).suffix.lower()
+    for ext, content_type in FORMATS.values():
+        if ext == suffix:
+            return content_type
+    return 'image/png'
+
+
+def get_profile(cfg, section):
+    """Профиль кодирования для секции: encoding.<section>, иначе encoding.default, иначе PNG без изменений."""
+    profiles = cfg.get('encoding', {}) or {}
+    return profiles.get(section) or profiles.get('default') or DEFAULT_PROFILE
+
+
+def encode_screenshot(src_path, profile):
+    """
+    Перекодировать скриншот по профилю (format, quality, max_dim, scale).
+    Возвращает (путь, content_type). Результат пишется рядом с исходником (last.webp, last.jpg, ...),
+    исходный PNG не трогается. При любой ошибке возвращается исходный PNG.
+    """
+    src = Path(src_path)
+    fmt = str(profile.get('format', 'png')).lower()
+    if fmt not in FORMATS:
+        logging.warning(f'[encoder] Неизвестный формат {fmt}, отправляю PNG')
+        fmt = 'png'
+    max_dim = profile.get('max_dim')
+    scale = float(profile.get('scale', 1.0))
+    if fmt == 'png' and not max_dim and scale >= 1.0:
+        return str(src), 'image/png'
+    if cv2 is None:
+        logging.warning('[encoder] opencv-python не установлен, профили кодирования не применяются')
+        return str(src), 'image/png'
+    img = cv2.imread(str(src), cv2.IMREAD_COLOR)
+    if img is None:
+        logging.error(f'[encoder] Не удалось прочитать {src}')
+        return str(src), 'image/png'
+    h, w = img.shape[:2]
+    factor = min(scale, 1.0)
+    if max_dim and max(h, w) * factor > int(max_dim):
+        factor = int(max_dim) / max(h, w)
+    if factor < 1.0:
+        img = cv2.resize(img, (max(1, int(w * factor)), max(1, int(h * factor))), interpolation=cv2.INTER_AREA)
+    ext, content_type = FORMATS[fmt]
+    quality = int(profile.get('quality', 80))
+    if fmt == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    elif fmt in ('jpeg', 'jpg'):
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    ok, buf = cv2.imencode(ext, img, params)
+    if not ok:
+        logging.error(f'[encoder] Ошибка кодирования {src} в {fmt}')
+        return str(src), 'image/png'
+    dst = src.with_name(f'{src.stem}_enc{ext}')
+    tmp = dst.with_name(dst.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(buf.tobytes())
+    # os.replace, а не перезапись: файл предыдущей отправки может ещё лежать в очереди (hardlink)
+    os.replace(tmp, dst)
+    return str(dst), content_type
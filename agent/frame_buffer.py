@@ -0,0 +1,128 @@
+import os
+import time
+import json
+import shutil
+import logging
+import zipfile
+import threading
+from pathlib import Path
+from collections import deque
+from encoder import encode_screenshot, FORMATS
+
+DEFAULT_PROFILE = {'format': 'webp', 'quality': 60, 'scale': 0.5}
+
+
+class FrameBuffer:
+    """
+    Кольцевой буфер последних кадров по устройствам: для разбора ошибки/бана нужны кадры за секунды
+    до события, а на сервер постоянно отправлять всё не нужно.
+    - индекс (время, секция, хэш кадра) — в памяти, сжатые кадры — на диске (buffer_dir/<устройство>/)
+    - неизменившийся кадр не кодируется заново: запись ссылается на файл предыдущего
+    - ограничения: max_frames на устройство, max_age секунд, max_mb на весь буфер (удаляются самые старые)
+    При старте агента буфер пуст (файлы прошлого запуска удаляются).
+    """
+    def __init__(self, buffer_dir='frames', max_frames=120, max_age=600, max_bytes=200 * 1024 * 1024, profile=None):
+        self.dir = Path(buffer_dir)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_frames = max_frames
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.profile = profile or DEFAULT_PROFILE
+        self.frames = {}
+        self.refs = {}
+        self.sizes = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, device_id, section, src_path, frame_hash, ts=None):
+        """Добавить кадр (исходный файл не изменяется)."""
+        ts = ts or time.time()
+        with self.lock:
+            # повтор кадра ссылается на файл предыдущего: проверка и ссылка под одной блокировкой,
+            # иначе параллельный add может вытеснить (и удалить) этот файл между ними
+            frames = self.frames.setdefault(device_id, deque())
+            if frames and frames[-1]['hash'] == frame_hash:
+                self._append(frames, ts, section, frame_hash, frames[-1]['file'])
+                return
+        # кодирование и запись нового файла — без блокировки
+        file = self._store(device_id, src_path, ts)
+        if file is None:
+            return
+        with self.lock:
+            self._append(self.frames.setdefault(device_id, deque()), ts, section, frame_hash, file)
+
+    def _append(self, frames, ts, section, frame_hash, file):
+        frames.append({'ts': ts, 'section': section, 'hash': frame_hash, 'file': file})
+        self.refs[file] = self.refs.get(file, 0) + 1
+        self._evict(ts)
+
+    def _store(self, device_id, src_path, ts):
+        device_dir = self.dir / device_id.replace(':', '_').replace('/', '_')
+        device_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            encoded, content_type = encode_screenshot(src_path, self.profile)
+            ext = next(ext for ext, ct in FORMATS.values() if ct == content_type)
+            dst = device_dir / f'{int(ts * 1000)}{ext}'
+            if Path(encoded) == Path(src_path):
+                shutil.copyfile(encoded, dst)
+            else:
+                os.replace(encoded, dst)
+        except Exception as e:
+            logging.error(f'[frames] {device_id}: не удалось сохранить кадр: {e}')
+            return None
+        size = dst.stat().st_size
+        with self.lock:
+            self.sizes[str(dst)] = size
+            self.total_bytes += size
+        return str(dst)
+
+    def _release(self, entry):
+        file = entry['file']
+        self.refs[file] -= 1
+        if self.refs[file] > 0:
+            return
+        del self.refs[file]
+        self.total_bytes -= self.sizes.pop(file, 0)
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+    def _evict(self, now):
+        for frames in self.frames.values():
+            while frames and (len(frames) > self.max_frames or now - frames[0]['ts'] > self.max_age):
+                self._release(frames.popleft())
+        while self.total_bytes > self.max_bytes:
+            oldest = min((f for f in self.frames.values() if f), key=lambda f: f[0]['ts'], default=None)
+            if oldest is None:
+                break
+            self._release(oldest.popleft())
+
+    def window(self, device_id, since=None, until=None):
+        """Записи буфера устройства за интервал [since, until] (unix time)."""
+        with self.lock:
+            return [dict(e) for e in self.frames.get(device_id, ())
+                    if (since is None or e['ts'] >= since) and (until is None or e['ts'] <= until)]
+
+    def pack(self, device_id, since=None, until=None):
+        """
+        Упаковать кадры за интервал в один zip (кадры + manifest.json) для одной пакетной отправки.
+        Возвращает (путь к архиву, число кадров) или (None, 0), если кадров нет.
+        """
+        entries = self.window(device_id, since, until)
+        if not entries:
+            return None, 0
+        archive = self.dir / f'{device_id.replace(":", "_").replace("/", "_")}_{int(time.time() * 1000)}.zip'
+        manifest = []
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+            for entry in entries:
+                name = Path(entry['file']).name
+                if name not in zf.namelist():
+                    try:
+                        zf.write(entry['file'], name)
+                    except OSError:
+                        continue
+                manifest.append({'ts': entry['ts'], 'section': entry['section'], 'hash': entry['hash'], 'file': name})
+            zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False))
+        return str(archive), len(manifest)
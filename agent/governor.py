@@ -0,0 +1,88 @@
+import time
+import json
+import logging
+import threading
+
+# Классы приоритета записей очереди (меньше — важнее)
+PRIORITY_COMMAND = 0   # подтверждения и результаты команд
+PRIORITY_ERROR = 1     # сообщения об ошибках
+PRIORITY_EVIDENCE = 2  # доказательные снимки (по командам, пакеты кадров) и прочие сообщения
+PRIORITY_MONITOR = 3   # плановые снимки мониторинга
+
+DEFAULT_MONITOR_SECTIONS = ['default', 'monitor', 'auto']
+
+
+class TokenBucket:
+    """Token bucket: rate байт/сек, ёмкость burst байт. Запись больше ёмкости уходит в долг."""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n, force=False):
+        """Списать n байт. Возвращает 0, если списано, иначе сколько секунд подождать."""
+        with self.lock:
+            self.refill()
+            need = min(n, self.capacity)
+            if force or self.tokens >= need:
+                self.tokens -= n
+                return 0.0
+            return (need - self.tokens) / self.rate
+
+
+class BandwidthGovernor:
+    """
+    Ограничение исходящего трафика одного сервера-получателя:
+    - token bucket rate_kbps/burst_kb; подтверждения команд отправляются без ожидания (но расходуют токены)
+    - очередь отправляется по приоритету: команды > ошибки > доказательные снимки > мониторинг
+    - если очередь при текущей скорости не уйдёт за max_delay секунд — снимки мониторинга прореживаются
+      (по устройству/секции остаётся последний), затем удаляются самые старые из них
+    rate_kbps: 0 — без ограничения скорости (приоритеты всё равно действуют).
+    """
+    def __init__(self, rate_kbps=0, burst_kb=None, max_delay=120, monitor_sections=None):
+        rate = float(rate_kbps or 0) * 1024
+        self.bucket = TokenBucket(rate, float(burst_kb or rate_kbps * 2) * 1024) if rate else None
+        self.max_delay = max_delay
+        self.monitor_sections = set(monitor_sections or DEFAULT_MONITOR_SECTIONS)
+
+    def classify(self, kind, payload):
+        if kind == 'command_result':
+            return PRIORITY_COMMAND
+        if kind == 'message':
+            return PRIORITY_ERROR if payload.get('type') == 'error' else PRIORITY_EVIDENCE
+        if kind == 'screenshot' and payload.get('section', 'default') in self.monitor_sections:
+            return PRIORITY_MONITOR
+        return PRIORITY_EVIDENCE
+
+    @staticmethod
+    def cost(item):
+        return (item.get('size') or 0) + len(json.dumps(item['payload']))
+
+    def wait_time(self, item):
+        """0 — запись можно отправлять (токены списаны), иначе сколько подождать."""
+        if self.bucket is None:
+            return 0.0
+        return self.bucket.take(self.cost(item), force=item.get('priority') == PRIORITY_COMMAND)
+
+    def relieve(self, spool):
+        """Сброс нагрузки: прореживание и удаление снимков мониторинга при переполненной очереди."""
+        if self.bucket is None:
+            return 0
+        limit = self.bucket.rate * self.max_delay
+        if spool.backlog_bytes() <= limit:
+            return 0
+        dropped = len(spool.collapse(PRIORITY_MONITOR))
+        while spool.backlog_bytes() > limit:
+            if spool.drop_oldest(PRIORITY_MONITOR) is None:
+                break
+            dropped += 1
+        if dropped:
+            logging.warning(f'[governor] Канал перегружен, удалено снимков мониторинга: {dropped}')
+        return dropped
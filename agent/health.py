@@ -0,0 +1,167 @@
+import time
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from adb_shards import is_network_device
+
+# Ступени восстановления устройства (по возрастанию радиуса поражения)
+RECONNECT = 'reconnect'          # переподключить только это устройство
+RESTART_SHARD = 'restart_shard'  # перезапустить adb server его шарда
+RESTART_ALL = 'restart_all'      # перезапустить все adb server агента
+STEPS = [RECONNECT, RESTART_SHARD, RESTART_ALL]
+
+
+class DeviceHealth:
+    """Результаты проверок одного устройства."""
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.state = None
+        self.ok = None
+        self.latency_ms = None
+        self.error = None
+        self.failures = 0
+        self.step = 0
+        self.last_action = None
+        self.checked_at = None
+
+    def as_dict(self):
+        return {'state': self.state, 'ok': self.ok, 'latency_ms': self.latency_ms, 'error': self.error,
+                'failures': self.failures, 'last_action': self.last_action, 'checked_at': self.checked_at}
+
+
+class HealthMonitor(threading.Thread):
+    """
+    Проверка здоровья ADB по каждому устройству вместо глобального `adb kill-server`:
+    - проба — `adb -s <id> shell echo ok` через adb server шарда устройства, время ответа сохраняется
+    - состояния offline / пропало (для сетевых устройств) — тоже сбой; unauthorized только фиксируется
+      (нужно подтверждение на устройстве, перезапуск adb не поможет)
+    - после `failures` сбоев подряд — следующая ступень: переподключение устройства, затем перезапуск
+      его шарда, затем всех adb server; перезапуски шарда и глобальный ограничены cooldown
+    """
+    def __init__(self, pool, registry, expected=None, interval=30, timeout=5, failures=2,
+                 shard_cooldown=300, global_cooldown=1800, on_action=None, workers=8):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.registry = registry
+        self.expected = expected or (lambda: [])
+        self.interval = interval
+        self.timeout = timeout
+        self.max_failures = failures
+        self.shard_cooldown = shard_cooldown
+        self.global_cooldown = global_cooldown
+        self.on_action = on_action
+        self.workers = workers
+        self.health = {}
+        self.shard_restarted = {}
+        self.global_restarted = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check_all()
+            except Exception as e:
+                logging.error(f'[health] Ошибка проверки устройств: {e}')
+
+    def latency(self, device_id):
+        entry = self.health.get(device_id)
+        return entry.latency_ms if entry else None
+
+    def status(self):
+        with self.lock:
+            return {device_id: entry.as_dict() for device_id, entry in self.health.items()}
+
+    def devices(self):
+        """Проверяются устройства из реестра и из конфига (пропавшие сетевые устройства — тоже сбой).
+        Без реестра (CLI `status`) устройства из конфига пробуются напрямую."""
+        if self.registry is None:
+            return {device_id: 'device' for device_id in self.expected()}
+        known = self.registry.all()
+        for device_id in self.expected():
+            known.setdefault(device_id, None)
+        return known
+
+    def check_all(self):
+        devices = self.devices()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(lambda item: (item[0], item[1], self.probe(item[0], item[1])), devices.items()))
+        for device_id, state, (ok, latency_ms, error) in results:
+            self.record(device_id, state, ok, latency_ms, error)
+        return self.status()
+
+    def probe(self, device_id, state):
+        """(ok, latency_ms, error); ok=None — проба не выполнялась и сбоем не считается."""
+        if state == 'unauthorized':
+            return None, None, 'unauthorized'
+        if state is None and not is_network_device(device_id):
+            return None, None, 'not connected'
+        if state != 'device':
+            return False, None, state or 'missing'
+        shard = self.pool.shard_for(device_id)
+        started = time.monotonic()
+        try:
+            result = shard.run('-s', device_id, 'shell', 'echo', 'ok', timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return False, None, f'timeout {self.timeout}s'
+        except Exception as e:
+            return False, None, str(e)
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+        if result.returncode != 0 or result.stdout.strip() != 'ok':
+            return False, latency_ms, (result.stderr or result.stdout).strip()
+        return True, latency_ms, None
+
+    def record(self, device_id, state, ok, latency_ms, error):
+        with self.lock:
+            entry = self.health.setdefault(device_id, DeviceHealth(device_id))
+            entry.state = state
+            entry.ok = ok
+            entry.latency_ms = latency_ms
+            entry.error = error
+            entry.checked_at = time.time()
+            if ok is None:
+                return
+            if ok:
+                if entry.step:
+                    logging.info(f'[health] {device_id}: восстановлено ({entry.last_action}), {latency_ms} мс')
+                entry.failures = 0
+                entry.step = 0
+                return
+            entry.failures += 1
+            if entry.failures < self.max_failures:
+                return
+            entry.failures = 0
+            step = STEPS[min(entry.step, len(STEPS) - 1)]
+            entry.step += 1
+        self.escalate(entry, step)
+
+    def escalate(self, entry, step):
+        device_id = entry.device_id
+        shard = self.pool.shard_for(device_id)
+        now = time.monotonic()
+        if step == RESTART_ALL and self.global_restarted is not None and now - self.global_restarted < self.global_cooldown:
+            step = RESTART_SHARD
+        last_shard_restart = self.shard_restarted.get(shard.port)
+        if step == RESTART_SHARD and last_shard_restart is not None and now - last_shard_restart < self.shard_cooldown:
+            step = RECONNECT
+        logging.warning(f'[health] {device_id}: {entry.error}, восстановление: {step} (adb:{shard.port})')
+        entry.last_action = step
+        try:
+            if step == RECONNECT:
+                shard.reconnect(device_id)
+            elif step == RESTART_SHARD:
+                self.shard_restarted[shard.port] = now
+                shard.restart()
+            else:
+                self.global_restarted = now
+                for port in self.pool.shards:
+                    self.shard_restarted[port] = now
+                self.pool.restart_all()
+        except Exception as e:
+            logging.error(f'[health] {device_id}: ошибка восстановления {step}: {e}')
+        if self.on_action is not None:
+            self.on_action(device_id, step, entry.error)
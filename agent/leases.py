@@ -0,0 +1,82 @@
+import time
+import logging
+import threading
+import requests
+
+# Запас до окончания аренды: агент прекращает съёмку раньше, чем сервер отдаст устройство другому агенту
+SAFETY_MARGIN = 5.0
+
+
+class LeaseClient(threading.Thread):
+    """
+    Аренда устройств у сервера (/api/agents/heartbeat): агент сообщает ёмкость и видимые устройства
+    и снимает только устройства, аренда которых действует. Срок аренды считается по monotonic-часам
+    агента от ответа сервера (expires_in), поэтому расхождение часов хостов не важно.
+    Если сервер недоступен, агент снимает устройства до последнего подтверждённого сервером срока
+    (keep_on_offline) и не продлевает аренды сам: при разрыве сети сервер уже мог отдать устройство
+    другому агенту. Без keep_on_offline аренды снимаются при первой неудачной попытке.
+    """
+    def __init__(self, target, agent_id, candidates, capacity=50, interval=20, keep_on_offline=True, server_id='', host=''):
+        super().__init__(daemon=True)
+        self.target = target
+        self.agent_id = agent_id
+        self.server_id = server_id
+        self.host = host
+        self.candidates = candidates
+        self.capacity = capacity
+        self.interval = interval
+        self.keep_on_offline = keep_on_offline
+        self.leases = {}
+        self.draining = set()
+        self.online = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def holds(self, device_id):
+        with self.lock:
+            expires = self.leases.get(device_id)
+        return expires is not None and time.monotonic() < expires
+
+    def held(self):
+        now = time.monotonic()
+        with self.lock:
+            return sorted(d for d, expires in self.leases.items() if now < expires)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.heartbeat()
+            self.stopped.wait(self.interval)
+
+    def heartbeat(self):
+        body = {'agent_id': self.agent_id, 'server_id': self.server_id, 'host': self.host,
+                'capacity': self.capacity, 'devices': sorted(set(self.candidates()))}
+        sent_at = time.monotonic()
+        try:
+            resp = requests.post(self.target.url + '/api/agents/heartbeat', headers=self.target.headers, json=body, timeout=10)
+            resp.raise_for_status()
+            data = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            if self.online:
+                logging.warning(f'[leases] Сервер аренды недоступен: {e}')
+            self.online = False
+            if not self.keep_on_offline:
+                self.apply([], sent_at)
+            return
+        self.online = True
+        self.apply(data.get('leases', []), sent_at)
+
+    def apply(self, leases, sent_at):
+        """Заменить аренды ответом сервера; сроки — от момента отправки запроса (с запасом)."""
+        granted = {l['device_id']: sent_at + l['expires_in'] - SAFETY_MARGIN for l in leases}
+        with self.lock:
+            gained = set(granted) - set(self.leases)
+            lost = set(self.leases) - set(granted)
+            self.leases = granted
+            self.draining = {l['device_id'] for l in leases if l.get('draining')}
+        for device_id in sorted(gained):
+            logging.info(f'[leases] Получена аренда: {device_id}')
+        for device_id in sorted(lost):
+            logging.info(f'[leases] Аренда снята: {device_id}')
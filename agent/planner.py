@@ -0,0 +1,94 @@
+import time
+import random
+import hashlib
+import logging
+import threading
+import requests
+
+
+def local_offset(device_id, interval):
+    """Фаза без плана сервера: стабильная по id устройства, чтобы агенты не снимали все разом."""
+    return int(hashlib.md5(device_id.encode()).hexdigest(), 16) % 10000 / 10000 * interval
+
+
+class CapturePlan(threading.Thread):
+    """
+    План съёмки от сервера (/api/schedule/plan): для каждого устройства фаза (offset от начала эпохи unix),
+    джиттер и интервал (сервер растягивает его, если не успевает принимать загрузки). Съёмка устройства
+    выполняется в моменты offset + k * interval (+ случайный джиттер), поэтому загрузки всего парка
+    распределены по интервалу равномерно, а не приходят волной после старта агентов.
+    Время сервера пересчитывается в локальное по server_time ответа (поправка часов).
+    Пока плана нет (сервер недоступен) — фаза считается локально по id устройства.
+    """
+    def __init__(self, target, agent_id, devices, refresh=300, server_id='', host=''):
+        super().__init__(daemon=True)
+        self.target = target
+        self.agent_id = agent_id
+        self.server_id = server_id
+        self.host = host
+        self.devices = devices
+        self.refresh = refresh
+        self.plan = {}
+        self.clock_offset = 0.0
+        self.ingest = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def poke(self):
+        """Запросить план досрочно (новое устройство); серия вызовов даёт один запрос."""
+        self.wakeup.set()
+
+    def has(self, device_id):
+        with self.lock:
+            return device_id in self.plan
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.update()
+            self.wakeup.wait(self.refresh)
+            self.wakeup.clear()
+            self.stopped.wait(2)
+
+    def update(self):
+        """devices() — {device_id: интервал из конфига}."""
+        body = {'agent_id': self.agent_id, 'server_id': self.server_id, 'host': self.host,
+                'devices': [{'device_id': d, 'interval': i} for d, i in sorted(self.devices().items())]}
+        sent_at = time.time()
+        try:
+            resp = requests.post(self.target.url + '/api/schedule/plan', headers=self.target.headers, json=body, timeout=10)
+            resp.raise_for_status()
+            data = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f'[planner] План съёмки недоступен: {e}')
+            return False
+        received_at = time.time()
+        with self.lock:
+            self.plan = data.get('devices', {})
+            self.clock_offset = data.get('server_time', received_at) - (sent_at + received_at) / 2
+            self.ingest = data.get('ingest', {})
+            self.version += 1
+        if self.ingest.get('stretch', 1) > 1:
+            logging.warning(f'[planner] Сервер не успевает принимать загрузки, интервалы увеличены в {self.ingest["stretch"]} раз')
+        return True
+
+    def slot(self, device_id, interval):
+        """(offset, interval, jitter) устройства; интервал из конфига — если плана для устройства нет."""
+        with self.lock:
+            p = self.plan.get(device_id)
+        if p:
+            return p['offset'], p['interval'], p['jitter']
+        return local_offset(device_id, interval), interval, 0.0
+
+    def next_due(self, device_id, interval, now=None):
+        """Следующий момент съёмки (локальное unix time) строго позже now."""
+        now = time.time() if now is None else now
+        offset, interval, jitter = self.slot(device_id, interval)
+        server_now = now + self.clock_offset
+        k = (server_now - offset) // interval + 1
+        return offset + k * interval - self.clock_offset + random.uniform(0, jitter)
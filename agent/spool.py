@@ -0,0 +1,275 @@
+import os
+import time
+import json
+import random
+import shutil
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+# Результаты попытки доставки (возвращает функция send у SpoolDrainer)
+SEND_OK = 'ok'            # доставлено — удалить из очереди
+SEND_RETRY = 'retry'      # ошибка сервера (5xx) — повторить позже, попытка засчитывается
+SEND_OFFLINE = 'offline'  # сервер недоступен или перегружен (503) — ждать с backoff или Retry-After
+                          # (send кладёт его в item['retry_after']), попытка не засчитывается
+SEND_DROP = 'drop'        # сервер отверг запрос (4xx) — повторять бессмысленно
+
+ITEM_COLUMNS = 'id, kind, payload, file, attempts, size, priority'
+
+
+class Spool:
+    """
+    Персистентная очередь исходящих отправок агента (скриншоты, сообщения, подтверждения команд).
+    Записи хранятся в SQLite (spool.db), файлы — в подпапке files/. Записи отдаются по приоритету
+    (меньше — раньше), внутри приоритета — по порядку. Очередь ограничена по количеству записей и
+    суммарному размеру файлов: при переполнении удаляются самые старые записи низшего приоритета.
+    on_drop(item) — вызывается для каждой записи, удалённой очередью без отправки (переполнение,
+    сброс нагрузки), чтобы владелец записи узнал, что она не будет доставлена.
+    """
+    def __init__(self, spool_dir='spool', max_items=10000, max_bytes=1024 * 1024 * 1024, on_drop=None):
+        self.dir = Path(spool_dir)
+        self.on_drop = on_drop
+        self.files_dir = self.dir / 'files'
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.conn = sqlite3.connect(str(self.dir / 'spool.db'), check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            payload TEXT,
+            file TEXT,
+            size INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            created_at REAL
+        )''')
+        # Миграция очереди прошлых версий: приоритет записи
+        columns = [r[1] for r in self.conn.execute('PRAGMA table_info(items)')]
+        if 'priority' not in columns:
+            self.conn.execute('ALTER TABLE items ADD COLUMN priority INTEGER DEFAULT 0')
+        self.conn.commit()
+
+    def put(self, kind, payload, file_path=None, priority=0, on_queued=None):
+        """
+        Поставить отправку в очередь. Файл (если есть) связывается/копируется в папку очереди.
+        on_queued(item_id) вызывается до того, как запись увидит поток отправки (и до её возможного удаления).
+        """
+        stored = None
+        size = 0
+        if file_path:
+            src = Path(file_path)
+            stored = self.files_dir / f'{time.time_ns()}_{src.name}'
+            try:
+                os.link(src, stored)
+            except OSError:
+                shutil.copyfile(src, stored)
+            size = stored.stat().st_size
+        with self.lock:
+            cur = self.conn.execute(
+                'INSERT INTO items (kind, payload, file, size, created_at, priority) VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, json.dumps(payload, ensure_ascii=False), str(stored) if stored else None, size, time.time(), priority))
+            self.conn.commit()
+            item_id = cur.lastrowid
+            if on_queued is not None:
+                on_queued(item_id)
+            dropped = self._enforce_limits()
+        self._notify_dropped(dropped)
+        self.event.set()
+        return item_id
+
+    def _enforce_limits(self):
+        """Удалить самые старые записи низшего приоритета сверх лимитов; возвращает удалённые записи."""
+        count, total = self.conn.execute('SELECT count(*), coalesce(sum(size), 0) FROM items').fetchone()
+        dropped = []
+        while count > self.max_items or total > self.max_bytes:
+            row = self.conn.execute(f'SELECT {ITEM_COLUMNS} FROM items ORDER BY priority DESC, id LIMIT 1').fetchone()
+            if not row:
+                break
+            item = self._item(row)
+            self._delete(item['id'], item['file'])
+            count -= 1
+            total -= item['size'] or 0
+            dropped.append(item)
+        if dropped:
+            self.conn.commit()
+            logging.warning(f'[spool] Очередь переполнена, удалено старых записей: {len(dropped)}')
+        return dropped
+
+    def _notify_dropped(self, items):
+        """Сообщить владельцу об удалённых записях (вне self.lock: обработчик может обращаться к очереди)."""
+        if self.on_drop is None:
+            return
+        for item in items:
+            try:
+                self.on_drop(item)
+            except Exception as e:
+                logging.error(f'[spool] Ошибка обработчика удаления #{item["id"]}: {e}')
+
+    @staticmethod
+    def _item(row):
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'file': row[3], 'attempts': row[4],
+                'size': row[5], 'priority': row[6]}
+
+    def _delete(self, item_id, file):
+        self.conn.execute('DELETE FROM items WHERE id=?', (item_id,))
+        if file:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+    def head(self):
+        """Самая старая запись высшего приоритета или None."""
+        with self.lock:
+            row = self.conn.execute(f'SELECT {ITEM_COLUMNS} FROM items ORDER BY priority, id LIMIT 1').fetchone()
+        return self._item(row) if row else None
+
+    def backlog_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT coalesce(sum(size), 0) FROM items').fetchone()[0]
+
+    def collapse(self, priority):
+        """Оставить только последний снимок каждого устройства/секции среди записей приоритета priority;
+        возвращает удалённые записи."""
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {ITEM_COLUMNS} FROM items WHERE priority=? ORDER BY id DESC', (priority,)).fetchall()
+            seen = set()
+            dropped = []
+            for row in rows:
+                item = self._item(row)
+                key = (item['payload'].get('device_id'), item['payload'].get('section'))
+                if key in seen:
+                    self._delete(item['id'], item['file'])
+                    dropped.append(item)
+                seen.add(key)
+            if dropped:
+                self.conn.commit()
+        self._notify_dropped(dropped)
+        return dropped
+
+    def drop_oldest(self, priority):
+        """Удалить самую старую запись приоритета priority и вернуть её. None — таких записей нет."""
+        with self.lock:
+            row = self.conn.execute(f'SELECT {ITEM_COLUMNS} FROM items WHERE priority=? ORDER BY id LIMIT 1', (priority,)).fetchone()
+            if not row:
+                return None
+            item = self._item(row)
+            self._delete(item['id'], item['file'])
+            self.conn.commit()
+        self._notify_dropped([item])
+        return item
+
+    def done(self, item):
+        with self.lock:
+            self._delete(item['id'], item['file'])
+            self.conn.commit()
+
+    def failed(self, item):
+        with self.lock:
+            self.conn.execute('UPDATE items SET attempts=attempts+1 WHERE id=?', (item['id'],))
+            self.conn.commit()
+        item['attempts'] += 1
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT count(*) FROM items').fetchone()[0]
+
+
+class SpoolDrainer(threading.Thread):
+    """
+    Фоновый поток, который отправляет записи очереди по порядку.
+    - rate_per_sec — не больше N отправок в секунду (чтобы не завалить сервер после восстановления связи)
+    - при недоступности сервера — экспоненциальный backoff с джиттером до backoff_max секунд
+    - запись, которая max_attempts раз получила ошибку сервера, удаляется
+    - on_done(item, delivered) — вызывается, когда запись покидает очередь (доставлена или удалена,
+      в том числе самой очередью при переполнении и сбросе нагрузки)
+    - governor — ограничение трафика (BandwidthGovernor): ожидание токенов и сброс нагрузки
+    """
+    def __init__(self, spool, send, rate_per_sec=5.0, backoff_min=1.0, backoff_max=300.0, max_attempts=20, on_done=None,
+                 governor=None):
+        super().__init__(daemon=True)
+        self.spool = spool
+        self.send = send
+        self.on_done = on_done
+        self.governor = governor
+        self.min_interval = 1.0 / rate_per_sec if rate_per_sec else 0.0
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.max_attempts = max_attempts
+        self.online = True
+        self.failures = 0
+        self.stopped = threading.Event()
+        if spool.on_drop is None:
+            spool.on_drop = lambda item: self.notify(item, False)
+
+    def stop(self):
+        self.stopped.set()
+        self.spool.event.set()
+
+    def backoff(self):
+        delay = min(self.backoff_max, self.backoff_min * (2 ** min(self.failures, 16)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def notify(self, item, delivered):
+        if self.on_done is None:
+            return
+        try:
+            self.on_done(item, delivered)
+        except Exception as e:
+            logging.error(f'[spool] Ошибка обработчика доставки #{item["id"]}: {e}')
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.spool.event.clear()
+            if self.governor is not None:
+                self.governor.relieve(self.spool)
+            item = self.spool.head()
+            if item is None:
+                self.spool.event.wait(5)
+                continue
+            if self.governor is not None:
+                delay = self.governor.wait_time(item)
+                if delay:
+                    # ждём токены короткими шагами: за это время может прийти запись важнее
+                    self.spool.event.wait(min(delay, 0.5))
+                    continue
+            started = time.monotonic()
+            try:
+                result = self.send(item)
+            except Exception as e:
+                logging.error(f'[spool] Ошибка отправки #{item["id"]} ({item["kind"]}): {e}')
+                result = SEND_RETRY
+            if result == SEND_OK:
+                self.spool.done(item)
+                self.notify(item, True)
+                if not self.online:
+                    logging.info(f'[spool] Сервер снова доступен, в очереди: {len(self.spool)}')
+                self.online = True
+                self.failures = 0
+            elif result == SEND_DROP:
+                logging.error(f'[spool] Сервер отверг запись #{item["id"]} ({item["kind"]}), удаляю')
+                self.spool.done(item)
+                self.notify(item, False)
+            else:
+                if result == SEND_RETRY:
+                    self.spool.failed(item)
+                    if item['attempts'] >= self.max_attempts:
+                        logging.error(f'[spool] Запись #{item["id"]} не доставлена за {item["attempts"]} попыток, удаляю')
+                        self.spool.done(item)
+                        self.notify(item, False)
+                else:
+                    if self.online:
+                        logging.warning(f'[spool] Сервер недоступен, отправки копятся в очереди ({len(self.spool)})')
+                    self.online = False
+                self.failures += 1
+                delay = item.get('retry_after')
+                # Retry-After: 0 (или отрицательный) не должен превращать ожидание в цикл без паузы
+                self.stopped.wait(min(max(delay, self.backoff_min), self.backoff_max) if delay is not None else self.backoff())
+                continue
+            elapsed = time.monotonic() - started
+            if elapsed < self.min_interval:
+                self.stopped.wait(self.min_interval - elapsed)
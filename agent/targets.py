@@ -0,0 +1,156 @@
+import time
+import logging
+import requests
+from pathlib import Path
+from email.utils import parsedate_to_datetime
+from encoder import content_type_for
+from spool import Spool, SpoolDrainer, SEND_OK, SEND_RETRY, SEND_OFFLINE, SEND_DROP
+from governor import BandwidthGovernor
+from chunked import ChunkedUploader
+
+
+class ServerTarget:
+    """
+    Центральный сервер-получатель. У каждого сервера свои учётные данные, своя очередь отправок
+    (spool) и свой поток отправки с собственным лимитом скорости: медленный или недоступный сервер
+    не задерживает остальные. Файл скриншота кодируется один раз и связывается (hardlink) в очередь
+    каждого сервера.
+    """
+    def __init__(self, name, url, api_key, server_id, spool_dir, spool_cfg=None, commands=False, on_done=None,
+                 bandwidth_cfg=None, chunk_kb=1024):
+        sp_cfg = spool_cfg or {}
+        bw_cfg = bandwidth_cfg or {}
+        self.name = name
+        self.url = url.rstrip('/')
+        self.api_key = api_key
+        self.server_id = server_id
+        self.commands = commands
+        self.spool = Spool(
+            spool_dir,
+            max_items=sp_cfg.get('max_items', 10000),
+            max_bytes=int(sp_cfg.get('max_mb', 1024)) * 1024 * 1024
+        )
+        self.governor = BandwidthGovernor(
+            rate_kbps=bw_cfg.get('rate_kbps', 0),
+            burst_kb=bw_cfg.get('burst_kb'),
+            max_delay=bw_cfg.get('max_delay', 120),
+            monitor_sections=bw_cfg.get('monitor_sections')
+        )
+        self.uploader = ChunkedUploader(self.url, self.headers, chunk_size=int(chunk_kb) * 1024)
+        self.drainer = SpoolDrainer(
+            self.spool, self.deliver,
+            rate_per_sec=sp_cfg.get('rate_per_sec', 5),
+            backoff_min=sp_cfg.get('backoff_min', 1),
+            backoff_max=sp_cfg.get('backoff_max', 300),
+            max_attempts=sp_cfg.get('max_attempts', 20),
+            on_done=(lambda item, delivered: on_done(self, item, delivered)) if on_done else None,
+            governor=self.governor
+        )
+
+    @property
+    def headers(self):
+        return {'Authorization': f'Bearer {self.api_key}'}
+
+    @property
+    def online(self):
+        return self.drainer.online
+
+    def start(self):
+        self.drainer.start()
+        if len(self.spool):
+            logging.info(f'[{self.name}] В очереди с прошлого запуска: {len(self.spool)}')
+
+    def stop(self):
+        self.drainer.stop()
+
+    def put(self, kind, payload, file_path=None, on_queued=None):
+        """Поставить запись в очередь сервера, возвращает id записи (on_queued(item_id) — см. Spool.put)."""
+        if 'server_id' in payload:
+            payload = dict(payload, server_id=self.server_id)
+        return self.spool.put(kind, payload, file_path, priority=self.governor.classify(kind, payload), on_queued=on_queued)
+
+    def deliver(self, item):
+        """Реальная отправка записи очереди на сервер (вызывается только из SpoolDrainer)."""
+        payload = item['payload']
+        try:
+            if item['kind'] == 'screenshot':
+                with open(item['file'], 'rb') as f:
+                    files = {'image': (Path(item['file']).name, f, content_type_for(item['file']))}
+                    resp = requests.post(self.url + '/upload_screenshot', headers=self.headers, data=payload, files=files, timeout=30)
+            elif item['kind'] == 'frames':
+                with open(item['file'], 'rb') as f:
+                    files = {'archive': (Path(item['file']).name, f, 'application/zip')}
+                    resp = requests.post(self.url + '/api/upload_frames', headers=self.headers, data=payload, files=files, timeout=120)
+            elif item['kind'] == 'artifact':
+                resp = self.uploader.upload(item['file'], payload)
+            elif item['kind'] == 'message':
+                resp = requests.post(self.url + '/api/send_message', headers=self.headers, json=payload, timeout=15)
+            elif item['kind'] == 'telemetry':
+                resp = requests.post(self.url + '/api/telemetry', headers=self.headers, json=payload, timeout=15)
+            elif item['kind'] == 'command_result':
+                resp = requests.post(self.url + '/api/command_result', headers=self.headers, json=payload, timeout=10)
+            else:
+                logging.error(f'[{self.name}] Неизвестный тип записи: {item["kind"]}')
+                return SEND_DROP
+        except FileNotFoundError:
+            logging.error(f'[{self.name}] Файл записи #{item["id"]} не найден: {item["file"]}')
+            return SEND_DROP
+        except requests.RequestException as e:
+            logging.debug(f'[{self.name}] Ошибка HTTP: {e}')
+            return SEND_OFFLINE
+        if resp.ok:
+            logging.info(f'[{self.name}] Отправлено: {item["kind"]} #{item["id"]}')
+            return SEND_OK
+        delay = retry_after(resp)
+        if resp.status_code == 503 or delay is not None:
+            # сервер перегружен (очередь приёма полна) — ждать, как при недоступности, попытку не засчитывать
+            logging.warning(f'[{self.name}] Сервер занят ({resp.status_code}), повтор через {delay if delay is not None else "backoff"} с')
+            item['retry_after'] = delay
+            return SEND_OFFLINE
+        if 400 <= resp.status_code < 500 and resp.status_code not in (408, 429):
+            logging.error(f'[{self.name}] Ошибка отправки {item["kind"]}: {resp.status_code} {resp.text}')
+            return SEND_DROP
+        return SEND_RETRY
+
+
+def retry_after(resp):
+    """Retry-After ответа в секундах (число или HTTP-дата) или None."""
+    value = (getattr(resp, 'headers', None) or {}).get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def load_targets(cfg, on_done=None):
+    """
+    Серверы из config_agent.yaml. Без секции servers — один сервер из server_url/api_key/server_id
+    (очередь в spool.dir, как раньше). В секции servers у каждого сервера: name, url, api_key,
+    необязательные server_id, spool и bandwidth (переопределение общих секций); команды принимаются от сервера
+    с commands: true (по умолчанию — от первого). on_done(target, item, delivered) — итог доставки записи.
+    """
+    sp_cfg = cfg.get('spool', {}) or {}
+    bw_cfg = cfg.get('bandwidth', {}) or {}
+    chunk_kb = (cfg.get('artifacts', {}) or {}).get('chunk_kb', 1024)
+    spool_dir = Path(sp_cfg.get('dir', 'spool'))
+    servers = cfg.get('servers')
+    if not servers:
+        return [ServerTarget('main', cfg['server_url'], cfg['api_key'], cfg['server_id'], spool_dir, sp_cfg, commands=True, on_done=on_done,
+                             bandwidth_cfg=bw_cfg, chunk_kb=chunk_kb)]
+    command_name = next((s['name'] for s in servers if s.get('commands')), servers[0]['name'])
+    targets = []
+    for server in servers:
+        target_spool = dict(sp_cfg, **(server.get('spool') or {}))
+        target_bandwidth = dict(bw_cfg, **(server.get('bandwidth') or {}))
+        targets.append(ServerTarget(
+            server['name'], server['url'], server['api_key'], server.get('server_id', cfg.get('server_id')),
+            spool_dir / server['name'], target_spool, commands=server['name'] == command_name, on_done=on_done,
+            bandwidth_cfg=target_bandwidth, chunk_kb=chunk_kb
+        ))
+    return targets
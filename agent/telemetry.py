@@ -0,0 +1,65 @@
+import time
+import uuid
+import logging
+import threading
+
+
+def parse_metrics(meta):
+    """
+    Числовые метрики из метаданных устройства (значения с ошибками пропускаются):
+    uptime_s — аптайм, free_space_kb — свободно на /data (колонка Available из df), battery_pct — заряд.
+    """
+    metrics = {}
+    try:
+        metrics['uptime_s'] = float(meta.get('uptime'))
+    except (TypeError, ValueError):
+        pass
+    columns = str(meta.get('free_space', '')).split()
+    if len(columns) >= 4 and columns[3].isdigit():
+        metrics['free_space_kb'] = float(columns[3])
+    try:
+        metrics['battery_pct'] = float(meta.get('battery'))
+    except (TypeError, ValueError):
+        pass
+    return metrics
+
+
+class TelemetryBatcher(threading.Thread):
+    """
+    Накопитель числовых метрик устройств: сэмплы (device_id, metric, value, ts) отправляются пачкой
+    раз в flush_interval секунд или при накоплении max_samples. send(samples, batch_id) ставит пачку в очередь отправки;
+    batch_id — уникальный id пачки: повтор отправки (таймаут после записи на сервере) не учитывается в агрегатах дважды.
+    """
+    def __init__(self, send, flush_interval=60, max_samples=1000):
+        super().__init__(daemon=True)
+        self.send = send
+        self.flush_interval = flush_interval
+        self.max_samples = max_samples
+        self.samples = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def add(self, device_id, metric, value, ts=None):
+        with self.lock:
+            self.samples.append({'device_id': device_id, 'metric': metric, 'value': float(value), 'ts': ts or time.time()})
+            full = len(self.samples) >= self.max_samples
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            samples, self.samples = self.samples, []
+        if not samples:
+            return
+        try:
+            self.send(samples, uuid.uuid4().hex)
+        except Exception as e:
+            logging.error(f'[telemetry] Ошибка отправки телеметрии: {e}')
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
@@ -0,0 +1,59 @@
+import unittest
+import sys
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from adb_shards import AdbShardPool, shard_port
+from device_registry import ShardedRegistry
+
+
+class TestAdbShards(unittest.TestCase):
+    def test_stable_assignment(self):
+        devices = [f'127.0.0.1:{5555 + 2 * i}' for i in range(200)]
+        ports = [5037, 5038, 5039]
+        first = {d: shard_port(d, ports) for d in devices}
+        self.assertEqual(first, {d: shard_port(d, list(reversed(ports))) for d in devices})
+        # нагрузка распределена по всем шардам
+        self.assertEqual(set(first.values()), set(ports))
+        # добавление шарда переносит только устройства на новый шард
+        moved = {d: shard_port(d, ports + [5040]) for d in devices}
+        for d in devices:
+            self.assertIn(moved[d], (first[d], 5040))
+
+    def test_env_and_assign(self):
+        pool = AdbShardPool([5037, 5038])
+        pool.assign(['127.0.0.1:5555', 'emulator-5554'])
+        shard = pool.shard_for('127.0.0.1:5555')
+        self.assertEqual(pool.env_for('127.0.0.1:5555')['ANDROID_ADB_SERVER_PORT'], str(shard.port))
+        self.assertEqual(shard.network_devices, {'127.0.0.1:5555'})
+        self.assertEqual(sum(len(s.network_devices) for s in pool.shards.values()), 1)
+
+    def test_registry_sees_only_own_devices(self):
+        pool = AdbShardPool([5037, 5038])
+        migrated = []
+        pool.migrate = lambda serial, port: migrated.append((serial, port))
+        registry = ShardedRegistry(pool)
+        serials = ['emulator-5554', '127.0.0.1:5555', '127.0.0.1:5557', '127.0.0.1:5559']
+        # каждый adb server видит все устройства (например, эмуляторы регистрируются во всех)
+        for port, reg in registry.registries.items():
+            reg.update({s: 'device' for s in serials})
+        self.assertEqual(sorted(registry.online()), sorted(serials))
+        for port, reg in registry.registries.items():
+            self.assertTrue(all(pool.owns(port, s) for s in reg.online()))
+        for serial in serials:
+            self.assertTrue(registry.is_online(serial))
+    def test_local_device_pinned_to_seeing_shard(self):
+        pool = AdbShardPool([5037, 5038])
+        registry = ShardedRegistry(pool)
+        owner = pool.shard_for('emulator-5554').port
+        other = next(port for port in pool.shards if port != owner)
+        # эмулятор зарегистрирован только в чужом adb server: закрепляется за ним, а не теряется
+        registry.registries[other].update({'emulator-5554': 'device'})
+        self.assertTrue(registry.is_online('emulator-5554'))
+        self.assertEqual(pool.env_for('emulator-5554')['ANDROID_ADB_SERVER_PORT'], str(other))
+        registry.registries[owner].update({'emulator-5554': 'device'})
+        self.assertEqual(registry.online(), ['emulator-5554'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import sys
+import json
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from channel import AgentChannel
+
+
+class FakeWebSocket:
+    def __init__(self, channel, messages):
+        self.channel = channel
+        self.messages = list(messages)
+        self.sent = []
+
+    def recv(self, timeout=None):
+        if not self.messages:
+            self.channel.stopped.set()
+            raise TimeoutError
+        return json.dumps(self.messages.pop(0))
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+
+class TestAgentChannel(unittest.TestCase):
+    def test_ack_only_accepted_commands(self):
+        # агент без аренды устройства команду не подтверждает — она остаётся pending для арендатора
+        channel = AgentChannel('http://server:8000', 'key', 'server-01', lambda cmd: cmd['device_id'] == 'leased')
+        ws = channel.ws = FakeWebSocket(channel, [
+            {'type': 'command', 'command': {'id': 1, 'device_id': 'other'}},
+            {'type': 'command', 'command': {'id': 2, 'device_id': 'leased'}},
+        ])
+        channel.listen(ws)
+        self.assertEqual([m for m in ws.sent if m['type'] == 'ack'], [{'type': 'ack', 'command_id': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import sys
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+from unittest import mock
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+import chunked
+from chunked import ChunkedUploader, file_sha256, make_upload_id
+
+
+class FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+        self.ok = status_code < 400
+        self.text = str(data)
+
+    def json(self):
+        return self.data
+
+
+class FakeServer:
+    """Сервер артефактов в памяти; fail_after — сколько частей принять до обрыва связи."""
+    def __init__(self, fail_after=None):
+        self.data = b''
+        self.fail_after = fail_after
+        self.offsets = []
+
+    def request(self, method, url, headers=None, timeout=None, json=None, params=None, data=None):
+        if url.endswith('/init'):
+            self.meta = json
+            return FakeResponse(200, {'offset': len(self.data)})
+        if url.endswith('/chunk'):
+            if self.fail_after is not None and len(self.offsets) >= self.fail_after:
+                raise chunked.requests.ConnectionError('link down')
+            self.offsets.append(params['offset'])
+            assert headers['X-Chunk-Sha256'] == hashlib.sha256(data).hexdigest()
+            if params['offset'] != len(self.data):
+                return FakeResponse(409, {'offset': len(self.data)})
+            self.data += data
+            return FakeResponse(200, {'offset': len(self.data)})
+        ok = hashlib.sha256(self.data).hexdigest() == self.meta['sha256']
+        return FakeResponse(200 if ok else 409, {'status': 'ok'})
+
+
+class TestChunkedUploader(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, os.urandom(10 * 1024 + 100))
+        os.close(fd)
+        sha256 = file_sha256(self.path)
+        self.meta = {'upload_id': make_upload_id('dev1', 5, sha256), 'device_id': 'dev1', 'filename': 'x.bin', 'sha256': sha256}
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_resume_after_disconnect(self):
+        server = FakeServer(fail_after=4)
+        uploader = ChunkedUploader('http://server', {}, chunk_size=1024, retries=0)
+        with mock.patch.object(chunked.requests, 'request', side_effect=server.request):
+            with self.assertRaises(chunked.requests.RequestException):
+                uploader.upload(self.path, self.meta)
+            self.assertEqual(len(server.data), 4 * 1024)
+            server.fail_after = None
+            resp = uploader.upload(self.path, self.meta)
+        self.assertTrue(resp.ok)
+        # вторая попытка начинается с подтверждённого смещения, а не с нуля
+        self.assertEqual(server.offsets[4], 4 * 1024)
+        self.assertEqual(server.data, Path(self.path).read_bytes())
+
+    def test_retry_keeps_chunk_checksum(self):
+        server = FakeServer()
+        failures = []
+        real = server.request
+
+        def flaky(method, url, **kwargs):
+            # первая попытка каждой части обрывается, повтор должен уйти с тем же X-Chunk-Sha256
+            if url.endswith('/chunk') and kwargs['params']['offset'] not in failures:
+                failures.append(kwargs['params']['offset'])
+                raise chunked.requests.ConnectionError('link flap')
+            return real(method, url, **kwargs)
+
+        uploader = ChunkedUploader('http://server', {'Authorization': 'Bearer k'}, chunk_size=1024, retries=2)
+        with mock.patch.object(chunked.requests, 'request', side_effect=flaky), mock.patch.object(chunked.time, 'sleep'):
+            resp = uploader.upload(self.path, self.meta)
+        self.assertTrue(resp.ok)
+        self.assertEqual(len(failures), 11)
+        self.assertEqual(server.data, Path(self.path).read_bytes())
+
+    def test_restart_after_checksum_mismatch(self):
+        server = FakeServer()
+        corrupted = []
+        real = server.request
+
+        def corrupting(method, url, **kwargs):
+            resp = real(method, url, **kwargs)
+            # сервер один раз испортил принятый файл: complete отвечает 409 и сбрасывает смещение в 0
+            if url.endswith('/chunk') and not corrupted and len(server.data) == 2048:
+                corrupted.append(True)
+                server.data = b'x' * 2048
+            if url.endswith('/complete') and resp.status_code == 409:
+                server.data = b''
+                return FakeResponse(409, {'error': 'checksum mismatch', 'offset': 0})
+            return resp
+
+        uploader = ChunkedUploader('http://server', {}, chunk_size=1024, retries=0)
+        with mock.patch.object(chunked.requests, 'request', side_effect=corrupting):
+            resp = uploader.upload(self.path, self.meta)
+        self.assertTrue(resp.ok)
+        self.assertEqual(server.data, Path(self.path).read_bytes())
+
+    def test_upload_id_is_stable(self):
+        self.assertEqual(self.meta['upload_id'], make_upload_id('dev1', 5, file_sha256(self.path)))
+        self.assertNotEqual(self.meta['upload_id'], make_upload_id('dev1', 6, file_sha256(self.path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import sys
+import tempfile
+import shutil
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from dedupe import DedupeStore, ACKED, FAILED, PENDING
+
+
+class TestDedupeStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = Path(self.tmp) / 'dedupe_state.json'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_state_survives_restart(self):
+        store = DedupeStore(self.path)
+        store.record('dev1:default', 'abc')
+        store.pending('dev1:default', 'main', 7)
+        store.ack('dev1:default', 'main', 7, True)
+        store.close()
+        reopened = DedupeStore(self.path)
+        self.assertTrue(reopened.is_duplicate('dev1:default', 'abc'))
+        self.assertFalse(reopened.is_duplicate('dev1:default', 'def'))
+        self.assertEqual(reopened.entries['dev1:default']['status'], ACKED)
+        reopened.close()
+
+    def test_lost_frame_is_sent_again(self):
+        store = DedupeStore(self.path)
+        store.record('dev1:default', 'abc')
+        store.pending('dev1:default', 'main', 1)
+        store.pending('dev1:default', 'analytics', 1)
+        store.ack('dev1:default', 'main', 1, True)
+        self.assertTrue(store.is_duplicate('dev1:default', 'abc'))
+        store.ack('dev1:default', 'analytics', 1, False)
+        self.assertEqual(store.entries['dev1:default']['status'], FAILED)
+        self.assertFalse(store.is_duplicate('dev1:default', 'abc'))
+        store.close()
+
+    def test_ack_waits_for_all_targets(self):
+        store = DedupeStore(self.path)
+        store.record('dev1:default', 'abc', targets=['main', 'analytics'])
+        store.pending('dev1:default', 'main', 1)
+        store.ack('dev1:default', 'main', 1, True)
+        # второй сервер ещё не поставил кадр в очередь — кадр не считается доставленным
+        self.assertEqual(store.entries['dev1:default']['status'], PENDING)
+        store.pending('dev1:default', 'analytics', 3)
+        store.ack('dev1:default', 'analytics', 3, True)
+        self.assertEqual(store.entries['dev1:default']['status'], ACKED)
+        store.close()
+
+    def test_stale_ack_ignored(self):
+        store = DedupeStore(self.path)
+        store.record('dev1:default', 'old')
+        store.pending('dev1:default', 'main', 1)
+        store.record('dev1:default', 'new')
+        store.pending('dev1:default', 'main', 2)
+        store.ack('dev1:default', 'main', 1, False)
+        self.assertTrue(store.is_duplicate('dev1:default', 'new'))
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
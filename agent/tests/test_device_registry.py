@@ -0,0 +1,73 @@
+import unittest
+import sys
+import socket
+import threading
+import queue
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from device_registry import DeviceRegistry, parse_devices
+
+
+def adb_message(text):
+    data = text.encode()
+    return b'%04x' % len(data) + data
+
+
+class FakeAdbServer:
+    """Минимальный adb server: отвечает на host:track-devices заданной последовательностью списков."""
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.request = None
+        self.proceed = threading.Event()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        conn, _ = self.sock.accept()
+        with conn:
+            length = int(conn.recv(4), 16)
+            self.request = conn.recv(length)
+            conn.sendall(b'OKAY')
+            for snapshot in self.snapshots:
+                conn.sendall(adb_message(snapshot))
+                self.proceed.wait(5)
+                self.proceed.clear()
+
+
+class TestDeviceRegistry(unittest.TestCase):
+    def test_parse_devices(self):
+        self.assertEqual(parse_devices('emulator-5554\tdevice\n127.0.0.1:5555\toffline\n'),
+                         {'emulator-5554': 'device', '127.0.0.1:5555': 'offline'})
+        self.assertEqual(parse_devices(''), {})
+
+    def test_track_devices_events(self):
+        server = FakeAdbServer([
+            'emulator-5554\tdevice\n127.0.0.1:5555\toffline\n',
+            'emulator-5554\tdevice\n127.0.0.1:5555\tdevice\n',
+            '127.0.0.1:5555\tdevice\n',
+        ])
+        events = queue.Queue()
+        registry = DeviceRegistry(port=server.port, reconnect_delay=60)
+        registry.subscribe(lambda *event: events.put(event))
+        registry.start()
+        try:
+            got = {events.get(timeout=5), events.get(timeout=5)}
+            self.assertEqual(server.request, b'host:track-devices')
+            self.assertEqual(got, {('added', 'emulator-5554', 'device', None), ('added', '127.0.0.1:5555', 'offline', None)})
+            self.assertEqual(registry.online(), ['emulator-5554'])
+            server.proceed.set()
+            self.assertEqual(events.get(timeout=5), ('changed', '127.0.0.1:5555', 'device', 'offline'))
+            server.proceed.set()
+            self.assertEqual(events.get(timeout=5), ('removed', 'emulator-5554', None, 'device'))
+            self.assertFalse(registry.is_online('emulator-5554'))
+            self.assertTrue(registry.is_online('127.0.0.1:5555'))
+        finally:
+            registry.stop()
+
+if __name__ == '__main__':
+    unittest.main()
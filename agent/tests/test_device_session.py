@@ -30,22 +30,96 @@ class TestDeviceSession(unittest.TestCase):
         Path('test_screenshots').mkdir(exist_ok=True)
         self.session = DeviceSession(self.device, self.cfg)
 
+    @staticmethod
+    def fake_adb(args, **kwargs):
+        # adb pull: эмулируем скачанный с устройства кадр
+        if 'pull' in args:
+            time.sleep(0.05)
+            Path(args[-1]).write_bytes(b'\x89PNG\r\n\x1a\n' + os.urandom(2000))
+        return MagicMock(returncode=0)
+
     @patch('device_session.subprocess.run')
     def test_take_screenshot_success(self, mock_run):
-        # Эмулируем успешное создание файла
-        test_file = Path('test_screenshots/test_device_2020-01-01_00-00-00.png')
-        test_file.write_bytes(b'\x89PNG\r\n\x1a\n' + b'0' * 2000)
-        with patch('device_session.datetime') as mock_dt:
-            mock_dt.now.return_value.strftime.return_value = '2020-01-01_00-00-00'
-            result = self.session.take_screenshot()
+        mock_run.side_effect = self.fake_adb
+        result = self.session.take_screenshot()
         self.assertTrue(result.endswith('.png'))
-        test_file.unlink()
+        # в одну секунду — разные файлы и на устройстве, и локально
+        second = self.session.take_screenshot()
+        self.assertNotEqual(result, second)
+        remote = {call.args[0][-1] for call in mock_run.call_args_list if 'screencap' in call.args[0]}
+        self.assertEqual(len(remote), 2)
+        Path(result).unlink()
+        Path(second).unlink()
+
+    @patch('device_session.subprocess.run')
+    def test_buffer_and_device_jobs_concurrently(self, mock_run):
+        # съёмка в буфер и обычная съёмка одного устройства в одном run_pending
+        import agent
+        from dedupe import DedupeStore
+        from frame_buffer import FrameBuffer
+        mock_run.side_effect = self.fake_adb
+        tmp = tempfile.mkdtemp()
+        cfg = {'screenshot_dir': str(Path(tmp) / 'shots'), 'devices': []}
+        buffer = FrameBuffer(str(Path(tmp) / 'frames'))
+        store = DedupeStore(str(Path(tmp) / 'dedupe_state.json'))
+        uploads, errors = [], []
+        def run(job, *args):
+            try:
+                job(*args)
+            except Exception as e:
+                errors.append(e)
+        try:
+            with patch.object(agent, 'get_frame_buffer', return_value=buffer), \
+                 patch.object(agent, 'get_dedupe', return_value=store), \
+                 patch.object(agent, 'get_targets', return_value=[]), \
+                 patch.object(agent, 'encode_screenshot', side_effect=lambda path, profile: (path, None)), \
+                 patch.object(agent, 'upload_screenshot', side_effect=lambda *args, **kwargs: uploads.append(args[2])), \
+                 patch.object(agent, 'send_message'), patch.object(agent, 'get_commands', return_value=[]), \
+                 patch.object(agent.DeviceSession, 'get_metadata', return_value={}):
+                for _ in range(3):
+                    threads = [threading.Thread(target=run, args=(agent.buffer_job, cfg, self.device)),
+                               threading.Thread(target=run, args=(agent.device_job, cfg, self.device))]
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+        finally:
+            store.close()
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(uploads), 3)
 
     @patch('device_session.subprocess.run', side_effect=Exception('ADB error'))
     def test_take_screenshot_fail(self, mock_run):
         result = self.session.take_screenshot()
         self.assertIsNone(result)
 
+    @patch('device_session.subprocess.check_output')
+    def test_get_metadata_single_call_and_cache(self, mock_out):
+        from device_session import MetadataCache
+        import device_session
+        cache = MetadataCache()
+        def fake_output(cmd, **kwargs):
+            if cmd == ['adb', 'version']:
+                return 'Android Debug Bridge version 1.0.41\nVersion 34.0.5\n'
+            return '100.50 200.00\n__META_SEP__\nFilesystem 1K-blocks Used Available Use% Mounted on\n/dev/block/dm-0 1000 500 500 50% /data\n'
+        mock_out.side_effect = fake_output
+        with patch.object(device_session, 'metadata_cache', cache):
+            meta = self.session.get_metadata()
+            meta2 = self.session.get_metadata()
+        self.assertEqual(meta['adb_version'], 'Android Debug Bridge version 1.0.41')
+        self.assertTrue(meta['free_space'].startswith('/dev/block/dm-0'))
+        self.assertGreaterEqual(float(meta2['uptime']), 100.5)
+        # adb version + один общий shell-вызов; второй запрос целиком из кэша
+        self.assertEqual(mock_out.call_count, 2)
+
+    @patch('device_session.subprocess.check_output', side_effect=Exception('ADB error'))
+    def test_get_metadata_fail(self, mock_out):
+        from device_session import MetadataCache
+        meta = MetadataCache().get('test_device')
+        self.assertTrue(meta['adb_version'].startswith('error:'))
+        self.assertTrue(meta['uptime'].startswith('error:'))
+
     def wait_server_ready(self, url, timeout=10):
         start = time.time()
         while time.time() - start < timeout:
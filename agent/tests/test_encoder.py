@@ -0,0 +1,45 @@
+import unittest
+import sys
+import tempfile
+import shutil
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from encoder import encode_screenshot, get_profile, content_type_for, cv2
+
+
+class TestEncoder(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = Path(self.tmp) / 'last.png'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_profile_lookup(self):
+        cfg = {'encoding': {'default': {'format': 'png'}, 'monitor': {'format': 'webp', 'quality': 70}}}
+        self.assertEqual(get_profile(cfg, 'monitor')['format'], 'webp')
+        self.assertEqual(get_profile(cfg, 'evidence')['format'], 'png')
+        self.assertEqual(get_profile({}, 'monitor')['format'], 'png')
+
+    def test_png_passthrough(self):
+        self.src.write_bytes(b'\x89PNG' + b'0' * 100)
+        path, content_type = encode_screenshot(self.src, {'format': 'png'})
+        self.assertEqual(path, str(self.src))
+        self.assertEqual(content_type, 'image/png')
+
+    @unittest.skipIf(cv2 is None, 'opencv-python не установлен')
+    def test_webp_downscale(self):
+        import numpy as np
+        img = np.random.randint(0, 255, (400, 800, 3), dtype=np.uint8)
+        cv2.imwrite(str(self.src), img)
+        path, content_type = encode_screenshot(self.src, {'format': 'webp', 'quality': 60, 'max_dim': 200})
+        self.assertEqual(content_type, 'image/webp')
+        self.assertEqual(content_type_for(path), 'image/webp')
+        out = cv2.imread(path)
+        self.assertEqual(out.shape[:2], (100, 200))
+        self.assertTrue(self.src.exists())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import sys
+import json
+import zipfile
+import tempfile
+import shutil
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from frame_buffer import FrameBuffer
+
+
+class TestFrameBuffer(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.src = self.tmp / 'shot.png'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def frame(self, content):
+        self.src.write_bytes(content)
+        return self.src
+
+    def test_bounded_and_deduplicated(self):
+        buffer = FrameBuffer(self.tmp / 'frames', max_frames=3, profile={'format': 'png'})
+        buffer.add('dev1', 'default', self.frame(b'a' * 10), 'ha', ts=100)
+        buffer.add('dev1', 'default', self.frame(b'a' * 10), 'ha', ts=101)
+        buffer.add('dev1', 'default', self.frame(b'b' * 10), 'hb', ts=102)
+        # неизменившийся кадр хранится одним файлом
+        self.assertEqual(len(list((self.tmp / 'frames' / 'dev1').iterdir())), 2)
+        buffer.add('dev1', 'default', self.frame(b'c' * 10), 'hc', ts=103)
+        buffer.add('dev1', 'default', self.frame(b'd' * 10), 'hd', ts=104)
+        self.assertEqual([e['hash'] for e in buffer.window('dev1')], ['hb', 'hc', 'hd'])
+        self.assertEqual(len(list((self.tmp / 'frames' / 'dev1').iterdir())), 3)
+        self.assertEqual(buffer.total_bytes, 30)
+
+    def test_concurrent_repeats_keep_files(self):
+        import os
+        import time
+        import threading
+
+        class YieldingLock:
+            # после освобождения блокировки поток уступает другим — между двумя захватами успевает
+            # пройти параллельный add
+            def __init__(self):
+                self.lock = threading.Lock()
+
+            def __enter__(self):
+                self.lock.acquire()
+
+            def __exit__(self, *exc):
+                self.lock.release()
+                time.sleep(0.0005)
+
+        buffer = FrameBuffer(self.tmp / 'frames', max_frames=1, profile={'format': 'png'})
+        buffer.lock = YieldingLock()
+        sources = {}
+        for name in ('ha', 'hb'):
+            sources[name] = self.tmp / f'{name}.png'
+            sources[name].write_bytes(name.encode() * 5)
+
+        def worker(offset):
+            for i in range(200):
+                name = 'ha' if (i // 2) % 2 else 'hb'
+                buffer.add('dev1', 'default', sources[name], name, ts=1000 + offset + i * 10)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # повтор не ссылается на файл, вытесненный параллельным add
+        for entry in buffer.window('dev1'):
+            self.assertTrue(os.path.exists(entry['file']))
+        self.assertEqual(set(buffer.refs), {e['file'] for e in buffer.window('dev1')})
+
+    def test_pack_window(self):
+        buffer = FrameBuffer(self.tmp / 'frames', max_age=50, profile={'format': 'png'})
+        for i, ts in enumerate([100, 110, 120, 130]):
+            buffer.add('dev1', 'default', self.frame(bytes([i]) * 10), f'h{i}', ts=ts)
+        archive, count = buffer.pack('dev1', since=105, until=125)
+        self.assertEqual(count, 2)
+        with zipfile.ZipFile(archive) as zf:
+            manifest = json.loads(zf.read('manifest.json'))
+            self.assertEqual([m['ts'] for m in manifest], [110, 120])
+            self.assertEqual(zf.read(manifest[0]['file']), bytes([1]) * 10)
+        self.assertEqual(buffer.pack('dev2'), (None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
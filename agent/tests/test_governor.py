@@ -0,0 +1,82 @@
+import unittest
+import sys
+import time
+import tempfile
+import shutil
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from spool import Spool, SpoolDrainer, SEND_OK
+from governor import BandwidthGovernor, TokenBucket, PRIORITY_COMMAND, PRIORITY_ERROR, PRIORITY_EVIDENCE, PRIORITY_MONITOR
+
+
+class TestGovernor(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.spool = Spool(self.tmp / 'spool')
+        self.governor = BandwidthGovernor(rate_kbps=10, burst_kb=10, max_delay=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def put(self, kind, payload, size=0):
+        path = None
+        if size:
+            path = self.tmp / f'{time.time_ns()}.webp'
+            path.write_bytes(b'0' * size)
+        return self.spool.put(kind, payload, path, priority=self.governor.classify(kind, payload))
+
+    def test_priority_order(self):
+        self.put('screenshot', {'device_id': 'd1', 'section': 'default'}, 100)
+        self.put('frames', {'device_id': 'd1'}, 100)
+        self.put('message', {'type': 'error', 'message': 'fail'})
+        self.put('command_result', {'command_id': 1, 'status': 'done'})
+        order = []
+        while (item := self.spool.head()) is not None:
+            order.append(item['priority'])
+            self.spool.done(item)
+        self.assertEqual(order, [PRIORITY_COMMAND, PRIORITY_ERROR, PRIORITY_EVIDENCE, PRIORITY_MONITOR])
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1000, burst=1000)
+        self.assertEqual(bucket.take(800), 0)
+        self.assertGreater(bucket.take(800), 0)
+        # подтверждения команд не ждут, а уходят в долг
+        self.assertEqual(bucket.take(800, force=True), 0)
+        self.assertLess(bucket.tokens, 0)
+
+    def test_relieve_sheds_monitor_frames(self):
+        for _ in range(3):
+            self.put('screenshot', {'device_id': 'd1', 'section': 'default'}, 8 * 1024)
+            self.put('screenshot', {'device_id': 'd2', 'section': 'default'}, 8 * 1024)
+        self.put('frames', {'device_id': 'd1'}, 8 * 1024)
+        self.put('message', {'type': 'error', 'message': 'fail'})
+        dropped = self.governor.relieve(self.spool)
+        # лимит — 10 КБ (10 КБ/с * 1 с): снимки мониторинга удалены, доказательства и ошибки остались
+        self.assertEqual(dropped, 6)
+        kinds = []
+        while (item := self.spool.head()) is not None:
+            kinds.append(item['kind'])
+            self.spool.done(item)
+        self.assertEqual(kinds, ['message', 'frames'])
+
+    def test_drainer_sends_urgent_first(self):
+        governor = BandwidthGovernor(rate_kbps=4, burst_kb=4)
+        self.put('screenshot', {'device_id': 'd1', 'section': 'default'}, 4 * 1024)
+        self.put('screenshot', {'device_id': 'd2', 'section': 'default'}, 4 * 1024)
+        sent = []
+        drainer = SpoolDrainer(self.spool, lambda item: sent.append(item['kind']) or SEND_OK, rate_per_sec=0, governor=governor)
+        drainer.start()
+        time.sleep(0.2)
+        # первый снимок исчерпал токены, второй ждёт ~1 с — результат команды уходит раньше
+        self.put('command_result', {'command_id': 1, 'status': 'done'})
+        deadline = time.time() + 5
+        while len(self.spool) and time.time() < deadline:
+            time.sleep(0.05)
+        drainer.stop()
+        self.assertEqual(sent, ['screenshot', 'command_result', 'screenshot'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import sys
+import subprocess
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from health import HealthMonitor, RECONNECT, RESTART_SHARD, RESTART_ALL
+
+
+class FakeShard:
+    def __init__(self, port, pool):
+        self.port = port
+        self.pool = pool
+
+    def run(self, *args, timeout=30):
+        device_id = args[1]
+        if device_id in self.pool.broken:
+            return subprocess.CompletedProcess(args, 1, '', 'error: closed')
+        return subprocess.CompletedProcess(args, 0, 'ok\n', '')
+
+    def reconnect(self, device_id):
+        self.pool.actions.append(('reconnect', device_id))
+
+    def restart(self):
+        self.pool.actions.append(('restart', self.port))
+
+
+class FakePool:
+    def __init__(self):
+        self.broken = set()
+        self.actions = []
+        self.shards = {5037: FakeShard(5037, self)}
+
+    def shard_for(self, device_id):
+        return self.shards[5037]
+
+    def restart_all(self):
+        self.actions.append(('restart_all', None))
+
+
+class FakeRegistry:
+    def __init__(self, devices):
+        self.devices = devices
+
+    def all(self):
+        return dict(self.devices)
+
+
+class TestHealthMonitor(unittest.TestCase):
+    def test_escalation_is_targeted(self):
+        pool = FakePool()
+        registry = FakeRegistry({'emu-1': 'device', 'emu-2': 'device', 'emu-3': 'unauthorized'})
+        actions = []
+        monitor = HealthMonitor(pool, registry, failures=2, on_action=lambda d, step, err: actions.append((d, step)))
+        status = monitor.check_all()
+        self.assertTrue(status['emu-1']['ok'])
+        self.assertIsNotNone(status['emu-1']['latency_ms'])
+        self.assertIsNone(status['emu-3']['ok'])
+        pool.broken.add('emu-2')
+        for _ in range(6):
+            monitor.check_all()
+        # сначала переподключение одного устройства, затем шард, затем все adb server
+        self.assertEqual(actions, [('emu-2', RECONNECT), ('emu-2', RESTART_SHARD), ('emu-2', RESTART_ALL)])
+        self.assertEqual(pool.actions, [('reconnect', 'emu-2'), ('restart', 5037), ('restart_all', None)])
+        # повторный глобальный перезапуск ограничен cooldown
+        monitor.check_all()
+        monitor.check_all()
+        self.assertEqual(actions[-1], ('emu-2', RECONNECT))
+        # устройство восстановилось — ступени сбрасываются
+        pool.broken.clear()
+        self.assertTrue(monitor.check_all()['emu-2']['ok'])
+        self.assertEqual(monitor.health['emu-2'].step, 0)
+
+    def test_missing_usb_device_not_escalated(self):
+        pool = FakePool()
+        monitor = HealthMonitor(pool, FakeRegistry({}), expected=lambda: ['usb-serial', '10.0.0.5:5555'], failures=1)
+        status = monitor.check_all()
+        self.assertIsNone(status['usb-serial']['ok'])
+        self.assertFalse(status['10.0.0.5:5555']['ok'])
+        self.assertEqual(pool.actions, [('reconnect', '10.0.0.5:5555')])
+
+
+if __name__ == '__main__':
+    unittest.main()
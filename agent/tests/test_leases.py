@@ -0,0 +1,66 @@
+import unittest
+import sys
+import time
+from pathlib import Path
+from unittest import mock
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+import leases
+from leases import LeaseClient
+
+
+class FakeTarget:
+    url = 'http://server:8000'
+    headers = {'Authorization': 'Bearer key'}
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class TestLeaseClient(unittest.TestCase):
+    def test_only_leased_devices(self):
+        client = LeaseClient(FakeTarget(), 'agent-a', lambda: ['d1', 'd2'], capacity=5, server_id='srv', host='host-a')
+        data = {'leases': [{'device_id': 'd1', 'expires_in': 60, 'draining': False},
+                           {'device_id': 'd2', 'expires_in': 3, 'draining': True}]}
+        with mock.patch.object(leases.requests, 'post', return_value=FakeResponse(data)) as post:
+            client.heartbeat()
+        self.assertEqual(post.call_args.kwargs['json'], {'agent_id': 'agent-a', 'server_id': 'srv', 'host': 'host-a',
+                                                            'capacity': 5, 'devices': ['d1', 'd2']})
+        self.assertTrue(client.holds('d1'))
+        # до окончания аренды меньше запаса — агент уже не снимает устройство
+        self.assertFalse(client.holds('d2'))
+        self.assertFalse(client.holds('d3'))
+
+    def test_offline_keeps_only_confirmed_leases(self):
+        client = LeaseClient(FakeTarget(), 'agent-a', lambda: ['d1', 'd2'], interval=20)
+        with mock.patch.object(leases.time, 'monotonic', return_value=100.0):
+            client.apply([{'device_id': 'd1', 'expires_in': 60}, {'device_id': 'd2', 'expires_in': 1}], 100.0)
+            with mock.patch.object(leases.requests, 'post', side_effect=leases.requests.ConnectionError('down')):
+                client.heartbeat()
+            self.assertFalse(client.online)
+            self.assertEqual(client.held(), ['d1'])
+        # при разрыве сети аренда не продлевается локально: после подтверждённого срока съёмка прекращается
+        with mock.patch.object(leases.time, 'monotonic', return_value=160.0):
+            with mock.patch.object(leases.requests, 'post', side_effect=leases.requests.ConnectionError('down')):
+                client.heartbeat()
+            self.assertEqual(client.held(), [])
+
+    def test_offline_drops_leases_without_keep(self):
+        client = LeaseClient(FakeTarget(), 'agent-a', lambda: ['d1'], keep_on_offline=False)
+        client.apply([{'device_id': 'd1', 'expires_in': 60}], time.monotonic())
+        with mock.patch.object(leases.requests, 'post', side_effect=leases.requests.ConnectionError('down')):
+            client.heartbeat()
+        self.assertFalse(client.holds('d1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import sys
+from pathlib import Path
+from unittest import mock
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+import planner
+from planner import CapturePlan
+
+
+class FakeTarget:
+    url = 'http://server:8000'
+    headers = {'Authorization': 'Bearer key'}
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class TestCapturePlan(unittest.TestCase):
+    def test_aligned_to_server_phase(self):
+        plan = CapturePlan(FakeTarget(), 'agent-a', lambda: {'d1': 60, 'd2': 60})
+        data = {'server_time': 1000.0, 'devices': {'d1': {'offset': 15.0, 'interval': 60, 'jitter': 0}},
+                'ingest': {'stretch': 1}}
+        # часы агента отстают от сервера на 100 сек
+        with mock.patch.object(planner.time, 'time', return_value=900.0), \
+                mock.patch.object(planner.requests, 'post', return_value=FakeResponse(data)) as post:
+            self.assertTrue(plan.update())
+        self.assertEqual(post.call_args.kwargs['json']['devices'],
+                         [{'device_id': 'd1', 'interval': 60}, {'device_id': 'd2', 'interval': 60}])
+        self.assertEqual(plan.version, 1)
+        # серверное время 1000 -> следующая фаза 1035 по серверу = 935 по часам агента
+        self.assertAlmostEqual(plan.next_due('d1', 60, now=900.0), 935.0)
+        self.assertAlmostEqual(plan.next_due('d1', 60, now=935.0), 995.0)
+
+    def test_local_phase_without_plan(self):
+        plan = CapturePlan(FakeTarget(), 'agent-a', lambda: {})
+        with mock.patch.object(planner.requests, 'post', side_effect=planner.requests.ConnectionError('down')):
+            self.assertFalse(plan.update())
+        due = plan.next_due('d1', 60, now=1000.0)
+        self.assertGreater(due, 1000.0)
+        self.assertLessEqual(due, 1060.0)
+        # фаза стабильна для устройства и различается между устройствами
+        self.assertAlmostEqual(plan.next_due('d1', 60, now=1000.0), due)
+        self.assertNotAlmostEqual(plan.next_due('d2', 60, now=1000.0), due)
+
+
+if __name__ == '__main__':
+    unittest.main()
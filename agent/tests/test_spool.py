@@ -0,0 +1,99 @@
+import unittest
+import os
+import sys
+import time
+import tempfile
+import shutil
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from spool import Spool, SpoolDrainer, SEND_OK, SEND_OFFLINE, SEND_DROP
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.spool_dir = Path(self.tmp) / 'spool'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_put_survives_restart(self):
+        src = Path(self.tmp) / 'last.png'
+        src.write_bytes(b'\x89PNG' + b'0' * 100)
+        spool = Spool(self.spool_dir)
+        spool.put('screenshot', {'device_id': 'dev1'}, src)
+        spool.put('message', {'message': 'hello'})
+        spool.conn.close()
+        # last.png заменяется через os.replace — в очереди остаётся своя копия
+        new = Path(self.tmp) / 'new.png'
+        new.write_bytes(b'changed')
+        os.replace(new, src)
+        reopened = Spool(self.spool_dir)
+        self.assertEqual(len(reopened), 2)
+        item = reopened.head()
+        self.assertEqual(item['kind'], 'screenshot')
+        self.assertEqual(Path(item['file']).read_bytes()[:4], b'\x89PNG')
+        reopened.done(item)
+        self.assertFalse(Path(item['file']).exists())
+        self.assertEqual(reopened.head()['payload'], {'message': 'hello'})
+
+    def test_limits_drop_oldest(self):
+        spool = Spool(self.spool_dir, max_items=3)
+        for i in range(5):
+            spool.put('message', {'n': i})
+        self.assertEqual(len(spool), 3)
+        self.assertEqual(spool.head()['payload'], {'n': 2})
+
+    def test_dropped_items_reported(self):
+        spool = Spool(self.spool_dir, max_items=2)
+        done = []
+        SpoolDrainer(spool, lambda item: SEND_OK, on_done=lambda item, delivered: done.append((item['payload']['n'], delivered)))
+        queued = []
+        for i in range(3):
+            spool.put('message', {'n': i, 'device_id': 'd1', 'section': 'default'}, on_queued=queued.append)
+        # запись отмечена до удаления, удаление при переполнении доходит до on_done
+        self.assertEqual(len(queued), 3)
+        self.assertEqual(done, [(0, False)])
+        self.assertEqual([item['payload']['n'] for item in spool.collapse(0)], [1])
+        self.assertEqual(done, [(0, False), (1, False)])
+        self.assertEqual(spool.drop_oldest(0)['payload']['n'], 2)
+        self.assertIsNone(spool.drop_oldest(0))
+        self.assertEqual(done[-1], (2, False))
+
+    def test_drainer_waits_for_server(self):
+        spool = Spool(self.spool_dir)
+        spool.put('message', {'n': 1})
+        spool.put('message', {'n': 2})
+        calls = []
+        def send(item):
+            calls.append(item['payload']['n'])
+            # первые две попытки — сервер недоступен
+            return SEND_OFFLINE if len(calls) <= 2 else SEND_OK
+        drainer = SpoolDrainer(spool, send, rate_per_sec=0, backoff_min=0.01, backoff_max=0.02)
+        drainer.start()
+        deadline = time.time() + 5
+        while len(spool) and time.time() < deadline:
+            time.sleep(0.02)
+        drainer.stop()
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(calls, [1, 1, 1, 2])
+        self.assertTrue(drainer.online)
+
+    def test_drainer_drops_rejected(self):
+        spool = Spool(self.spool_dir)
+        item_id = spool.put('message', {'n': 1})
+        done = []
+        drainer = SpoolDrainer(spool, lambda item: SEND_DROP, rate_per_sec=0,
+                               on_done=lambda item, delivered: done.append((item['id'], delivered)))
+        drainer.start()
+        deadline = time.time() + 5
+        while len(spool) and time.time() < deadline:
+            time.sleep(0.02)
+        drainer.stop()
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(done, [(item_id, False)])
+
+if __name__ == '__main__':
+    unittest.main()
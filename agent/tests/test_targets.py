@@ -0,0 +1,97 @@
+import unittest
+import sys
+import time
+import tempfile
+import shutil
+import threading
+from pathlib import Path
+from unittest import mock
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+import targets
+from targets import load_targets
+
+
+class FakeResponse:
+    ok = True
+    status_code = 200
+    text = 'ok'
+
+
+class TestTargets(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cfg = {
+            'server_url': 'http://main:8000', 'api_key': 'key', 'server_id': 'server-01',
+            'spool': {'dir': str(Path(self.tmp) / 'spool'), 'rate_per_sec': 0},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_single_server_compat(self):
+        (target,) = load_targets(self.cfg)
+        self.assertEqual(target.url, 'http://main:8000')
+        self.assertTrue(target.commands)
+        self.assertEqual(target.spool.dir, Path(self.tmp) / 'spool')
+
+    def test_slow_server_does_not_block_others(self):
+        self.cfg['servers'] = [
+            {'name': 'ha', 'url': 'http://ha:8000', 'api_key': 'k1'},
+            {'name': 'analytics', 'url': 'http://analytics:8000', 'api_key': 'k2', 'server_id': 'agent-a'},
+        ]
+        release = threading.Event()
+        sent = []
+
+        def post(url, **kwargs):
+            if url.startswith('http://ha'):
+                release.wait(5)
+            sent.append((url, kwargs['json']['server_id']))
+            return FakeResponse()
+
+        ha, analytics = load_targets(self.cfg)
+        self.assertTrue(ha.commands)
+        self.assertFalse(analytics.commands)
+        with mock.patch.object(targets.requests, 'post', side_effect=post):
+            for target in (ha, analytics):
+                target.put('message', {'server_id': 'server-01', 'message': 'hi'})
+                target.start()
+            deadline = time.time() + 3
+            while len(analytics.spool) and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(len(analytics.spool), 0)
+            self.assertEqual(len(ha.spool), 1)
+            release.set()
+            deadline = time.time() + 3
+            while len(ha.spool) and time.time() < deadline:
+                time.sleep(0.05)
+            for target in (ha, analytics):
+                target.stop()
+        self.assertIn(('http://analytics:8000/api/send_message', 'agent-a'), sent)
+        self.assertIn(('http://ha:8000/api/send_message', 'server-01'), sent)
+
+    def test_busy_server_not_counted_as_attempt(self):
+        self.cfg['spool']['max_attempts'] = 1
+        self.cfg['spool']['backoff_min'] = 0.1
+        # Retry-After: 0 — пауза не меньше backoff_min, а не повтор без ожидания
+        busy = mock.Mock(ok=False, status_code=503, text='Ingest queue is full', headers={'Retry-After': '0'})
+        responses = [busy, busy, FakeResponse()]
+        (target,) = load_targets(self.cfg)
+        with mock.patch.object(targets.requests, 'post', side_effect=responses) as post:
+            target.put('message', {'server_id': 'server-01', 'message': 'hi'})
+            started = time.monotonic()
+            target.start()
+            deadline = time.time() + 3
+            while len(target.spool) and time.time() < deadline:
+                time.sleep(0.02)
+            target.stop()
+        # 503 — не ошибка записи: max_attempts=1 не исчерпан, пауза — по Retry-After, но не меньше backoff_min
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(len(target.spool), 0)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(targets.retry_after(mock.Mock(headers={})), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+import sys
+from pathlib import Path
+AGENT_DIR = str(Path(__file__).parent.parent.resolve())
+if AGENT_DIR not in sys.path:
+    sys.path.insert(0, AGENT_DIR)
+from telemetry import TelemetryBatcher, parse_metrics
+
+
+class TestTelemetry(unittest.TestCase):
+    def test_parse_metrics(self):
+        meta = {'adb_version': 'Android Debug Bridge version 1.0.41', 'uptime': '100.50',
+                'free_space': '/dev/block/dm-0 1000 400 600 40% /data', 'battery': '87'}
+        self.assertEqual(parse_metrics(meta), {'uptime_s': 100.5, 'free_space_kb': 600.0, 'battery_pct': 87.0})
+        failed = {'uptime': 'error: adb shell failed', 'free_space': 'error: adb shell failed', 'battery': 'error: no battery info'}
+        self.assertEqual(parse_metrics(failed), {})
+
+    def test_batches(self):
+        batches = []
+        batcher = TelemetryBatcher(lambda samples, batch_id: batches.append((samples, batch_id)), max_samples=3)
+        for i in range(4):
+            batcher.add('dev1', 'capture_ms', i * 10, ts=1000 + i)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([s['value'] for s in batches[0][0]], [0, 10, 20])
+        batcher.stop()
+        self.assertEqual(batches[1][0], [{'device_id': 'dev1', 'metric': 'capture_ms', 'value': 30.0, 'ts': 1003}])
+        # у каждой пачки свой id — по нему сервер отбрасывает повторную доставку
+        self.assertNotEqual(batches[0][1], batches[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,523 @@
+import os
+import re
+import time
+import heapq
+import queue
+import zlib
+import sqlite3
+import calendar
+import logging
+import threading
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+# Настройки соединения: WAL — читатели не блокируют писателя; synchronous=NORMAL в WAL
+# не теряет целостность (после сбоя питания возможна потеря последних транзакций, но не порча БД)
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 10000,           # мс ожидания блокировки вместо мгновенного "database is locked"
+    'mmap_size': 256 * 1024 * 1024,  # чтение страниц через mmap
+    'cache_size': -64 * 1024,        # 64 МБ кэша страниц на соединение (отрицательное — в КиБ)
+    'temp_store': 'MEMORY',
+}
+
+
+class Database:
+    """
+    Общий слой соединений SQLite для central_server: одно долгоживущее соединение на поток
+    (потоки пула FastAPI и event loop) вместо sqlite3.connect на каждый запрос.
+    Соединения настраиваются один раз (pragmas), кэш подготовленных выражений (cached_statements)
+    переиспользуется между запросами потока. close_all() закрывает все соединения при остановке
+    сервера — последний закрытый переносит WAL в основной файл БД.
+    """
+    def __init__(self, path, pragmas=None, cached_statements=256, uri=False):
+        self.path = str(path)
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        self.cached_statements = cached_statements
+        self.uri = uri
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.pragmas['busy_timeout'] / 1000,
+                               check_same_thread=False, cached_statements=self.cached_statements, uri=self.uri)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}')
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._open()
+        return conn
+
+    @contextmanager
+    def connect(self):
+        """
+        Соединение потока как контекст транзакции (как `with sqlite3.connect(...)`: commit при выходе,
+        rollback при исключении). row_factory сбрасывается — его устанавливает сам обработчик.
+        """
+        conn = self.connection()
+        conn.row_factory = None
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def migrate(self, migrations):
+        """
+        Версионные миграции: migrations — [(версия, описание, шаги)], шаг — SQL-строка или функция(conn).
+        Номер применённой версии хранится в PRAGMA user_version; каждая миграция выполняется
+        в своей транзакции вместе с записью версии, поэтому прерванная миграция повторится целиком.
+        """
+        conn = self.connection()
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, description, steps in sorted(migrations, key=lambda m: m[0]):
+            if version <= current:
+                continue
+            # BEGIN IMMEDIATE: при одновременном старте нескольких процессов сервера миграцию выполняет один
+            conn.execute('BEGIN IMMEDIATE')
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version <= current:
+                conn.execute('ROLLBACK')
+                continue
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(f'PRAGMA user_version={int(version)}')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            logging.info(f'[db] Миграция {version}: {description}')
+            current = version
+        return current
+
+    def close_local(self):
+        """Закрыть соединение текущего потока (соединения других потоков закрываются их владельцами или GC)."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+        self.local.conn = None
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self.local = threading.local()
+
+
+class GroupCommitWriter(threading.Thread):
+    """
+    Очередь записи с групповым коммитом: вставки из обработчиков (сообщения, строки скринов) копятся
+    и записываются одной транзакцией — до max_batch записей или max_delay секунд от первой записи пачки.
+    Один fsync на пачку вместо одного на запись.
+    submit() сразу возвращает Future (результат — lastrowid): обработчик отвечает агенту, не дожидаясь
+    коммита, либо ждёт Future (режим durable). sync() — дождаться записи всего, что поставлено раньше
+    (только там, где нужно чтение после записи, например перед удалением партиций; не на пути чтения). Очередь ограничена max_queue: при переполнении submit ждёт.
+    Запись может идти в другую БД (database, например файл партиции): пачка коммитится отдельно в каждую.
+    database может быть и функцией, возвращающей БД: она вызывается в потоке записи непосредственно
+    перед записью, поэтому партиция выбирается уже после задач, поставленных раньше.
+    call() — выполнить функцию в потоке записи между записями очереди (например удаление партиций:
+    все поставленные раньше записи уже закоммичены, следующие ещё не начаты, соединения потока
+    записи можно закрыть без гонки с ним).
+    """
+    def __init__(self, database, max_batch=500, max_delay=0.02, max_queue=10000):
+        super().__init__(daemon=True, name='group-commit')
+        self.db = database
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.batches = 0
+        self.rows = 0
+
+    def submit(self, sql, params=(), block=True, database=None):
+        """Поставить запись в очередь (в database, по умолчанию — основная БД); block=False — queue.Full вместо ожидания места."""
+        future = Future()
+        with self.lock:
+            self.pending += 1
+        try:
+            self.queue.put((database or self.db, sql, params, future), block=block)
+        except queue.Full:
+            with self.lock:
+                self.pending -= 1
+            raise
+        return future
+
+    def call(self, fn):
+        """Выполнить fn() в потоке записи после всех поставленных раньше записей; Future — результат fn."""
+        future = Future()
+        with self.lock:
+            self.pending += 1
+        self.queue.put((None, fn, None, future))
+        return future
+
+    def sync(self, timeout=10):
+        """Дождаться коммита всех поставленных ранее записей (сразу, если очередь пуста)."""
+        with self.lock:
+            if not self.pending:
+                return
+        self.submit(None).result(timeout)
+
+    def run(self):
+        while not (self.stopped.is_set() and self.queue.empty()):
+            try:
+                first = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch):
+        # задачи call() делят пачку: записи до задачи коммитятся до её выполнения, после — после
+        segment = []
+        for item in batch:
+            if item[0] is None:
+                self.write_segment(segment)
+                segment = []
+                self.run_task(item[1], item[3])
+            else:
+                segment.append(item)
+        self.write_segment(segment)
+        with self.lock:
+            self.batches += 1
+
+    def write_segment(self, batch):
+        groups = defaultdict(list)
+        results = {}
+        for database, sql, params, future in batch:
+            if sql is None:
+                continue
+            if callable(database):
+                try:
+                    database = database()
+                except Exception as e:
+                    results[id(future)] = e
+                    continue
+            groups[database].append((sql, params, future))
+        for database, writes in groups.items():
+            results.update(self.write_group(database, writes))
+        with self.lock:
+            self.pending -= len(batch)
+            self.rows += sum(len(writes) for writes in groups.values())
+        for database, sql, params, future in batch:
+            result = results.get(id(future))
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def run_task(self, fn, future):
+        try:
+            result = fn()
+        except Exception as e:
+            logging.error(f'[db] Ошибка задачи потока записи: {e}')
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def write_group(self, database, writes):
+        results = {}
+        try:
+            with database.connect() as conn:
+                for sql, params, future in writes:
+                    results[id(future)] = conn.execute(sql, params).lastrowid
+        except sqlite3.Error as e:
+            # ошибка одной записи не должна терять остальные: пачка повторяется по одной записи
+            logging.error(f'[db] Ошибка группового коммита ({len(writes)} записей): {e}')
+            results = {}
+            for sql, params, future in writes:
+                try:
+                    with database.connect() as conn:
+                        results[id(future)] = conn.execute(sql, params).lastrowid
+                except sqlite3.Error as item_error:
+                    results[id(future)] = item_error
+        return results
+
+    def stop(self, timeout=10):
+        """Записать остаток очереди и остановить поток (при остановке сервера, до close_all)."""
+        self.stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+# --- Партиции по месяцам (и по server_id) ---
+PARTITION_FILE_RE = re.compile(r'^(\d{4}-\d{2})\.sqlite3$')
+
+
+def month_of(ts):
+    """Месяц партиции ('YYYY-MM', UTC) для unix time."""
+    return time.strftime('%Y-%m', time.gmtime(ts))
+
+
+def month_bounds(month):
+    """[начало, конец) месяца 'YYYY-MM' в unix time (UTC)."""
+    year, mon = int(month[:4]), int(month[5:7])
+    start = calendar.timegm((year, mon, 1, 0, 0, 0))
+    end = calendar.timegm((year + mon // 12, mon % 12 + 1, 1, 0, 0, 0))
+    return start, end
+
+
+def tenant_dir(server_id):
+    """Имя каталога партиций server_id (только безопасные для файловой системы символы)."""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(server_id)) or '_'
+
+
+class PartitionSet:
+    """
+    Растущие по времени таблицы (скрины, сообщения) в отдельных файлах SQLite по месяцам:
+    root/2026-10.sqlite3, с by_tenant — root/<server_id>/2026-10.sqlite3.
+    Запись — в файл месяца created_ts записи (database()); чтение (query()) подключает через ATTACH
+    только партиции, пересекающие диапазон дат запроса, и сливает отсортированные результаты.
+    Удаление старой истории — удаление файлов (drop_before), без DELETE и VACUUM основной БД;
+    текущий месяц остаётся небольшим файлом, который помещается в кэш.
+    id записей уникальны между партициями: AUTOINCREMENT каждой партиции начинается с
+    (номер месяца << 48) | (хэш server_id << 32), поэтому курсор (created_ts, id) однозначен.
+    """
+    MAX_ATTACH = 8  # SQLite по умолчанию допускает 10 подключённых БД на соединение
+
+    def __init__(self, root, migrations, tables, by_tenant=False, pragmas=None):
+        self.root = Path(root)
+        self.migrations = migrations
+        self.tables = list(tables)
+        self.by_tenant = by_tenant
+        self.pragmas = pragmas
+        self.databases = {}
+        # одна блокировка на создание, подключение (ATTACH) и удаление файлов партиций:
+        # запрос не подключает файл, который в этот момент удаляет drop_before
+        self.lock = threading.Lock()
+        # соединение потока, к которому партиции подключаются на время запроса (URI: ATTACH с mode=ro)
+        self.reader = Database(':memory:', uri=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.upgrade()
+
+    def upgrade(self):
+        """Применить новые миграции ко всем существующим партициям (чтение подключает файлы без миграций)."""
+        for _, _, path in self.partitions():
+            database = Database(path, self.pragmas)
+            try:
+                database.migrate(self.migrations)
+            finally:
+                database.close_all()
+
+    def path(self, month, tenant=None):
+        return (self.root / tenant if tenant else self.root) / f'{month}.sqlite3'
+
+    def database(self, ts, server_id=None):
+        """БД партиции для записи с created_ts = ts (файл создаётся и размечается при первом обращении)."""
+        month = month_of(ts)
+        tenant = tenant_dir(server_id) if self.by_tenant and server_id is not None else None
+        key = (month, tenant)
+        database = self.databases.get(key)
+        if database is not None:
+            return database
+        with self.lock:
+            database = self.databases.get(key)
+            if database is None:
+                path = self.path(month, tenant)
+                if not path.exists():
+                    self.create(path, month, tenant)
+                database = Database(path, self.pragmas)
+                database.migrate(self.migrations)
+                self.databases[key] = database
+        return database
+
+    def create(self, path, month, tenant):
+        """
+        Новая партиция: схема и начало последовательностей id во временном файле, затем ссылка на него
+        под именем партиции — читатели (и другие процессы сервера) не видят файл без таблиц.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        database = Database(tmp, dict(self.pragmas or {}, journal_mode='DELETE'))
+        try:
+            database.migrate(self.migrations)
+            year, mon = int(month[:4]), int(month[5:7])
+            base = (year * 12 + mon - 1) << 48
+            if tenant:
+                base |= (zlib.crc32(tenant.encode()) & 0xFFFF) << 32
+            with database.connect() as conn:
+                for table in self.tables:
+                    conn.execute('INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? '
+                                 'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)', (table, base, table))
+        finally:
+            database.close_all()
+        try:
+            os.link(tmp, path)  # атомарно и без перезаписи, если партицию уже создал другой процесс
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+
+    def partitions(self, ts_from=None, ts_to=None, server_id=None):
+        """
+        [(месяц, каталог server_id или None, путь)] — существующие партиции, пересекающие [ts_from, ts_to],
+        новые сверху. Находятся файлы обеих раскладок (общие и по server_id), server_id отбирает каталоги.
+        """
+        found = []
+        wanted = tenant_dir(server_id) if server_id is not None else None
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                if wanted is not None and entry.name != wanted:
+                    continue
+                found += [(m.group(1), entry.name, Path(f.path)) for f in os.scandir(entry.path)
+                          for m in [PARTITION_FILE_RE.match(f.name)] if m]
+            else:
+                m = PARTITION_FILE_RE.match(entry.name)
+                if m:
+                    found.append((m.group(1), None, Path(entry.path)))
+        result = []
+        for month, tenant, path in found:
+            start, end = month_bounds(month)
+            if (ts_from is None or end > ts_from) and (ts_to is None or start <= ts_to):
+                result.append((month, tenant, path))
+        return sorted(result, key=lambda p: (p[0], p[1] or ''), reverse=True)
+
+    def query(self, sql, params=(), order='created_ts DESC, id DESC', key=None, limit=None,
+              ts_from=None, ts_to=None, server_id=None):
+        """
+        Запрос ко всем партициям диапазона: sql — SELECT без ORDER BY/LIMIT, {p} — схема партиции
+        (например, FROM {p}.messages). С limit — первые limit строк в порядке order (по убыванию,
+        key(row) — ключ сортировки в Python, первый элемент — created_ts): партиции читаются от новых
+        к старым и подключаются группами по MAX_ATTACH (UNION ALL с ORDER BY/LIMIT внутри SQLite),
+        старые месяцы не читаются, если страница уже набрана. Без limit — все строки всех партиций
+        (для агрегатов, которые затем суммирует вызывающий).
+        """
+        parts = self.partitions(ts_from, ts_to, server_id)
+        groups = [parts[i:i + self.MAX_ATTACH] for i in range(0, len(parts), self.MAX_ATTACH)]
+        results, collected = [], 0
+        for i, group in enumerate(groups):
+            rows = self.query_group(group, sql, list(params), order if limit else None, limit)
+            results.append(rows)
+            collected += len(rows)
+            # все строки следующих групп старше уже набранных — дальше читать не нужно
+            if limit and collected >= limit and i + 1 < len(groups) and groups[i + 1][0][0] < group[-1][0]:
+                break
+        if not limit:
+            return [row for rows in results for row in rows]
+        return list(heapq.merge(*results, key=key, reverse=True))[:limit]
+
+    def query_group(self, group, sql, params, order, limit):
+        conn = self.reader.connection()
+        names = []
+        try:
+            with self.lock:
+                # mode=ro: ATTACH удалённой партиции — ошибка, а не новый пустой файл без таблиц
+                for i, (_, _, path) in enumerate(group):
+                    if not path.exists():
+                        continue  # удалена после partitions()
+                    conn.execute(f'ATTACH DATABASE ? AS p{i}', (f'{path.resolve().as_uri()}?mode=ro',))
+                    names.append(f'p{i}')
+            if not names:
+                return []
+            tail = (f' ORDER BY {order}' if order else '') + (f' LIMIT {int(limit)}' if limit else '')
+            union = ' UNION ALL '.join(f"SELECT * FROM ({sql.replace('{p}', name)}{tail})" for name in names)
+            return conn.execute(union + tail, params * len(names)).fetchall()
+        finally:
+            for name in names:
+                conn.execute(f'DETACH DATABASE {name}')
+
+    def absorb(self, database, table, columns, batch=1000):
+        """
+        Перенести строки table из database (основная БД до партиционирования) в партиции:
+        id сохраняются, вставка INSERT OR IGNORE — прерванный перенос безопасно повторяется.
+        columns должны включать created_ts и server_id.
+        """
+        select = ', '.join(['id'] + columns)
+        insert = f"INSERT OR IGNORE INTO {table} ({select}) VALUES ({', '.join('?' * (len(columns) + 1))})"
+        ts_pos, server_pos = columns.index('created_ts') + 1, columns.index('server_id') + 1
+        moved = 0
+        while True:
+            with database.connect() as conn:
+                rows = conn.execute(f'SELECT {select} FROM {table} ORDER BY id LIMIT ?', (batch,)).fetchall()
+            if not rows:
+                break
+            targets = defaultdict(list)
+            for row in rows:
+                ts = row[ts_pos] if row[ts_pos] is not None else time.time()
+                targets[self.database(ts, row[server_pos])].append(row)
+            for target, items in targets.items():
+                with target.connect() as conn:
+                    conn.executemany(insert, items)
+            with database.connect() as conn:
+                conn.executemany(f'DELETE FROM {table} WHERE id = ?', [(row[0],) for row in rows])
+            moved += len(rows)
+        if moved:
+            logging.info(f'[db] {table}: {moved} записей перенесено в партиции')
+        return moved
+
+    def drop_before(self, month):
+        """
+        Удалить партиции старше месяца 'YYYY-MM' (файлы целиком); возвращает [(месяц, каталог)].
+        Вызывается в потоке группового коммита (GroupCommitWriter.call): соединения партиции, в том
+        числе соединение потока записи, закрываются до удаления файла, а записи, поставленные позже,
+        выбирают партицию уже после удаления. Файл, который удалить не удалось (на Windows — открыт
+        читающим запросом), остаётся и удаляется при следующем запуске.
+        """
+        dropped = []
+        with self.lock:
+            for part_month, tenant, path in self.partitions():
+                if part_month >= month:
+                    continue
+                database = self.databases.pop((part_month, tenant), None)
+                if database is not None:
+                    database.close_all()
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.warning(f'[db] Партиция не удалена: {path}: {e}')
+                    continue
+                for suffix in ('-wal', '-shm'):
+                    try:
+                        os.remove(f'{path}{suffix}')
+                    except OSError:
+                        pass
+                dropped.append((part_month, tenant))
+                logging.info(f'[db] Партиция удалена: {path}')
+        return dropped
+
+    def close_all(self):
+        with self.lock:
+            databases, self.databases = list(self.databases.values()), {}
+        for database in databases:
+            database.close_all()
+        self.reader.close_all()
@@ -5,23 +5,40 @@ from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Streamin
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from typing import Optional, List
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import shutil
+import re
 import sqlite3
 import json
 import yaml
 from pydantic import BaseModel
 import asyncio
 import threading
+import logging
 from starlette.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
 import csv
 import io
 import zipfile
 import openpyxl
 from openpyxl.utils import get_column_letter
 import time
+import queue
+import hashlib
+import base64
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from functools import partial
+from central_server.db import Database, GroupCommitWriter, PartitionSet, month_of, PARTITION_FILE_RE
 from central_server.integrations.webhook import send_webhook
 
+try:
+    import cv2
+    import numpy as np
+except ImportError:  # opencv не установлен — превью не строятся, отдаётся оригинал
+    cv2 = None
+
 """
 Central Screenshot Server (FastAPI)
 
@@ -30,9 +47,20 @@ REST API для масштабируемого сбора, хранения и 
 API:
 - POST   /upload_screenshot   (авторизация) — загрузка скриншота и метаданных
 - POST   /api/send_message    (авторизация) — отправка сообщения/лога/статуса
-- GET    /api/messages        (авторизация) — получение сообщений
+- GET    /api/messages        (авторизация) — получение сообщений (страницами: cursor, заголовок X-Next-Cursor)
 - GET    /api/get_commands    (авторизация) — получение команд для агента
 - POST   /api/command_result  (авторизация) — агент подтверждает выполнение команды
+- POST   /api/agents/heartbeat (авторизация) — регистрация агента и аренды устройств; GET /api/agents — агенты и аренды
+- POST   /api/artifacts/init, PUT /api/artifacts/{upload_id}/chunk, POST /api/artifacts/{upload_id}/complete (авторизация)
+         — возобновляемая загрузка артефактов (logcat, файлы) частями с проверкой sha256 (команда pull)
+- GET    /api/artifacts       (авторизация) — список артефактов, GET /download_artifact/{id} — скачать
+- GET    /api/ingest          (авторизация) — приём скринов: время по фазам, загрузки в обработке, отказы 503
+- POST   /api/schedule/plan   (авторизация) — фазы/джиттер съёмки устройств по пропускной способности приёма
+- POST   /api/telemetry       (авторизация) — пачка числовых метрик устройств (повтор batch_id пропускается); GET /api/telemetry — временной ряд
+- POST   /api/upload_frames   (авторизация) — пакет кадров из буфера агента (команда upload_frames)
+- GET    /api/frame_batches   (авторизация) — список пакетов кадров, GET /download_frames/{id} — скачать zip
+- GET    /api/partitions      (авторизация) — файлы партиций скринов/сообщений по месяцам; DELETE ?before=YYYY-MM — удалить старые
+- WS     /ws/agent            (авторизация) — постоянный канал агента: команды сразу, ack/result/heartbeat обратно
 - GET    /screenshots         (публично)    — список скринов (фильтрация)
 - GET    /download/...        (публично)    — скачать скрин
 - Web-интерфейс: /            — просмотр скринов, фильтры
@@ -46,6 +74,10 @@ API:
 DATA_DIR = Path(__file__).parent / 'data'
 DATA_DIR.mkdir(exist_ok=True)
 DB_PATH = Path(__file__).parent / 'db.sqlite3'
+# Соединения с БД: одно на поток, WAL и настроенные pragmas (central_server/db.py)
+db = Database(DB_PATH)
+# Помесячные файлы скринов и сообщений (central_server/db.py, PartitionSet)
+PARTITIONS_DIR = Path(__file__).parent / 'partitions'
 
 def get_config_path():
     env_path = os.environ.get('CONFIG_YAML')
@@ -53,6 +85,34 @@ def get_config_path():
         return Path(env_path)
     return Path(__file__).parent.parent / 'config.yaml'
 
+# Кэш config.yaml: файл перечитывается только после изменения (mtime/размер), а не на каждый запрос
+config_cache = {'key': None, 'cfg': None}
+config_lock = threading.Lock()
+
+def read_config() -> Optional[dict]:
+    """config.yaml сервера (кэш до изменения файла); None — файла нет. Ошибка YAML пробрасывается."""
+    config_path = get_config_path()
+    try:
+        st = config_path.stat()
+    except FileNotFoundError:
+        return None
+    key = (str(config_path), st.st_mtime_ns, st.st_size)
+    with config_lock:
+        if config_cache['key'] == key:
+            return config_cache['cfg']
+    with open(config_path, 'r', encoding='utf-8') as f:
+        cfg = yaml.safe_load(f) or {}
+    with config_lock:
+        config_cache.update(key=key, cfg=cfg)
+    return cfg
+
+def load_server_config() -> dict:
+    """config.yaml сервера; пустой словарь, если файла нет или он не разбирается."""
+    try:
+        return read_config() or {}
+    except yaml.YAMLError:
+        return {}
+
 # --- FastAPI ---
 app = FastAPI(title="Central Screenshot Server", description="Масштабируемый сервер для сбора и анализа скринов с множества агентов", version="1.0")
 
@@ -74,8 +134,12 @@ def check_role(required_roles):
     return dependency
 
 # --- БД (SQLite, если нужна история) ---
+# Прореживание телеметрии: имя таблицы -> шаг агрегата (сек); сколько дней хранить каждый уровень
+TELEMETRY_RESOLUTIONS = {'1m': 60, '1h': 3600}
+TELEMETRY_RETENTION_DAYS = {'raw': 2, '1m': 14, '1h': 365}
+
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
+    with db.connect() as conn:
         c = conn.cursor()
         c.execute('''CREATE TABLE IF NOT EXISTS screenshots (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -86,6 +150,10 @@ def init_db():
             meta TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )''')
+        # Миграция: тип содержимого скриншота (агент может отправлять PNG/JPEG/WebP)
+        columns = [r[1] for r in c.execute('PRAGMA table_info(screenshots)')]
+        if 'content_type' not in columns:
+            c.execute("ALTER TABLE screenshots ADD COLUMN content_type TEXT DEFAULT 'image/png'")
         c.execute('''CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             server_id TEXT,
@@ -103,15 +171,412 @@ def init_db():
             status TEXT DEFAULT 'pending',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )''')
+        # Пакеты кадров из буфера агента (команда upload_frames): zip с кадрами и manifest.json
+        c.execute('''CREATE TABLE IF NOT EXISTS frame_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id TEXT,
+            device_id TEXT,
+            command_id INTEGER,
+            filename TEXT,
+            frames INTEGER,
+            first_ts REAL,
+            last_ts REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        # Артефакты устройств (logcat, файлы), загружаемые частями с возобновлением
+        c.execute('''CREATE TABLE IF NOT EXISTS artifacts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            upload_id TEXT UNIQUE,
+            server_id TEXT,
+            device_id TEXT,
+            command_id INTEGER,
+            kind TEXT,
+            filename TEXT,
+            size INTEGER,
+            sha256 TEXT,
+            received INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'uploading',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        )''')
+        # Агенты и аренда устройств (lease): кто из агентов сейчас снимает устройство
+        c.execute('''CREATE TABLE IF NOT EXISTS agents (
+            agent_id TEXT PRIMARY KEY,
+            capacity INTEGER,
+            devices TEXT,
+            last_seen REAL,
+            registered_at REAL
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS leases (
+            device_id TEXT PRIMARY KEY,
+            agent_id TEXT,
+            expires_at REAL,
+            granted_at REAL,
+            draining INTEGER DEFAULT 0
+        )''')
+        # План съёмки: устройства и их интервалы, о которых сообщили агенты
+        c.execute('''CREATE TABLE IF NOT EXISTS schedule_devices (
+            device_id TEXT PRIMARY KEY,
+            agent_id TEXT,
+            interval REAL,
+            updated_at REAL
+        )''')
+        # Телеметрия устройств: сырые сэмплы и агрегаты по минутам/часам (ts — unix-время, секунды)
+        c.execute('''CREATE TABLE IF NOT EXISTS telemetry_raw (
+            server_id TEXT,
+            device_id TEXT,
+            metric TEXT,
+            ts INTEGER,
+            value REAL
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_raw ON telemetry_raw (device_id, metric, ts)')
+        for table in TELEMETRY_RESOLUTIONS:
+            c.execute(f'''CREATE TABLE IF NOT EXISTS telemetry_{table} (
+                server_id TEXT,
+                device_id TEXT,
+                metric TEXT,
+                bucket INTEGER,
+                cnt INTEGER,
+                total REAL,
+                vmin REAL,
+                vmax REAL,
+                PRIMARY KEY (device_id, metric, bucket, server_id)
+            ) WITHOUT ROWID''')
         conn.commit()
+    db.migrate(MIGRATIONS)
+    for table, columns in PARTITIONED_COLUMNS.items():
+        partitions.absorb(db, table, columns)
+
+# --- Версионные миграции схемы (PRAGMA user_version), применяются при старте после init_db ---
+# created_ts — unix-время создания записи (UTC, как created_at): фильтры по дате и сортировка идут
+# по индексам с этой колонкой, а не по строковому created_at
+EPOCH_TABLES = ['screenshots', 'messages', 'commands']
+
+def epoch_columns_migration():
+    steps = []
+    for table in EPOCH_TABLES:
+        steps += [
+            f'ALTER TABLE {table} ADD COLUMN created_ts INTEGER',
+            f"UPDATE {table} SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)",
+            # запись без created_ts (вставка не через обработчики сервера) получает его из created_at
+            f'''CREATE TRIGGER IF NOT EXISTS {table}_created_ts AFTER INSERT ON {table} WHEN NEW.created_ts IS NULL
+                BEGIN UPDATE {table} SET created_ts = CAST(strftime('%s', NEW.created_at) AS INTEGER) WHERE id = NEW.id; END'''
+        ]
+    return steps
+
+# Полнотекстовый поиск: таблица -> колонки индекса FTS5 (external content: текст не дублируется,
+# индекс обновляется триггерами на insert/update/delete исходной таблицы)
+FTS_COLUMNS = {
+    'screenshots': ['filename', 'meta'],
+    'messages': ['message'],
+    'commands': ['command', 'params', 'status', 'server_id', 'device_id'],
+}
+
+def fts_migration(tables=tuple(FTS_COLUMNS)):
+    steps = []
+    for table in tables:
+        columns = FTS_COLUMNS[table]
+        cols = ', '.join(columns)
+        new_values = ', '.join(f'new.{c}' for c in columns)
+        old_values = ', '.join(f'old.{c}' for c in columns)
+        steps += [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({cols}, content='{table}', content_rowid='id', prefix='2 3')",
+            f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table}
+                BEGIN INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.id, {new_values}); END''',
+            f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table}
+                BEGIN INSERT INTO {table}_fts ({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_values}); END''',
+            f'''CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE OF {cols} ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.id, {new_values}); END''',
+            f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')"
+        ]
+    return steps
+
+# Поля формы агента, сохраняемые отдельными колонками screenshots (раньше терялись или лежали в meta)
+SCREENSHOT_META_COLUMNS = ['section', 'device_name', 'ip', 'port']
+
+MIGRATIONS = [
+    (1, 'created_ts (unix time) в screenshots, messages, commands', epoch_columns_migration()),
+    (2, 'составные индексы под фильтры и сортировку списков', [
+        # /screenshots, /api/last_screenshot: фильтр по серверу/окну/устройству, новые сверху
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_server_device_ts ON screenshots (server_id, device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_server_window_ts ON screenshots (server_id, window, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_device_ts ON screenshots (device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_ts ON screenshots (created_ts)',
+        # /api/messages, /logs, аналитика ошибок
+        'CREATE INDEX IF NOT EXISTS idx_messages_server_device_ts ON messages (server_id, device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_device_ts ON messages (device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_type_ts ON messages (type, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (created_ts)',
+        # /api/get_commands (опрос каждого устройства) и /api/get_commands_bulk, история команд
+        'CREATE INDEX IF NOT EXISTS idx_commands_server_device_status_ts ON commands (server_id, device_id, status, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_commands_server_status_ts ON commands (server_id, status, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_commands_device_ts ON commands (device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_commands_ts ON commands (created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_frame_batches_device ON frame_batches (device_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_artifacts_device ON artifacts (device_id, id)',
+        'ANALYZE'
+    ]),
+    (3, 'полнотекстовый поиск (FTS5) по скринам, сообщениям и командам', fts_migration()),
+    (4, 'колонки section, device_name, ip, port в screenshots (из формы агента и meta)', [
+        *[f'ALTER TABLE screenshots ADD COLUMN {column} TEXT' for column in SCREENSHOT_META_COLUMNS],
+        # заполнение из meta (JSON); секция без meta.section — окно, как раньше показывал /screenshots
+        f'''UPDATE screenshots SET
+            {', '.join(f"{c} = CASE WHEN json_valid(meta) THEN json_extract(meta, '$.{c}') END" for c in SCREENSHOT_META_COLUMNS)}''',
+        'UPDATE screenshots SET section = window WHERE section IS NULL',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_server_section_ts ON screenshots (server_id, section, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_section_ts ON screenshots (section, created_ts)',
+    ]),
+    (5, 'указатель на последний скрин устройства (вместо копии <device>_last.<ext>)', [
+        '''CREATE TABLE IF NOT EXISTS last_screenshots (
+            server_id TEXT,
+            window TEXT,
+            device_id TEXT,
+            blob TEXT,
+            content_type TEXT,
+            filename TEXT,
+            created_ts INTEGER,
+            PRIMARY KEY (server_id, window, device_id)
+        ) WITHOUT ROWID''',
+    ]),
+    (6, 'аренды и план съёмки по (scope, device_id): локальные серийники (emulator-5554, 127.0.0.1:5555) разных хостов не совпадают', [
+        'ALTER TABLE agents ADD COLUMN server_id TEXT',
+        'ALTER TABLE agents ADD COLUMN host TEXT',
+        # аренды и план — состояние на минуты, агенты восстанавливают его следующим heartbeat/запросом плана
+        'DROP TABLE IF EXISTS leases',
+        '''CREATE TABLE leases (
+            scope TEXT,
+            device_id TEXT,
+            agent_id TEXT,
+            expires_at REAL,
+            granted_at REAL,
+            draining INTEGER DEFAULT 0,
+            PRIMARY KEY (scope, device_id)
+        )''',
+        'DROP TABLE IF EXISTS schedule_devices',
+        '''CREATE TABLE schedule_devices (
+            scope TEXT,
+            device_id TEXT,
+            agent_id TEXT,
+            interval REAL,
+            updated_at REAL,
+            PRIMARY KEY (scope, device_id)
+        )''',
+    ]),
+    (7, 'принятые пачки телеметрии (повтор пачки не учитывается в агрегатах дважды)', [
+        '''CREATE TABLE IF NOT EXISTS telemetry_batches (
+            batch_id TEXT PRIMARY KEY,
+            received_ts INTEGER
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_telemetry_batches_ts ON telemetry_batches (received_ts)',
+    ]),
+]
+
+# --- Партиции: скрины и сообщения в файлах partitions/YYYY-MM.sqlite3 (или partitions/<server_id>/YYYY-MM.sqlite3) ---
+# В основной БД остаются команды, агенты, артефакты и прочие небольшие таблицы; строки screenshots/messages,
+# записанные до партиционирования, переносятся в партиции при старте (PartitionSet.absorb)
+PARTITIONED_COLUMNS = {
+    'screenshots': ['server_id', 'window', 'device_id', 'filename', 'meta', 'content_type', 'created_at', 'created_ts', *SCREENSHOT_META_COLUMNS],
+    'messages': ['server_id', 'device_id', 'type', 'message', 'created_at', 'created_ts'],
+}
+
+PARTITION_MIGRATIONS = [
+    (1, 'скрины и сообщения за месяц', [
+        '''CREATE TABLE IF NOT EXISTS screenshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id TEXT,
+            window TEXT,
+            device_id TEXT,
+            filename TEXT,
+            meta TEXT,
+            content_type TEXT DEFAULT 'image/png',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_ts INTEGER,
+            section TEXT,
+            device_name TEXT,
+            ip TEXT,
+            port TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id TEXT,
+            device_id TEXT,
+            type TEXT,
+            message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_ts INTEGER
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_server_device_ts ON screenshots (server_id, device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_server_window_ts ON screenshots (server_id, window, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_server_section_ts ON screenshots (server_id, section, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_device_ts ON screenshots (device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_section_ts ON screenshots (section, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_ts ON screenshots (created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_server_device_ts ON messages (server_id, device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_device_ts ON messages (device_id, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_type_ts ON messages (type, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (created_ts)',
+        *fts_migration(PARTITIONED_COLUMNS),
+    ]),
+    (2, 'blob (sha256 содержимого) скрина и поиск по имени файла', [
+        'ALTER TABLE screenshots ADD COLUMN blob TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_screenshots_file ON screenshots (server_id, window, filename)',
+    ]),
+]
+
+def partition_settings() -> dict:
+    """
+    Секция partitions config.yaml: by_server_id — отдельный каталог файлов на каждый server_id,
+    retention_months — сколько месяцев истории хранить (включая текущий, 0 — без ограничения).
+    """
+    settings = load_server_config().get('partitions') or {}
+    return {'by_server_id': bool(settings.get('by_server_id', False)),
+            'retention_months': int(settings.get('retention_months', 0) or 0)}
+
+def retention_cutoff(months: int, now: Optional[float] = None) -> str:
+    """Первый хранимый месяц ('YYYY-MM'), если хранить months месяцев включая текущий."""
+    current = month_of(time.time() if now is None else now)
+    index = int(current[:4]) * 12 + int(current[5:7]) - 1 - (months - 1)
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+def apply_retention():
+    """Удалить партиции старше retention_months (в потоке группового коммита, после записанной очереди)."""
+    months = partition_settings()['retention_months']
+    if months > 0:
+        dropped = writes.call(partial(partitions.drop_before, retention_cutoff(months))).result(timeout=60)
+        if dropped:
+            collect_blobs()
+        return dropped
+    return []
+
+RETENTION_INTERVAL = 3600  # сек: как часто проверять retention_months (новый месяц — не позже чем через час)
+retention_stopped = threading.Event()
+
+def retention_loop():
+    # не на пути приёма: удаление файлов и ошибки удаления не задерживают и не роняют загрузку скринов
+    while True:
+        try:
+            apply_retention()
+        except Exception as e:
+            logging.error(f'[retention] Ошибка удаления старых партиций: {e}')
+        if retention_stopped.wait(RETENTION_INTERVAL):
+            return
+
+def partition_for(created_ts: float, server_id: str):
+    """
+    БД партиции для новой записи — функция для writes.submit(database=...): партиция выбирается
+    в потоке записи, поэтому запись не попадёт в файл, удалённый между выбором и записью.
+    """
+    return partial(partitions.database, created_ts, server_id)
+
+def utc_now():
+    """(unix time, строка как CURRENT_TIMESTAMP) — для created_ts/created_at новой записи."""
+    ts = int(time.time())
+    return ts, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
+
+def to_epoch(value: str) -> Optional[int]:
+    """ISO-дата/время (без зоны — UTC, как created_at) в unix time; None, если строку не разобрать."""
+    try:
+        dt = datetime.fromisoformat(value.strip())
+    except (ValueError, AttributeError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def created_range_sql(created_at_from: Optional[str], created_at_to: Optional[str]):
+    """Условия по дате создания: по индексируемому created_ts, нераспознанная строка — по created_at как раньше."""
+    cond, params = [], []
+    for value, op in ((created_at_from, '>='), (created_at_to, '<=')):
+        if not value:
+            continue
+        ts = to_epoch(value)
+        if ts is None:
+            cond.append(f'created_at {op} ?')
+            params.append(value)
+        else:
+            cond.append(f'created_ts {op} ?')
+            params.append(ts)
+    return cond, params
+
+def fts_query(text: str) -> Optional[str]:
+    """
+    Строка поиска -> запрос FTS5: текст в кавычках — фраза целиком, иначе все слова по префиксу (AND).
+    None — в строке нет слов (только знаки), тогда поиск идёт через LIKE.
+    """
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] == '"':
+        phrase = text[1:-1].replace('"', '""')
+        return f'"{phrase}"' if any(ch.isalnum() for ch in phrase) else None
+    words = [w.replace('"', '""') for w in text.split() if any(ch.isalnum() for ch in w)]
+    return ' '.join(f'"{w}"*' for w in words) or None
+
+# --- Курсорная пагинация (keyset): страница — записи «раньше» последней записи предыдущей страницы ---
+MAX_PAGE_SIZE = 5000
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+def encode_cursor(*key) -> str:
+    """Непрозрачный курсор из ключа последней записи страницы (например, created_ts, id)."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def keyset_sql(cursor: Optional[str], columns=('created_ts', 'id')):
+    """Условие «после курсора» при сортировке по columns DESC; страница читается по индексу без OFFSET."""
+    if not cursor:
+        return [], []
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if len(key) != len(columns) or not all(isinstance(v, int) for v in key):
+            raise ValueError
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    return [f"({', '.join(columns)}) < ({', '.join('?' * len(columns))})"], list(key)
+
+def page_limit(limit: int) -> int:
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+def partition_range(created_at_from: Optional[str], created_at_to: Optional[str], keyset_params=()):
+    """Границы created_ts запроса (None — без границы) для выбора партиций; курсор ограничивает сверху."""
+    ts_from = to_epoch(created_at_from) if created_at_from else None
+    ts_to = to_epoch(created_at_to) if created_at_to else None
+    if keyset_params:
+        ts_to = keyset_params[0] if ts_to is None else min(ts_to, keyset_params[0])
+    return ts_from, ts_to
+
+def text_search_sql(table: str, text: str, schema: str = ''):
+    """
+    Условие поиска по тексту: через FTS5-индекс таблицы, без слов в строке — LIKE по тем же колонкам.
+    schema — префикс таблицы индекса ('{p}.' для запроса к партициям).
+    """
+    match = fts_query(text)
+    if match is not None:
+        return f'id IN (SELECT rowid FROM {schema}{table}_fts WHERE {table}_fts MATCH ?)', [match]
+    columns = FTS_COLUMNS[table]
+    return '(' + ' OR '.join(f'{c} LIKE ?' for c in columns) + ')', [f'%{text}%'] * len(columns)
+
+partitions = PartitionSet(PARTITIONS_DIR, PARTITION_MIGRATIONS, PARTITIONED_COLUMNS, by_tenant=partition_settings()['by_server_id'])
 init_db()
 
+# Групповой коммит вставок сообщений и строк скринов (одна транзакция на пачку записей)
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_DELAY = 0.02  # сек: максимальная задержка записи ради пачки
+writes = GroupCommitWriter(db, max_batch=WRITE_BATCH_SIZE, max_delay=WRITE_BATCH_DELAY)
+writes.start()
+threading.Thread(target=retention_loop, daemon=True, name='retention').start()
+
+@app.on_event('shutdown')
+def close_db():
+    # Дописать очередь группового коммита, затем закрыть соединения всех потоков:
+    # WAL переносится в db.sqlite3, файлы -wal/-shm удаляются
+    retention_stopped.set()
+    ingest_executor.shutdown(wait=True)
+    writes.stop()
+    partitions.close_all()
+    db.close_all()
+
 # --- Ролевая модель ---
 def get_user_role(api_key: str) -> str:
-    config_path = get_config_path()
-    if config_path.exists():
-        with open(config_path, 'r', encoding='utf-8') as f:
-            cfg = yaml.safe_load(f) or {}
+    cfg = read_config()
+    if cfg is not None:
         for user in cfg.get('users', []):
             if user.get('api_key') == api_key:
                 return user.get('role', 'user')
@@ -122,11 +587,7 @@ def get_user_role(api_key: str) -> str:
 
 # --- Универсальный хук событий для интеграций ---
 def call_integrations(event: str, data: dict):
-    config_path = get_config_path()
-    if not config_path.exists():
-        return
-    with open(config_path, 'r', encoding='utf-8') as f:
-        cfg = yaml.safe_load(f) or {}
+    cfg = load_server_config()
     modules = cfg.get('modules', {})
     # Webhook
     if modules.get('webhook'):
@@ -149,6 +610,263 @@ def call_integrations(event: str, data: dict):
         except Exception as e:
             pass
 
+# --- Форматы скриншотов: content-type <-> расширение файла ---
+IMAGE_TYPES = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp'}
+
+def media_type_for(path) -> str:
+    suffix = Path(path).suffix.lower()
+    for content_type, ext in IMAGE_TYPES.items():
+        if ext == suffix:
+            return content_type
+    return 'image/png'
+
+# --- Хранилище скринов по содержимому: DATA_DIR/.blobs/<ab>/<sha256>.<ext> ---
+# Одинаковые кадры (в том числе с разных устройств) хранятся одним файлом; строка screenshots ссылается
+# на sha256 (колонка blob), последний скрин устройства — указатель в last_screenshots.
+# Скрины, сохранённые раньше, остаются файлами DATA_DIR/<server_id>/<window>/ и отдаются как прежде.
+BLOBS_DIR = DATA_DIR / '.blobs'
+BLOB_CHUNK_SIZE = 1024 * 1024
+BLOB_GC_GRACE = 3600  # сек: blob моложе не удаляется сборкой мусора (строка скрина может быть ещё не записана)
+blob_lock = threading.Lock()  # сохранение blob и его удаление сборкой мусора не перемежаются
+
+def blob_path(sha256: str, content_type: str) -> Path:
+    return BLOBS_DIR / sha256[:2] / f"{sha256}{IMAGE_TYPES.get(content_type, '.png')}"
+
+def store_blob(source, content_type: str):
+    """
+    Сохранить загрузку (файловый объект) как blob: sha256 считается при потоковой записи во временный файл,
+    затем файл переносится под своим хэшем; если такой кадр уже есть, временный файл удаляется.
+    Возвращает (sha256, путь blob).
+    """
+    tmp_dir = BLOBS_DIR / '.tmp'
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while chunk := source.read(BLOB_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256, content_type)
+        with blob_lock:
+            if path.exists():
+                # свежее mtime: сборка мусора не удалит кадр, строка которого ещё в очереди записи
+                os.utime(path)
+                os.remove(tmp)
+            else:
+                path.parent.mkdir(exist_ok=True)
+                os.replace(tmp, path)
+        return sha256, path
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+# --- Уменьшенные копии скринов (rendition): thumb — карточки галереи, preview — просмотр ---
+# Строятся при первом запросе (?rendition=thumb|preview) и кэшируются рядом с blob:
+# .blobs/<ab>/<sha256>.<rendition>.webp — содержимое blob не меняется, поэтому кэш не устаревает.
+# Скрины до хранилища blob и недекодируемые файлы отдаются оригиналом.
+RENDITIONS = {
+    'thumb': {'max_dim': 440, 'quality': 70},
+    'preview': {'max_dim': 1280, 'quality': 80},
+}
+
+def rendition_path(sha256: str, rendition: str) -> Path:
+    return BLOBS_DIR / sha256[:2] / f'{sha256}.{rendition}.webp'
+
+def make_rendition(source: Path, sha256: str, rendition: str) -> Optional[Path]:
+    """Уменьшенная WebP-копия blob (кэш на диске); None — нет opencv или файл не декодируется."""
+    target = rendition_path(sha256, rendition)
+    if target.exists():
+        return target
+    if cv2 is None:
+        return None
+    spec = RENDITIONS[rendition]
+    img = cv2.imdecode(np.fromfile(str(source), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    scale = spec['max_dim'] / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode('.webp', img, [cv2.IMWRITE_WEBP_QUALITY, spec['quality']])
+    if not ok:
+        return None
+    # запись через временный файл: параллельный запрос того же превью не увидит недописанный файл
+    tmp = target.with_name(f'.{target.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    buf.tofile(str(tmp))
+    os.replace(tmp, target)
+    return target
+
+def collect_blobs(now: Optional[float] = None) -> int:
+    """
+    Сборка мусора после удаления партиций: удалить blob, на которые не ссылаются ни оставшиеся
+    партиции, ни last_screenshots, вместе с их rendition. Возвращает число удалённых файлов.
+    """
+    referenced = {row[0] for row in partitions.query('SELECT DISTINCT blob FROM {p}.screenshots WHERE blob IS NOT NULL')}
+    with db.connect() as conn:
+        referenced.update(row[0] for row in conn.execute('SELECT DISTINCT blob FROM last_screenshots WHERE blob IS NOT NULL'))
+    deadline = (time.time() if now is None else now) - BLOB_GC_GRACE
+    removed = 0
+    if not BLOBS_DIR.exists():
+        return 0
+    for bucket in os.scandir(BLOBS_DIR):
+        if not bucket.is_dir() or bucket.name.startswith('.'):
+            continue  # .tmp — недописанные загрузки
+        for entry in os.scandir(bucket.path):
+            name = entry.name
+            if name.startswith('.') or name.split('.')[0] in referenced:
+                continue
+            # rendition строится только для кадра со строкой в БД — без ссылок её можно удалять сразу
+            rendition = name.endswith('.webp') and name.split('.')[1] in RENDITIONS
+            with blob_lock:
+                try:
+                    if rendition or os.stat(entry.path).st_mtime < deadline:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    pass
+    if removed:
+        logging.info(f'[blobs] Удалено файлов без ссылок: {removed}')
+    return removed
+
+def check_rendition(rendition: Optional[str]) -> Optional[str]:
+    if rendition in (None, '', 'original'):
+        return None
+    if rendition not in RENDITIONS:
+        raise HTTPException(status_code=400, detail=f"rendition: {', '.join(['original', *RENDITIONS])}")
+    return rendition
+
+def image_response(request: Request, path: Path, media_type: str, etag: Optional[str] = None, cache_control: str = 'no-cache'):
+    """Файл изображения с ETag: повторный запрос с If-None-Match получает 304 без тела."""
+    headers = {'Cache-Control': cache_control}
+    if etag:
+        headers['ETag'] = etag
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=304, headers=headers)
+    return FileResponse(str(path), media_type=media_type, headers=headers)
+
+def blob_response(request: Request, sha256: str, content_type: str, rendition: Optional[str], cache_control: str = 'no-cache'):
+    path = blob_path(sha256, content_type)
+    if not path.exists():
+        return JSONResponse({"error": "not found"}, status_code=404)
+    if rendition:
+        rendered = make_rendition(path, sha256, rendition)
+        if rendered is not None:
+            path, content_type = rendered, 'image/webp'
+    return image_response(request, path, content_type, f'"{sha256}-{rendition or "original"}"', cache_control)
+
+def screenshot_file(s: dict) -> Path:
+    """Файл скрина из списка query_screenshots: blob или (старые записи) файл в каталоге окна."""
+    if s.get('blob'):
+        return blob_path(s['blob'], s['content_type'])
+    return DATA_DIR / s['server_id'] / s['window'] / s['filename']
+
+def filename_range(filename: str):
+    """Границы created_ts по дате в имени файла (<device>_YYYY-MM-DD_HH-MM-SS[-mmm_<blob>].<ext>, локальное время сервера) с запасом в сутки."""
+    m = re.search(r'_(\d{4}-\d{2}-\d{2})_\d{2}-\d{2}-\d{2}(?:-\d{3}_[0-9a-f]+)?\.\w+$', filename)
+    ts = to_epoch(m.group(1)) if m else None
+    if ts is None:
+        return None, None
+    return ts - 86400, ts + 2 * 86400
+
+def find_last_path(save_dir: Path, safe_device: str) -> Optional[Path]:
+    for ext in IMAGE_TYPES.values():
+        path = save_dir / f"{safe_device}_last{ext}"
+        if path.exists():
+            return path
+    return None
+
+# --- Наблюдаемая пропускная способность приёма скринов (для плана съёмки) ---
+class IngestStats:
+    """
+    Скользящее среднее (EWMA) времени обработки одной загрузки скрина и её фаз:
+    queue — ожидание свободного потока приёма, store — запись и sha256 файла, db — постановка строк
+    в очередь записи (с durable — до коммита), integrations — вызов интеграций.
+    inflight — загрузки, принятые обработчиком и ещё не завершённые (меняется только в event loop).
+    """
+    def __init__(self, alpha: float = 0.05, initial: float = 0.05):
+        self.alpha = alpha
+        self.avg_seconds = initial
+        self.phases = {}
+        self.count = 0
+        self.inflight = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float, phases: Optional[dict] = None):
+        with self.lock:
+            self.avg_seconds += self.alpha * (seconds - self.avg_seconds)
+            for name, value in (phases or {}).items():
+                avg = self.phases.get(name, value)
+                self.phases[name] = avg + self.alpha * (value - avg)
+            self.count += 1
+
+    def phases_ms(self) -> dict:
+        with self.lock:
+            return {name: round(value * 1000, 3) for name, value in self.phases.items()}
+
+ingest_stats = IngestStats()
+
+# --- Приём скринов вне event loop: файл, sha256 и строки БД — в отдельном пуле потоков ---
+# Потоков — global.ingest_concurrency (config.yaml, по умолчанию 4); сверх INGEST_MAX_PENDING
+# одновременных загрузок сервер отвечает 503 с Retry-After (агент повторит отправку из spool)
+INGEST_WORKERS = max(1, int((load_server_config().get('global') or {}).get('ingest_concurrency', 4)))
+INGEST_MAX_PENDING = max(INGEST_WORKERS, int((load_server_config().get('global') or {}).get('ingest_queue', 64)))
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+
+def server_timing(timings: dict) -> str:
+    """Заголовок Server-Timing (мс по фазам) — видно в DevTools и логах агента."""
+    return ', '.join(f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items())
+
+def ingest_screenshot(source, server_id: str, window: str, device_id: str, meta: Optional[str], fields: dict,
+                      content_type: str, durable: bool, queued: float):
+    """Приём одного скрина в потоке ingest_executor; возвращает (ответ, время фаз в секундах)."""
+    started = time.perf_counter()
+    timings = {'queue': started - queued}
+    now = datetime.now()
+    # Содержимое — один раз в blob по sha256 (повторный кадр не записывается), last — указатель в БД вместо копии
+    blob, save_path = store_blob(source, content_type)
+    # Имя файла (для ссылок /download): device_id_YYYY-MM-DD_HH-MM-SS-mmm_<начало blob>.<ext> —
+    # разные кадры устройства в одну секунду (и даже миллисекунду) получают разные имена
+    safe_device = device_id.replace(':', '_').replace('/', '_')
+    filename = f"{safe_device}_{now.strftime('%Y-%m-%d_%H-%M-%S')}-{now.microsecond // 1000:03d}_{blob[:12]}{IMAGE_TYPES[content_type]}"
+    mark = time.perf_counter()
+    timings['store'] = mark - started
+    # Строки в БД — через групповой коммит (при заполненной очереди записи поток ждёт); durable — до коммита
+    created_ts, created_at = utc_now()
+    written = [
+        writes.submit('''INSERT INTO screenshots (server_id, window, device_id, filename, meta, content_type, created_at, created_ts,
+                         section, device_name, ip, port, blob) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (server_id, window, device_id, filename, meta or "", content_type, created_at, created_ts,
+                       fields['section'], fields['device_name'], fields['ip'], fields['port'], blob),
+                      database=partition_for(created_ts, server_id)),
+        writes.submit('''INSERT INTO last_screenshots (server_id, window, device_id, blob, content_type, filename, created_ts)
+                         VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (server_id, window, device_id) DO UPDATE SET
+                         blob = excluded.blob, content_type = excluded.content_type, filename = excluded.filename, created_ts = excluded.created_ts
+                         WHERE excluded.created_ts >= last_screenshots.created_ts''',
+                      (server_id, window, device_id, blob, content_type, filename, created_ts)),
+    ]
+    if durable:
+        for future in written:
+            future.result(timeout=30)
+    timings['db'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    call_integrations('screenshot_uploaded', {
+        'server_id': server_id,
+        'window': window,
+        'device_id': device_id,
+        'filename': filename,
+        'meta': meta,
+        'section': fields['section'],
+        'content_type': content_type,
+        'created_at': now
+    })
+    timings['integrations'] = time.perf_counter() - mark
+    ingest_stats.observe(time.perf_counter() - started, timings)
+    timings['total'] = time.perf_counter() - queued
+    return {"status": "ok", "path": str(save_path), "blob": blob, "last": f"/download_last/{server_id}/{window}/{device_id}"}, timings
+
 # --- API: загрузка скрина ---
 @app.post("/upload_screenshot")
 async def upload_screenshot(
@@ -156,41 +874,313 @@ async def upload_screenshot(
     window: str = Form(...),
     device_id: str = Form(...),
     meta: Optional[str] = Form(None),
+    section: Optional[str] = Form(None),
+    device_name: Optional[str] = Form(None),
+    ip: Optional[str] = Form(None),
+    port: Optional[str] = Form(None),
     image: UploadFile = File(...),
+    durable: bool = Query(False),
+    token: str = Depends(check_role(['admin', 'user']))
+):
+    # Обратное давление: очередь приёма полна — отказ сразу, а не ожидание с занятой памятью и соединением
+    if ingest_stats.inflight >= INGEST_MAX_PENDING:
+        ingest_stats.rejected += 1
+        raise HTTPException(status_code=503, detail='Ingest queue is full', headers={'Retry-After': '1'})
+    # Поля для фильтров — в отдельные колонки; без полей формы — из meta (старые агенты), секция по умолчанию — окно
+    fields = {'section': section, 'device_name': device_name, 'ip': ip, 'port': port}
+    if meta and not all(fields.values()):
+        try:
+            meta_dict = json.loads(meta)
+        except ValueError:
+            meta_dict = {}
+        if isinstance(meta_dict, dict):
+            for key, value in fields.items():
+                if not value and meta_dict.get(key) not in (None, ''):
+                    fields[key] = str(meta_dict[key])
+    fields['section'] = fields['section'] or window
+    # Формат определяем по content-type (агент может перекодировать в JPEG/WebP), по умолчанию PNG
+    content_type = image.content_type if image.content_type in IMAGE_TYPES else 'image/png'
+    # Запись файла, хэш и БД — в пуле ingest_executor: медленный диск не останавливает event loop
+    ingest_stats.inflight += 1
+    try:
+        result, timings = await asyncio.get_running_loop().run_in_executor(
+            ingest_executor, ingest_screenshot, image.file, server_id, window, device_id, meta, fields,
+            content_type, durable, time.perf_counter())
+    finally:
+        ingest_stats.inflight -= 1
+    return JSONResponse(result, headers={'Server-Timing': server_timing(timings)})
+
+@app.get('/api/ingest')
+def ingest_status(token: str = Depends(check_role(['admin', 'user', 'readonly']))):
+    """Приём скринов: среднее время и фазы (мс), загрузки в обработке, отказы 503, очередь записи в БД."""
+    return {
+        'avg_ms': round(ingest_stats.avg_seconds * 1000, 2),
+        'phases_ms': ingest_stats.phases_ms(),
+        'count': ingest_stats.count,
+        'inflight': ingest_stats.inflight,
+        'max_pending': INGEST_MAX_PENDING,
+        'workers': INGEST_WORKERS,
+        'rejected': ingest_stats.rejected,
+        'write_queue': writes.queue.qsize(),
+    }
+
+# --- API: пакет кадров из буфера агента (ответ на команду upload_frames) ---
+@app.post("/api/upload_frames")
+def upload_frames(
+    server_id: str = Form(...),
+    device_id: str = Form(...),
+    command_id: Optional[int] = Form(None),
+    archive: UploadFile = File(...),
     token: str = Depends(check_role(['admin', 'user']))
 ):
-    # Формируем путь: data/server_id/window/
-    save_dir = DATA_DIR / server_id / window
+    save_dir = DATA_DIR / server_id / 'frames'
     save_dir.mkdir(parents=True, exist_ok=True)
-    # Имя файла: device_id_YYYY-MM-DD_HH-MM-SS.png
-    now = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     safe_device = device_id.replace(':', '_').replace('/', '_')
-    filename = f"{safe_device}_{now}.png"
+    filename = f"{safe_device}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{command_id or 0}.zip"
     save_path = save_dir / filename
     with open(save_path, "wb") as f:
-        shutil.copyfileobj(image.file, f)
-    # Сохраняем last.png (перезапись)
-    last_path = save_dir / f"{safe_device}_last.png"
-    shutil.copyfile(save_path, last_path)
-    # Сохраняем в БД
-    with sqlite3.connect(DB_PATH) as conn:
+        shutil.copyfileobj(archive.file, f)
+    try:
+        with zipfile.ZipFile(save_path) as zf:
+            manifest = json.loads(zf.read('manifest.json'))
+    except (zipfile.BadZipFile, KeyError, ValueError):
+        manifest = None
+    # манифест — список кадров {file, ts}; без ts кадр нельзя отнести ко времени
+    if not isinstance(manifest, list) or not all(isinstance(f, dict) and isinstance(f.get('ts'), (int, float)) for f in manifest):
+        save_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail='Invalid frames archive')
+    timestamps = [f['ts'] for f in manifest]
+    with db.connect() as conn:
         c = conn.cursor()
-        c.execute('INSERT INTO screenshots (server_id, window, device_id, filename, meta) VALUES (?, ?, ?, ?, ?)',
-                  (server_id, window, device_id, filename, meta or ""))
+        c.execute('INSERT INTO frame_batches (server_id, device_id, command_id, filename, frames, first_ts, last_ts) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                  (server_id, device_id, command_id, filename, len(manifest), min(timestamps, default=None), max(timestamps, default=None)))
         conn.commit()
-    call_integrations('screenshot_uploaded', {
+        batch_id = c.lastrowid
+    call_integrations('frames_uploaded', {
         'server_id': server_id,
-        'window': window,
         'device_id': device_id,
-        'filename': filename,
-        'meta': meta,
-        'created_at': now
+        'command_id': command_id,
+        'frames': len(manifest),
+        'filename': filename
+    })
+    return {"status": "ok", "id": batch_id, "frames": len(manifest)}
+
+@app.get("/api/frame_batches")
+def list_frame_batches(response: Response, server_id: Optional[str] = None, device_id: Optional[str] = None, limit: int = Query(100), cursor: Optional[str] = None,
+                       token: str = Depends(check_role(['admin', 'user', 'readonly']))):
+    query = "SELECT id, server_id, device_id, command_id, filename, frames, first_ts, last_ts, created_at FROM frame_batches WHERE 1=1"
+    params = []
+    if server_id:
+        query += " AND server_id=?"
+        params.append(server_id)
+    if device_id:
+        query += " AND device_id=?"
+        params.append(device_id)
+    keyset, keyset_params = keyset_sql(cursor, ('id',))
+    query += ''.join(f" AND {c}" for c in keyset)
+    params.extend(keyset_params)
+    limit = page_limit(limit)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    with db.connect() as conn:
+        rows = conn.execute(query, params).fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1][0])
+    keys = ['id', 'server_id', 'device_id', 'command_id', 'filename', 'frames', 'first_ts', 'last_ts', 'created_at']
+    return [dict(zip(keys, r)) for r in rows]
+
+@app.get("/download_frames/{batch_id}")
+def download_frames(batch_id: int, token: str = Depends(check_role(['admin', 'user', 'readonly']))):
+    with db.connect() as conn:
+        row = conn.execute('SELECT server_id, filename FROM frame_batches WHERE id=?', (batch_id,)).fetchone()
+    if not row or not (DATA_DIR / row[0] / 'frames' / row[1]).exists():
+        return JSONResponse({"error": "not found"}, status_code=404)
+    return FileResponse(str(DATA_DIR / row[0] / 'frames' / row[1]), media_type='application/zip', filename=row[1])
+
+# --- API: артефакты устройств, загрузка частями с возобновлением ---
+# Незавершённые загрузки — DATA_DIR/.uploads/<upload_id>.part; после проверки sha256 всего файла
+# он атомарно (os.replace) переносится в DATA_DIR/<server_id>/artifacts/.
+UPLOADS_DIR = DATA_DIR / '.uploads'
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+class ArtifactInitIn(BaseModel):
+    upload_id: str
+    server_id: str
+    device_id: str
+    command_id: Optional[int] = None
+    kind: str = 'file'
+    filename: str
+    size: int
+    sha256: str
+
+def artifact_row(upload_id: str):
+    if not upload_id.isalnum():
+        raise HTTPException(status_code=400, detail='Invalid upload_id')
+    with db.connect() as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute('SELECT * FROM artifacts WHERE upload_id=?', (upload_id,)).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail='Upload not found')
+    return dict(row)
+
+@app.post('/api/artifacts/init')
+def artifact_init(req: ArtifactInitIn, token: str = Depends(check_role(['admin', 'user']))):
+    """Начать загрузку или продолжить существующую (тот же upload_id): ответ — принятое смещение."""
+    if not req.upload_id.isalnum() or req.size < 0:
+        raise HTTPException(status_code=400, detail='Invalid upload')
+    UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    with db.connect() as conn:
+        conn.execute('INSERT OR IGNORE INTO artifacts (upload_id, server_id, device_id, command_id, kind, filename, size, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (req.upload_id, req.server_id, req.device_id, req.command_id, req.kind, Path(req.filename).name, req.size, req.sha256))
+        conn.commit()
+    row = artifact_row(req.upload_id)
+    if row['size'] != req.size or row['sha256'] != req.sha256:
+        raise HTTPException(status_code=409, detail='upload_id already used for another file')
+    part = UPLOADS_DIR / f'{req.upload_id}.part'
+    # принятое смещение — по фактическому размеру части на диске (не больше записанного в БД)
+    received = min(row['received'], part.stat().st_size if part.exists() else 0)
+    if row['status'] != 'complete' and received != row['received']:
+        with db.connect() as conn:
+            conn.execute('UPDATE artifacts SET received=? WHERE upload_id=?', (received, req.upload_id))
+            conn.commit()
+    return {'upload_id': req.upload_id, 'offset': row['size'] if row['status'] == 'complete' else received,
+            'status': row['status'], 'max_chunk': MAX_CHUNK_SIZE}
+
+@app.put('/api/artifacts/{upload_id}/chunk')
+async def artifact_chunk(upload_id: str, request: Request, offset: int = Query(...),
+                         x_chunk_sha256: str = Header(...), token: str = Depends(check_role(['admin', 'user']))):
+    """Часть файла со смещения offset; смещение должно совпадать с принятым (иначе 409 с ожидаемым)."""
+    if not upload_id.isalnum():
+        raise HTTPException(status_code=400, detail='Invalid upload_id')
+    if int(request.headers.get('content-length') or 0) > MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=400, detail='Chunk out of range')
+    chunk = await request.body()
+    # проверка, запись на диск (fsync) и sqlite — в пуле потоков, не в event loop
+    return await run_in_threadpool(write_artifact_chunk, upload_id, offset, chunk, x_chunk_sha256)
+
+def write_artifact_chunk(upload_id: str, offset: int, chunk: bytes, checksum: str):
+    if hashlib.sha256(chunk).hexdigest() != checksum:
+        raise HTTPException(status_code=422, detail='Chunk checksum mismatch')
+    with db.connect() as conn:
+        # смещение перечитывается под блокировкой записи: параллельная часть того же upload_id ждёт здесь
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT size, received, status FROM artifacts WHERE upload_id=?', (upload_id,)).fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail='Upload not found')
+        size, received, status = row
+        if status == 'complete':
+            return {'offset': size}
+        if len(chunk) > MAX_CHUNK_SIZE or offset + len(chunk) > size:
+            raise HTTPException(status_code=400, detail='Chunk out of range')
+        if offset != received:
+            return JSONResponse({'error': 'unexpected offset', 'offset': received}, status_code=409)
+        part = UPLOADS_DIR / f'{upload_id}.part'
+        with open(part, 'r+b' if part.exists() else 'wb') as f:
+            f.seek(offset)
+            f.write(chunk)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        conn.execute('UPDATE artifacts SET received=? WHERE upload_id=?', (offset + len(chunk), upload_id))
+    return {'offset': offset + len(chunk)}
+
+@app.post('/api/artifacts/{upload_id}/complete')
+def artifact_complete(upload_id: str, token: str = Depends(check_role(['admin', 'user']))):
+    """Проверить sha256 файла целиком и атомарно перенести его в хранилище артефактов."""
+    row = artifact_row(upload_id)
+    if row['status'] == 'complete':
+        return {'status': 'ok', 'id': row['id']}
+    part = UPLOADS_DIR / f'{upload_id}.part'
+    if row['size'] == 0:
+        part.touch()
+    if row['received'] != row['size'] or not part.exists():
+        return JSONResponse({'error': 'upload incomplete', 'offset': row['received']}, status_code=409)
+    h = hashlib.sha256()
+    with open(part, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    if h.hexdigest() != row['sha256']:
+        # повреждённый файл не сохраняем: загрузка начнётся заново
+        part.unlink(missing_ok=True)
+        with db.connect() as conn:
+            conn.execute('UPDATE artifacts SET received=0 WHERE upload_id=?', (upload_id,))
+            conn.commit()
+        return JSONResponse({'error': 'checksum mismatch', 'offset': 0}, status_code=409)
+    save_dir = DATA_DIR / row['server_id'] / 'artifacts'
+    save_dir.mkdir(parents=True, exist_ok=True)
+    filename = f"{upload_id[:8]}_{row['filename']}"
+    os.replace(part, save_dir / filename)
+    with db.connect() as conn:
+        conn.execute("UPDATE artifacts SET status='complete', filename=?, completed_at=CURRENT_TIMESTAMP WHERE upload_id=?", (filename, upload_id))
+        conn.commit()
+    call_integrations('artifact_uploaded', {
+        'server_id': row['server_id'],
+        'device_id': row['device_id'],
+        'command_id': row['command_id'],
+        'kind': row['kind'],
+        'size': row['size'],
+        'filename': filename
     })
-    return {"status": "ok", "path": str(save_path), "last": str(last_path)}
+    return {'status': 'ok', 'id': row['id']}
+
+@app.get('/api/artifacts')
+def list_artifacts(response: Response, server_id: Optional[str] = None, device_id: Optional[str] = None, status: Optional[str] = None, limit: int = Query(100),
+                   cursor: Optional[str] = None, token: str = Depends(check_role(['admin', 'user', 'readonly']))):
+    query = "SELECT id, upload_id, server_id, device_id, command_id, kind, filename, size, received, status, created_at, completed_at FROM artifacts WHERE 1=1"
+    params = []
+    if server_id:
+        query += " AND server_id=?"
+        params.append(server_id)
+    if device_id:
+        query += " AND device_id=?"
+        params.append(device_id)
+    if status:
+        query += " AND status=?"
+        params.append(status)
+    keyset, keyset_params = keyset_sql(cursor, ('id',))
+    query += ''.join(f" AND {c}" for c in keyset)
+    params.extend(keyset_params)
+    limit = page_limit(limit)
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit + 1)
+    with db.connect() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = [dict(r) for r in conn.execute(query, params).fetchall()]
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1]['id'])
+    return rows
+
+@app.get("/download_artifact/{artifact_id}")
+def download_artifact(artifact_id: int, token: str = Depends(check_role(['admin', 'user', 'readonly']))):
+    with db.connect() as conn:
+        row = conn.execute("SELECT server_id, filename FROM artifacts WHERE id=? AND status='complete'", (artifact_id,)).fetchone()
+    if not row or not (DATA_DIR / row[0] / 'artifacts' / row[1]).exists():
+        return JSONResponse({"error": "not found"}, status_code=404)
+    return FileResponse(str(DATA_DIR / row[0] / 'artifacts' / row[1]), media_type='application/octet-stream', filename=row[1])
+
+# --- API: партиции БД (скрины и сообщения по месяцам) ---
+@app.get('/api/partitions')
+def list_partitions(token: str = Depends(check_role(['admin', 'user', 'readonly']))):
+    """Файлы партиций: месяц, каталог server_id (null — общий файл), размер в байтах."""
+    return [{'month': month, 'server_id': tenant, 'size': path.stat().st_size}
+            for month, tenant, path in partitions.partitions()]
+
+@app.delete('/api/partitions')
+def drop_partitions(before: str = Query(...), token: str = Depends(check_role(['admin']))):
+    """Удалить историю старше месяца before (YYYY-MM): файлы партиций удаляются целиком, затем blob без ссылок."""
+    if not PARTITION_FILE_RE.match(f'{before}.sqlite3'):
+        raise HTTPException(status_code=400, detail='before: ожидается YYYY-MM')
+    dropped = writes.call(partial(partitions.drop_before, before)).result(timeout=60)
+    # кадры удалённых месяцев, на которые больше ничего не ссылается, удаляются вместе с превью
+    blobs = collect_blobs() if dropped else 0
+    return {'dropped': [{'month': month, 'server_id': tenant} for month, tenant in dropped], 'blobs_removed': blobs}
 
 # --- API: получить список скринов (расширенная фильтрация) ---
 @app.get("/screenshots")
 def list_screenshots(
+    response: Response,
     server_id: Optional[str] = None,
     window: Optional[str] = None,
     device_id: Optional[str] = None,
@@ -198,15 +1188,37 @@ def list_screenshots(
     text: Optional[str] = None,  # поиск по filename/meta
     created_at_from: Optional[str] = None,  # ISO-строка
     created_at_to: Optional[str] = None,    # ISO-строка
+    cursor: Optional[str] = None,
+    limit: int = 1000
 ):
     """
-    Получить список скринов с расширенной фильтрацией:
+    Список скринов (новые сверху), постранично: курсор следующей страницы — в заголовке X-Next-Cursor
+    (нет заголовка — это последняя страница).
+    """
+    items, next_cursor = query_screenshots(server_id, window, device_id, section, text, created_at_from, created_at_to, cursor, limit)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return items
+
+def query_screenshots(
+    server_id: Optional[str] = None,
+    window: Optional[str] = None,
+    device_id: Optional[str] = None,
+    section: Optional[str] = None,
+    text: Optional[str] = None,
+    created_at_from: Optional[str] = None,
+    created_at_to: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 1000
+):
+    """
+    Получить страницу скринов с расширенной фильтрацией, возвращает (скрины, курсор следующей страницы или None):
     - server_id, window, device_id — как раньше
-    - section — фильтр по секции (window или meta.section)
-    - text — поиск по filename/meta (LIKE)
+    - section — фильтр по секции (поле section агента, для старых записей — meta.section или window)
+    - text — полнотекстовый поиск по filename/meta (слова по префиксу, "фраза" в кавычках)
     - created_at_from, created_at_to — фильтр по дате (ISO-строка)
     """
-    query = "SELECT server_id, window, device_id, filename, meta, created_at FROM screenshots WHERE 1=1"
+    query = "SELECT server_id, window, device_id, filename, section, created_at, content_type, device_name, ip, port, created_ts, id, blob FROM {p}.screenshots WHERE 1=1"
     params = []
     if server_id:
         query += " AND server_id=?"
@@ -218,68 +1230,87 @@ def list_screenshots(
         query += " AND device_id=?"
         params.append(device_id)
     if section:
-        query += " AND (window=? OR meta LIKE ?)"
+        query += " AND section=?"
         params.append(section)
-        params.append(f'%"section": "{section}"%')
     if text:
-        query += " AND (filename LIKE ? OR meta LIKE ?)"
-        like = f"%{text}%"
-        params.extend([like, like])
-    if created_at_from:
-        query += " AND created_at >= ?"
-        params.append(created_at_from)
-    if created_at_to:
-        query += " AND created_at <= ?"
-        params.append(created_at_to)
-    query += " ORDER BY created_at DESC LIMIT 1000"
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(query, params)
-        rows = c.fetchall()
+        cond, cond_params = text_search_sql('screenshots', text, '{p}.')
+        query += f" AND {cond}"
+        params.extend(cond_params)
+    cond, cond_params = created_range_sql(created_at_from, created_at_to)
+    keyset, keyset_params = keyset_sql(cursor)
+    query += ''.join(f" AND {c}" for c in cond + keyset)
+    params.extend(cond_params + keyset_params)
+    limit = page_limit(limit)
+    # только партиции месяцев из диапазона дат (и не новее курсора), новые сверху
+    ts_from, ts_to = partition_range(created_at_from, created_at_to, keyset_params)
+    rows = partitions.query(query, params, key=lambda r: (r[10], r[11]), limit=limit + 1,
+                            ts_from=ts_from, ts_to=ts_to, server_id=server_id)
+    next_cursor = encode_cursor(*rows[limit - 1][10:12]) if len(rows) > limit else None
     result = []
-    for r in rows:
-        meta = r[4]
-        section_val = r[1]
-        try:
-            meta_dict = json.loads(meta) if meta else {}
-            if 'section' in meta_dict:
-                section_val = meta_dict['section']
-        except Exception:
-            pass
+    for r in rows[:limit]:
         result.append({
             "server_id": r[0],
             "window": r[1],
             "device_id": r[2],
             "filename": r[3],
-            "section": section_val,
+            "section": r[4] or r[1],
+            "device_name": r[7],
+            "ip": r[8],
+            "port": r[9],
+            "content_type": r[6] or 'image/png',
+            "blob": r[12],
             "created_at": r[5]
         })
-    return result
+    return result, next_cursor
 
 # --- API: скачать скрин ---
 @app.get("/download/{server_id}/{window}/{filename}")
-def download_screenshot(server_id: str, window: str, filename: str):
+def download_screenshot(request: Request, server_id: str, window: str, filename: str, rendition: Optional[str] = None):
+    """rendition=thumb|preview — уменьшенная WebP-копия (для скринов в хранилище blob)."""
+    rendition = check_rendition(rendition)
     file_path = DATA_DIR / server_id / window / filename
-    if not file_path.exists():
+    if file_path.exists():
+        return FileResponse(str(file_path), media_type=media_type_for(file_path))
+    # новые скрины — blob по sha256 из строки screenshots (партиции около даты из имени файла)
+    ts_from, ts_to = filename_range(filename)
+    rows = partitions.query('SELECT blob, content_type, created_ts, id FROM {p}.screenshots WHERE server_id=? AND window=? AND filename=? AND blob IS NOT NULL',
+                            [server_id, window, filename], key=lambda r: (r[2], r[3]), limit=1,
+                            ts_from=ts_from, ts_to=ts_to, server_id=server_id)
+    if not rows:
         return JSONResponse({"error": "not found"}, status_code=404)
-    return FileResponse(str(file_path), media_type="image/png")
+    # скрин из истории не меняется — браузер может кэшировать без перепроверки
+    return blob_response(request, rows[0][0], rows[0][1], rendition, 'public, max-age=31536000, immutable')
 
 # --- API: скачать последний скрин ---
 @app.get("/download_last/{server_id}/{window}/{device_id}")
-def download_last_screenshot(server_id: str, window: str, device_id: str):
+def download_last_screenshot(request: Request, server_id: str, window: str, device_id: str, rendition: Optional[str] = None):
+    """
+    rendition=thumb|preview — уменьшенная WebP-копия. ETag меняется с новым кадром: автообновление галереи
+    перепроверяет картинку (If-None-Match) и получает 304 без тела, пока кадр прежний.
+    """
+    rendition = check_rendition(rendition)
+    with db.connect() as conn:
+        row = conn.execute('SELECT blob, content_type FROM last_screenshots WHERE server_id=? AND window=? AND device_id=?',
+                           (server_id, window, device_id)).fetchone()
+    if row and blob_path(*row).exists():
+        return blob_response(request, row[0], row[1], rendition)
+    # скрины, сохранённые до хранилища blob: файл <device>_last.<ext>
     safe_device = device_id.replace(':', '_').replace('/', '_')
-    last_path = DATA_DIR / server_id / window / f"{safe_device}_last.png"
-    if not last_path.exists():
+    last_path = find_last_path(DATA_DIR / server_id / window, safe_device)
+    if last_path is None:
         return JSONResponse({"error": "not found"}, status_code=404)
-    return FileResponse(str(last_path), media_type="image/png")
+    return FileResponse(str(last_path), media_type=media_type_for(last_path))
 
 # --- Web-интерфейс: просмотр скринов ---
 @app.get("/", response_class=HTMLResponse)
-def index(request: Request, server_id: Optional[str] = None, window: Optional[str] = None, device_id: Optional[str] = None):
-    section = request.query_params.get('section')
-    screenshots = list_screenshots(server_id, window, device_id, section)
+def index(request: Request, server_id: Optional[str] = None, window: Optional[str] = None, device_id: Optional[str] = None,
+          cursor: Optional[str] = None, limit: int = 200):
+    q = request.query_params
+    screenshots, next_cursor = query_screenshots(server_id, window, device_id, q.get('section'), q.get('text'),
+                                                 q.get('created_at_from'), q.get('created_at_to'), cursor, limit)
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    return templates.TemplateResponse("index.html", {"request": request, "screenshots": screenshots, "server_id": server_id, "window": window, "device_id": device_id, "now": now})
+    return templates.TemplateResponse("index.html", {"request": request, "screenshots": screenshots, "server_id": server_id, "window": window, "device_id": device_id, "now": now,
+                                                     "next_cursor": next_cursor})
 
 # --- Заглушки для интеграций (Telegram, Google Sheets, нейросети) ---
 # Можно реализовать как background tasks, очереди, webhooks и т.д.
@@ -323,12 +1354,7 @@ async def websocket_logs(websocket: WebSocket):
 # --- Интеграция с Telegram ---
 def send_telegram_alert(text: str):
     try:
-        config_path = get_config_path()
-        if not config_path.exists():
-            return
-        import yaml
-        with open(config_path, 'r', encoding='utf-8') as f:
-            cfg = yaml.safe_load(f)
+        cfg = load_server_config()
         tg = cfg.get('telegram', {})
         bot_token = tg.get('bot_token')
         chat_id = tg.get('chat_id')
@@ -342,12 +1368,14 @@ def send_telegram_alert(text: str):
         pass
 
 @app.post('/api/send_message')
-def send_message(msg: MessageIn, token: str = Depends(check_role(['admin', 'user']))):
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('INSERT INTO messages (server_id, device_id, type, message) VALUES (?, ?, ?, ?)',
-                  (msg.server_id, msg.device_id, msg.type, msg.message))
-        conn.commit()
+def send_message(msg: MessageIn, durable: bool = Query(False), token: str = Depends(check_role(['admin', 'user']))):
+    # Вставка — через групповой коммит; durable=1 — ответ только после коммита пачки
+    created_ts, created_at = utc_now()
+    written = writes.submit('INSERT INTO messages (server_id, device_id, type, message, created_at, created_ts) VALUES (?, ?, ?, ?, ?, ?)',
+                            (msg.server_id, msg.device_id, msg.type, msg.message, created_at, created_ts),
+                            database=partition_for(created_ts, msg.server_id))
+    if durable:
+        written.result(timeout=30)
     # WebSocket broadcast (async)
     def ws_broadcast():
         asyncio.run(log_manager.broadcast({
@@ -381,14 +1409,45 @@ def get_messages_list(
     created_at_from: Optional[str] = None,
     created_at_to: Optional[str] = None,
     limit: int = 100
+):
+    return query_messages(server_id, device_id, type, text, created_at_from, created_at_to, None, limit)[0]
+
+@app.get('/api/messages')
+def api_messages(
+    response: Response,
+    server_id: Optional[str] = None,
+    device_id: Optional[str] = None,
+    type: Optional[str] = None,
+    text: Optional[str] = None,
+    created_at_from: Optional[str] = None,
+    created_at_to: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    token: str = Depends(check_role(['admin', 'user', 'readonly']))
+):
+    """Сообщения (новые сверху) постранично: курсор следующей страницы — в заголовке X-Next-Cursor."""
+    items, next_cursor = query_messages(server_id, device_id, type, text, created_at_from, created_at_to, cursor, limit)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return items
+
+def query_messages(
+    server_id: Optional[str] = None,
+    device_id: Optional[str] = None,
+    type: Optional[str] = None,
+    text: Optional[str] = None,
+    created_at_from: Optional[str] = None,
+    created_at_to: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100
 ):
     """
-    Получить список сообщений с расширенной фильтрацией:
+    Получить страницу сообщений с расширенной фильтрацией, возвращает (сообщения, курсор следующей страницы или None):
     - server_id, device_id, type — как раньше
-    - text — поиск по message (LIKE)
+    - text — полнотекстовый поиск по message (слова по префиксу, "фраза" в кавычках)
     - created_at_from, created_at_to — фильтр по дате (ISO-строка)
     """
-    query = 'SELECT server_id, device_id, type, message, created_at FROM messages WHERE 1=1'
+    query = 'SELECT server_id, device_id, type, message, created_at, created_ts, id FROM {p}.messages WHERE 1=1'
     params = []
     if server_id:
         query += ' AND server_id=?'
@@ -400,36 +1459,36 @@ def get_messages_list(
         query += ' AND type=?'
         params.append(type)
     if text:
-        query += ' AND message LIKE ?'
-        params.append(f"%{text}%")
-    if created_at_from:
-        query += ' AND created_at >= ?'
-        params.append(created_at_from)
-    if created_at_to:
-        query += ' AND created_at <= ?'
-        params.append(created_at_to)
-    query += ' ORDER BY created_at DESC LIMIT ?'
-    params.append(limit)
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(query, params)
-        rows = c.fetchall()
+        cond, cond_params = text_search_sql('messages', text, '{p}.')
+        query += f' AND {cond}'
+        params.extend(cond_params)
+    cond, cond_params = created_range_sql(created_at_from, created_at_to)
+    keyset, keyset_params = keyset_sql(cursor)
+    query += ''.join(f' AND {c}' for c in cond + keyset)
+    params.extend(cond_params + keyset_params)
+    limit = page_limit(limit)
+    ts_from, ts_to = partition_range(created_at_from, created_at_to, keyset_params)
+    rows = partitions.query(query, params, key=lambda r: (r[5], r[6]), limit=limit + 1,
+                            ts_from=ts_from, ts_to=ts_to, server_id=server_id)
+    next_cursor = encode_cursor(*rows[limit - 1][5:7]) if len(rows) > limit else None
     return [
         {'server_id': r[0], 'device_id': r[1], 'type': r[2], 'message': r[3], 'created_at': r[4]}
-        for r in rows
-    ]
+        for r in rows[:limit]
+    ], next_cursor
 
 @app.get('/logs', response_class=HTMLResponse)
-def logs_page(request: Request, server_id: Optional[str] = Query(None), device_id: Optional[str] = Query(None), type: Optional[str] = Query(None), limit: int = Query(100)):
-    messages = get_messages_list(server_id, device_id, type, None, None, None, limit)
-    return templates.TemplateResponse('logs.html', {"request": request, "messages": messages, "server_id": server_id, "device_id": device_id, "type": type, "limit": limit})
+def logs_page(request: Request, server_id: Optional[str] = Query(None), device_id: Optional[str] = Query(None), type: Optional[str] = Query(None), limit: int = Query(100),
+              cursor: Optional[str] = Query(None)):
+    messages, next_cursor = query_messages(server_id, device_id, type, None, None, None, cursor, limit)
+    return templates.TemplateResponse('logs.html', {"request": request, "messages": messages, "server_id": server_id, "device_id": device_id, "type": type, "limit": limit,
+                                                    "next_cursor": next_cursor})
 
 # --- API: получить команды для агента ---
 @app.get('/api/get_commands')
 def get_commands(server_id: str, device_id: str, token: str = Depends(check_role(['admin', 'user', 'readonly']))):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db.connect() as conn:
         c = conn.cursor()
-        c.execute('SELECT id, command, params, status, created_at FROM commands WHERE server_id=? AND device_id=? AND status="pending" ORDER BY created_at',
+        c.execute('SELECT id, command, params, status, created_at FROM commands WHERE server_id=? AND device_id=? AND status="pending" ORDER BY created_ts, id',
                   (server_id, device_id))
         rows = c.fetchall()
     cmds = []
@@ -447,29 +1506,323 @@ class CommandResultIn(BaseModel):
     status: str
     result: Optional[str] = None
 
-@app.post('/api/command_result')
-def command_result(res: CommandResultIn, token: str = Depends(check_role(['admin', 'user']))):
-    with sqlite3.connect(DB_PATH) as conn:
+def save_command_result(command_id: int, status: str, result: Optional[str] = None):
+    with db.connect() as conn:
         c = conn.cursor()
-        c.execute('UPDATE commands SET status=? WHERE id=?', (res.status, res.command_id))
+        c.execute('UPDATE commands SET status=? WHERE id=?', (status, command_id))
         conn.commit()
     call_integrations('command_result', {
-        'command_id': res.command_id,
-        'status': res.status,
-        'result': res.result,
+        'command_id': command_id,
+        'status': status,
+        'result': result,
         'timestamp': datetime.now().isoformat()
     })
+
+@app.post('/api/command_result')
+def command_result(res: CommandResultIn, token: str = Depends(check_role(['admin', 'user']))):
+    save_command_result(res.command_id, res.status, res.result)
     return {'status': 'ok'}
 
+# --- WebSocket-канал агентов: мгновенная доставка команд ---
+def fetch_commands(server_id: str, command_id: Optional[int] = None) -> List[dict]:
+    """Команды в статусе pending для сервера (или одна конкретная команда)."""
+    query = 'SELECT id, device_id, command, params, status, created_at FROM commands WHERE server_id=? AND status="pending"'
+    params = [server_id]
+    if command_id is not None:
+        query += ' AND id=?'
+        params.append(command_id)
+    with db.connect() as conn:
+        c = conn.cursor()
+        c.execute(query + ' ORDER BY created_ts, id', params)
+        rows = c.fetchall()
+    cmds = []
+    for r in rows:
+        try:
+            cmd_params = json.loads(r[3]) if r[3] else {}
+        except Exception:
+            cmd_params = {}
+        cmds.append({'id': r[0], 'device_id': r[1], 'command': r[2], 'params': cmd_params, 'status': r[4], 'created_at': r[5]})
+    return cmds
+
+def mark_command_delivered(command_id: int):
+    with db.connect() as conn:
+        c = conn.cursor()
+        c.execute('UPDATE commands SET status="delivered" WHERE id=? AND status="pending"', (command_id,))
+        conn.commit()
+
+class AgentChannelManager:
+    """
+    Подключённые агенты (server_id -> список WebSocket).
+    Новые команды отправляются агенту сразу после вставки в таблицу commands;
+    агент подтверждает получение (ack), присылает результат (result) и heartbeat.
+    """
+    def __init__(self):
+        self.connections = {}
+        self.last_seen = {}
+        self.loop = None
+    async def connect(self, server_id: str, websocket: WebSocket):
+        await websocket.accept()
+        self.loop = asyncio.get_running_loop()
+        self.connections.setdefault(server_id, []).append(websocket)
+        self.last_seen[server_id] = datetime.now().isoformat()
+    def disconnect(self, server_id: str, websocket: WebSocket):
+        conns = self.connections.get(server_id, [])
+        if websocket in conns:
+            conns.remove(websocket)
+    def is_connected(self, server_id: str) -> bool:
+        return bool(self.connections.get(server_id))
+    async def push(self, server_id: str, commands: List[dict]):
+        for connection in list(self.connections.get(server_id, [])):
+            for cmd in commands:
+                try:
+                    await connection.send_json({'type': 'command', 'command': cmd})
+                except Exception:
+                    self.disconnect(server_id, connection)
+                    break
+    def notify(self, server_id: str, command_id: int):
+        """Вызывается из синхронных обработчиков (threadpool): отправить новую команду подключённому агенту."""
+        if self.loop is None or not self.is_connected(server_id):
+            return
+        commands = fetch_commands(server_id, command_id)
+        if commands:
+            asyncio.run_coroutine_threadsafe(self.push(server_id, commands), self.loop)
+agent_channels = AgentChannelManager()
+
+class AgentChannelIn(BaseModel):
+    """Сообщение агента по каналу: heartbeat, ack (команда принята) или result (как CommandResultIn)."""
+    type: str
+    command_id: Optional[int] = None
+    status: str = 'done'
+    result: Optional[str] = None
+
+def parse_channel_message(text: str) -> Optional[AgentChannelIn]:
+    """Разобрать кадр канала; None — не JSON-объект, неизвестный тип или ack/result без command_id."""
+    try:
+        msg = AgentChannelIn(**json.loads(text))
+    except (ValueError, TypeError):  # json и pydantic.ValidationError — подклассы ValueError
+        return None
+    if msg.type not in ('heartbeat', 'ack', 'result') or (msg.type != 'heartbeat' and msg.command_id is None):
+        return None
+    return msg
+
+@app.websocket('/ws/agent')
+async def websocket_agent(websocket: WebSocket, server_id: str):
+    authorization = websocket.headers.get('authorization', '')
+    token = authorization.split(' ', 1)[1] if authorization.startswith('Bearer ') else ''
+    if not token or get_user_role(token) not in ('admin', 'user'):
+        await websocket.close(code=1008)
+        return
+    await agent_channels.connect(server_id, websocket)
+    try:
+        # Всё, что накопилось, пока агент был не на связи
+        await agent_channels.push(server_id, await run_in_threadpool(fetch_commands, server_id))
+        while True:
+            text = await websocket.receive_text()
+            agent_channels.last_seen[server_id] = datetime.now().isoformat()
+            msg = parse_channel_message(text)
+            if msg is None:
+                # битый кадр не закрывает канал: остальные команды и результаты агента продолжают идти
+                logging.warning(f'[ws] {server_id}: некорректное сообщение агента пропущено: {text[:200]!r}')
+            elif msg.type == 'heartbeat':
+                await websocket.send_json({'type': 'heartbeat'})
+            elif msg.type == 'ack':
+                await run_in_threadpool(mark_command_delivered, msg.command_id)
+            else:
+                await run_in_threadpool(save_command_result, msg.command_id, msg.status, msg.result)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        agent_channels.disconnect(server_id, websocket)
+
+# --- Аренда устройств: сервер распределяет устройства между агентами ---
+LEASE_TTL = 60    # срок аренды, продлевается heartbeat-ом агента
+AGENT_TTL = 90    # агент без heartbeat дольше — считается мёртвым
+_lease_lock = threading.Lock()
+
+class AgentHeartbeatIn(BaseModel):
+    agent_id: str
+    server_id: str = ''
+    host: str = ''
+    capacity: int = 50
+    devices: List[str] = []
+
+def device_scope(server_id: str, host: str, device_id: str) -> str:
+    """
+    Область уникальности id устройства: сетевое устройство (ip:port) видят все агенты server_id,
+    а USB-серийник, эмулятор и loopback (emulator-5554, 127.0.0.1:5555) — только агенты своего хоста.
+    """
+    address = device_id.rsplit(':', 1)[0] if ':' in device_id else ''
+    if not address or address in ('127.0.0.1', 'localhost', '::1', '[::1]'):
+        return f'host:{host}'
+    return f'server:{server_id}'
+
+def rebalance_leases(conn, now: float):
+    """
+    Пересчитать аренды по живым агентам (устройство — пара (scope, device_id), см. device_scope):
+    - аренды просроченные, мёртвых агентов и устройств, которые агент больше не видит, удаляются
+    - свободные устройства выдаются видящему их агенту с наименьшей загрузкой (leases / capacity)
+    - перегруженный агент (сверх capacity или на 2+ аренды больше, чем другой агент, видящий устройство)
+      не продлевает часть аренд (draining): они истекают и переходят другому агенту без двойного захвата
+    """
+    agents = {}
+    for agent_id, server_id, host, capacity, devices in conn.execute(
+            'SELECT agent_id, server_id, host, capacity, devices FROM agents WHERE last_seen >= ?', (now - AGENT_TTL,)):
+        agents[agent_id] = {'capacity': max(int(capacity or 0), 0),
+                            'devices': {(device_scope(server_id or '', host or '', d), d) for d in json.loads(devices or '[]')}}
+    held = {}
+    for scope, device_id, agent_id, expires_at, draining in conn.execute('SELECT scope, device_id, agent_id, expires_at, draining FROM leases').fetchall():
+        key = (scope, device_id)
+        if expires_at > now and agent_id in agents and key in agents[agent_id]['devices']:
+            held[key] = (agent_id, draining)
+        elif expires_at <= now:
+            conn.execute('DELETE FROM leases WHERE scope=? AND device_id=?', key)
+    load = {agent_id: 0 for agent_id in agents}
+    for agent_id, _ in held.values():
+        load[agent_id] += 1
+    wanted = set().union(*(a['devices'] for a in agents.values())) if agents else set()
+    for key in sorted(wanted - set(held)):
+        if conn.execute('SELECT 1 FROM leases WHERE scope=? AND device_id=? AND expires_at > ?', (*key, now)).fetchone():
+            continue  # аренда ещё не истекла у агента, который пропал или больше не видит устройство
+        candidates = [a for a in agents if key in agents[a]['devices'] and load[a] < agents[a]['capacity']]
+        if not candidates:
+            continue
+        best = min(candidates, key=lambda a: (load[a] / agents[a]['capacity'], a))
+        conn.execute('INSERT OR REPLACE INTO leases (scope, device_id, agent_id, expires_at, granted_at, draining) VALUES (?, ?, ?, ?, ?, 0)',
+                     (*key, best, now + LEASE_TTL, now))
+        held[key] = (best, 0)
+        load[best] += 1
+    # ожидаемая загрузка: уходящие (draining) аренды уже считаются у агента, который их получит
+    expected = dict(load)
+    def receiver(key, holder):
+        others = [a for a in agents if a != holder and key in agents[a]['devices'] and expected[a] < agents[a]['capacity']]
+        return min(others, key=lambda a: (expected[a], a), default=None)
+    def move(key, holder):
+        expected[holder] -= 1
+        target = receiver(key, holder)
+        if target is not None:
+            expected[target] += 1
+    for key, (agent_id, is_draining) in sorted(held.items()):
+        if is_draining:
+            move(key, agent_id)
+    for key, (agent_id, is_draining) in sorted(held.items()):
+        if is_draining:
+            continue
+        target = receiver(key, agent_id)
+        if expected[agent_id] > agents[agent_id]['capacity'] or (target is not None and expected[agent_id] - expected[target] >= 2):
+            conn.execute('UPDATE leases SET draining=1 WHERE scope=? AND device_id=?', key)
+            move(key, agent_id)
+
+@app.post('/api/agents/heartbeat')
+def agent_heartbeat(hb: AgentHeartbeatIn, token: str = Depends(check_role(['admin', 'user']))):
+    """Агент сообщает ёмкость и видимые устройства, получает свои аренды (expires_in — секунды до окончания)."""
+    now = time.time()
+    with _lease_lock, db.connect() as conn:
+        conn.execute('''INSERT INTO agents (agent_id, server_id, host, capacity, devices, last_seen, registered_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (agent_id) DO UPDATE SET server_id=excluded.server_id, host=excluded.host, capacity=excluded.capacity,
+                        devices=excluded.devices, last_seen=excluded.last_seen''',
+                     (hb.agent_id, hb.server_id, hb.host, hb.capacity, json.dumps(sorted(set(hb.devices))), now, now))
+        rebalance_leases(conn, now)
+        conn.execute('UPDATE leases SET expires_at=? WHERE agent_id=? AND draining=0', (now + LEASE_TTL, hb.agent_id))
+        rows = conn.execute('SELECT device_id, expires_at, draining FROM leases WHERE agent_id=? ORDER BY device_id', (hb.agent_id,)).fetchall()
+        conn.commit()
+    return {
+        'agent_id': hb.agent_id,
+        'lease_ttl': LEASE_TTL,
+        'leases': [{'device_id': r[0], 'expires_in': round(r[1] - now, 1), 'draining': bool(r[2])} for r in rows]
+    }
+
+@app.get('/api/agents')
+def list_agents(token: str = Depends(check_role(['admin', 'user', 'readonly']))):
+    now = time.time()
+    with db.connect() as conn:
+        agents = conn.execute('SELECT agent_id, server_id, host, capacity, devices, last_seen FROM agents ORDER BY agent_id').fetchall()
+        leases = conn.execute('SELECT device_id, agent_id, expires_at, draining FROM leases WHERE expires_at > ? ORDER BY device_id', (now,)).fetchall()
+    return [{
+        'agent_id': agent_id,
+        'server_id': server_id,
+        'host': host,
+        'capacity': capacity,
+        'alive': now - last_seen < AGENT_TTL,
+        'last_seen': datetime.fromtimestamp(last_seen).isoformat(),
+        'visible_devices': json.loads(devices or '[]'),
+        'leases': [{'device_id': l[0], 'expires_in': round(l[2] - now, 1), 'draining': bool(l[3])} for l in leases if l[1] == agent_id]
+    } for agent_id, server_id, host, capacity, devices, last_seen in agents]
+
+# --- План съёмки: фазы и джиттер по устройствам, чтобы загрузки шли равномерно ---
+PLAN_DEVICE_TTL = 900      # устройство без обновления плана дольше — не учитывается
+PLAN_TARGET_LOAD = 0.7     # доля пропускной способности приёма, которую планируем занять
+PLAN_MAX_JITTER = 5.0      # максимальный джиттер, сек
+
+class PlanDeviceIn(BaseModel):
+    device_id: str
+    interval: float = 60
+
+class PlanRequestIn(BaseModel):
+    agent_id: str
+    server_id: str = ''
+    host: str = ''
+    devices: List[PlanDeviceIn] = []
+
+def ingest_capacity() -> float:
+    """Загрузок в секунду, которые сервер успевает обработать (по наблюдаемому времени обработки)."""
+    return INGEST_WORKERS / max(ingest_stats.avg_seconds, 0.001)
+
+def compute_plan(devices: List[tuple], capacity: float) -> dict:
+    """
+    devices — [(ключ устройства "scope|device_id", interval)] всего парка. Устройства одного интервала раскладываются по
+    равным слотам внутри интервала (порядок — по md5 id, стабилен при добавлении устройств);
+    если суммарная частота загрузок превышает PLAN_TARGET_LOAD * capacity, интервалы растягиваются.
+    """
+    load = sum(1.0 / max(interval, 1.0) for _, interval in devices)
+    stretch = max(1.0, load / (PLAN_TARGET_LOAD * capacity)) if capacity > 0 else 1.0
+    groups = {}
+    for device_id, interval in devices:
+        groups.setdefault(interval, []).append(device_id)
+    plan = {}
+    for interval, ids in groups.items():
+        effective = interval * stretch
+        spacing = effective / len(ids)
+        for rank, device_id in enumerate(sorted(ids, key=lambda d: hashlib.md5(d.encode()).hexdigest())):
+            plan[device_id] = {
+                'interval': round(effective, 3),
+                'offset': round(rank * spacing, 3),
+                'jitter': round(min(PLAN_MAX_JITTER, spacing / 2), 3)
+            }
+    return {'plan': plan, 'load_per_sec': round(load, 3), 'stretch': round(stretch, 3)}
+
+@app.post('/api/schedule/plan')
+def schedule_plan(req: PlanRequestIn, token: str = Depends(check_role(['admin', 'user']))):
+    """
+    Агент сообщает свои устройства и интервалы, получает фазы съёмки (offset от начала эпохи unix),
+    джиттер и, при перегрузке приёма, растянутый интервал. server_time — для поправки часов агента.
+    """
+    now = time.time()
+    own = {f'{device_scope(req.server_id, req.host, d.device_id)}|{d.device_id}': d.device_id for d in req.devices}
+    with db.connect() as conn:
+        conn.executemany('INSERT OR REPLACE INTO schedule_devices (scope, device_id, agent_id, interval, updated_at) VALUES (?, ?, ?, ?, ?)',
+                         [(device_scope(req.server_id, req.host, d.device_id), d.device_id, req.agent_id, d.interval, now) for d in req.devices])
+        conn.commit()
+        fleet = conn.execute("SELECT scope || '|' || device_id, interval FROM schedule_devices WHERE updated_at >= ?", (now - PLAN_DEVICE_TTL,)).fetchall()
+    capacity = ingest_capacity()
+    result = compute_plan(fleet, capacity)
+    return {
+        'server_time': time.time(),
+        'devices': {own[key]: p for key, p in result['plan'].items() if key in own},
+        'ingest': {
+            'avg_ms': round(ingest_stats.avg_seconds * 1000, 2),
+            'phases_ms': ingest_stats.phases_ms(),
+            'capacity_per_sec': round(capacity, 2),
+            'load_per_sec': result['load_per_sec'],
+            'stretch': result['stretch'],
+            'fleet_devices': len(fleet)
+        }
+    }
+
 @app.get('/commands', response_class=HTMLResponse)
 def commands_page(request: Request, server_id: Optional[str] = Query(None), device_id: Optional[str] = Query(None), message: Optional[str] = Query(None)):
-    # Для простоты: получить уникальные server_id и device_id из последних скринов
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute('SELECT DISTINCT server_id FROM screenshots ORDER BY server_id')
-        servers = [r[0] for r in c.fetchall()]
-        c.execute('SELECT DISTINCT device_id FROM screenshots ORDER BY device_id')
-        devices = [r[0] for r in c.fetchall()]
+    # Для простоты: получить уникальные server_id и device_id из скринов (все партиции)
+    servers = sorted({r[0] for r in partitions.query('SELECT DISTINCT server_id FROM {p}.screenshots', limit=None) if r[0]})
+    devices = sorted({r[0] for r in partitions.query('SELECT DISTINCT device_id FROM {p}.screenshots', limit=None) if r[0]})
     return templates.TemplateResponse('commands.html', {"request": request, "servers": servers, "devices": devices, "server_id": server_id, "device_id": device_id, "message": message})
 
 @app.post('/commands', response_class=HTMLResponse)
@@ -480,15 +1833,127 @@ def send_command(request: Request, server_id: str = Form(...), device_id: str =
         params_json = json.loads(params) if params.strip() else {}
     except Exception:
         params_json = {"raw": params}
-    with sqlite3.connect(DB_PATH) as conn:
+    created_ts, created_at = utc_now()
+    with db.connect() as conn:
         c = conn.cursor()
-        c.execute('INSERT INTO commands (server_id, device_id, command, params) VALUES (?, ?, ?, ?)',
-                  (server_id, device_id, command, json.dumps(params_json)))
+        c.execute('INSERT INTO commands (server_id, device_id, command, params, created_at, created_ts) VALUES (?, ?, ?, ?, ?, ?)',
+                  (server_id, device_id, command, json.dumps(params_json), created_at, created_ts))
         conn.commit()
+        command_id = c.lastrowid
+    agent_channels.notify(server_id, command_id)
     msg = f"Команда '{command}' отправлена для {device_id} на {server_id}"
     url = f"/commands?server_id={server_id}&device_id={device_id}&message={msg}"
     return RedirectResponse(url, status_code=303)
 
+# --- API: телеметрия устройств (временные ряды, raw → 1 мин → 1 час) ---
+class TelemetrySample(BaseModel):
+    device_id: str
+    metric: str
+    value: float
+    ts: float
+
+class TelemetryIn(BaseModel):
+    server_id: str
+    samples: List[TelemetrySample]
+    batch_id: Optional[str] = None  # id пачки агента: повторная доставка той же пачки пропускается
+
+_telemetry_compacted = 0.0
+
+def compact_telemetry(conn, now: Optional[float] = None):
+    """Удалить уровни телеметрии старше срока хранения (агрегаты уже посчитаны при приёме)."""
+    now = now or time.time()
+    conn.execute('DELETE FROM telemetry_raw WHERE ts < ?', (now - TELEMETRY_RETENTION_DAYS['raw'] * 86400,))
+    # id пачек хранятся, пока есть агрегаты, в которые пачка могла попасть
+    conn.execute('DELETE FROM telemetry_batches WHERE received_ts < ?', (now - max(TELEMETRY_RETENTION_DAYS.values()) * 86400,))
+    for table in TELEMETRY_RESOLUTIONS:
+        conn.execute(f'DELETE FROM telemetry_{table} WHERE bucket < ?', (now - TELEMETRY_RETENTION_DAYS[table] * 86400,))
+
+@app.post('/api/telemetry')
+def ingest_telemetry(batch: TelemetryIn, token: str = Depends(check_role(['admin', 'user']))):
+    global _telemetry_compacted
+    rows = [(batch.server_id, s.device_id, s.metric, int(s.ts), s.value) for s in batch.samples]
+    with db.connect() as conn:
+        # id пачки записывается в той же транзакции, что и агрегаты: пачка учитывается ровно один раз
+        if batch.batch_id and not conn.execute('INSERT OR IGNORE INTO telemetry_batches (batch_id, received_ts) VALUES (?, ?)',
+                                               (batch.batch_id, int(time.time()))).rowcount:
+            return {'status': 'duplicate', 'samples': 0}
+        conn.executemany('INSERT INTO telemetry_raw (server_id, device_id, metric, ts, value) VALUES (?, ?, ?, ?, ?)', rows)
+        for table, step in TELEMETRY_RESOLUTIONS.items():
+            conn.executemany(f'''INSERT INTO telemetry_{table} (server_id, device_id, metric, bucket, cnt, total, vmin, vmax)
+                VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (device_id, metric, bucket, server_id) DO UPDATE SET
+                    cnt = cnt + 1, total = total + excluded.total,
+                    vmin = min(vmin, excluded.vmin), vmax = max(vmax, excluded.vmax)''',
+                [(sid, dev, metric, ts - ts % step, value, value, value) for sid, dev, metric, ts, value in rows])
+        if time.time() - _telemetry_compacted > 600:
+            compact_telemetry(conn)
+            _telemetry_compacted = time.time()
+        conn.commit()
+    return {'status': 'ok', 'samples': len(rows)}
+
+def pick_resolution(ts_from: float, ts_to: float) -> str:
+    span = ts_to - ts_from
+    if span <= 6 * 3600:
+        return 'raw'
+    if span <= 7 * 86400:
+        return '1m'
+    return '1h'
+
+def query_telemetry(metric: str, server_id: Optional[str], device_id: Optional[str],
+                    ts_from: float, ts_to: float, resolution: str = 'auto'):
+    """Точки ряда: (device_id, ts, avg, min, max, count); resolution auto — по длине интервала."""
+    if resolution not in ('raw', *TELEMETRY_RESOLUTIONS):
+        resolution = pick_resolution(ts_from, ts_to)
+    if resolution == 'raw':
+        query = 'SELECT device_id, ts, value, value, value, 1 FROM telemetry_raw WHERE metric=? AND ts BETWEEN ? AND ?'
+    else:
+        query = (f'SELECT device_id, bucket, total / cnt, vmin, vmax, cnt FROM telemetry_{resolution} '
+                 'WHERE metric=? AND bucket BETWEEN ? AND ?')
+    params = [metric, int(ts_from), int(ts_to)]
+    if server_id:
+        query += ' AND server_id=?'
+        params.append(server_id)
+    if device_id:
+        query += ' AND device_id=?'
+        params.append(device_id)
+    query += ' ORDER BY 2 LIMIT 20000'
+    with db.connect() as conn:
+        return resolution, conn.execute(query, params).fetchall()
+
+@app.get('/api/telemetry')
+def get_telemetry(
+    metric: str,
+    device_id: Optional[str] = None,
+    server_id: Optional[str] = None,
+    ts_from: Optional[float] = None,
+    ts_to: Optional[float] = None,
+    resolution: str = 'auto',
+    token: str = Depends(check_role(['admin', 'user', 'readonly']))
+):
+    ts_to = ts_to or time.time()
+    ts_from = ts_from or ts_to - 86400
+    resolution, rows = query_telemetry(metric, server_id, device_id, ts_from, ts_to, resolution)
+    return {
+        'metric': metric,
+        'resolution': resolution,
+        'points': [{'device_id': r[0], 'ts': r[1], 'avg': r[2], 'min': r[3], 'max': r[4], 'count': r[5]} for r in rows]
+    }
+
+@app.get('/api/telemetry/metrics')
+def telemetry_metrics(server_id: Optional[str] = None):
+    """Метрики и устройства, по которым есть телеметрия (для фильтров страницы аналитики)."""
+    query = 'SELECT DISTINCT metric, device_id FROM telemetry_1h'
+    params = []
+    if server_id:
+        query += ' WHERE server_id=?'
+        params.append(server_id)
+    with db.connect() as conn:
+        rows = conn.execute(query + ' ORDER BY metric, device_id', params).fetchall()
+    metrics = {}
+    for metric, device_id in rows:
+        metrics.setdefault(metric, []).append(device_id)
+    return {'metrics': metrics}
+
 # --- API: экспорт скринов (CSV или ZIP) ---
 @app.get("/export/screenshots")
 def export_screenshots(
@@ -506,7 +1971,7 @@ def export_screenshots(
     - format=csv — метаданные в CSV
     - format=zip — архив файлов скринов
     """
-    screenshots = list_screenshots(server_id, window, device_id, text, created_at_from, created_at_to)
+    screenshots, _ = query_screenshots(server_id, window, device_id, text=text, created_at_from=created_at_from, created_at_to=created_at_to)
     if format == 'csv':
         output = io.StringIO()
         fieldnames = ["server_id", "window", "device_id", "filename", "created_at"]
@@ -521,7 +1986,7 @@ def export_screenshots(
         mem_zip = io.BytesIO()
         with zipfile.ZipFile(mem_zip, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
             for s in screenshots:
-                file_path = DATA_DIR / s['server_id'] / s['window'] / s['filename']
+                file_path = screenshot_file(s)
                 if file_path.exists():
                     zf.write(file_path, arcname=f"{s['server_id']}/{s['window']}/{s['filename']}")
         mem_zip.seek(0)
@@ -565,47 +2030,20 @@ def api_command_history(
     created_at_to: Optional[str] = None,
     format: str = 'json',  # 'json', 'csv', 'xlsx'
     limit: int = 1000,
+    cursor: Optional[str] = None,
     token: str = Depends(check_role(['admin']))
 ):
     """
     Получить историю команд с фильтрацией:
-    - server_id, device_id, command, status, text (LIKE по command/params), created_at_from/to
+    - server_id, device_id, command, status, text (полнотекстовый поиск по command/params/status/server_id/device_id), created_at_from/to
     - format: json (default), csv, xlsx
+    - cursor: страница после курсора; курсор следующей страницы — в заголовке X-Next-Cursor
     """
-    query = 'SELECT id, server_id, device_id, command, params, status, created_at FROM commands WHERE 1=1'
-    params = []
-    if server_id:
-        query += ' AND server_id=?'
-        params.append(server_id)
-    if device_id:
-        query += ' AND device_id=?'
-        params.append(device_id)
-    if command:
-        query += ' AND command=?'
-        params.append(command)
-    if status:
-        query += ' AND status=?'
-        params.append(status)
-    if text:
-        query += ' AND (command LIKE ? OR params LIKE ? OR status LIKE ? OR server_id LIKE ? OR device_id LIKE ?)'  # расширенный поиск
-        like = f"%{text}%"
-        params.extend([like, like, like, like, like])
-    if created_at_from:
-        query += ' AND created_at >= ?'
-        params.append(created_at_from)
-    if created_at_to:
-        query += ' AND created_at <= ?'
-        params.append(created_at_to)
-    query += ' ORDER BY created_at DESC LIMIT ?'
-    params.append(limit)
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(query, params)
-        rows = c.fetchall()
+    data, next_cursor = query_command_history(server_id, device_id, command, status, text, created_at_from, created_at_to, cursor, limit)
     columns = ["id", "server_id", "device_id", "command", "params", "status", "created_at"]
-    data = [dict(zip(columns, r)) for r in rows]
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
     if format == 'json':
-        return data
+        return JSONResponse(data, headers=headers)
     elif format == 'csv':
         import io, csv
         output = io.StringIO()
@@ -614,7 +2052,7 @@ def api_command_history(
         for row in data:
             writer.writerow(row)
         output.seek(0)
-        return StreamingResponse(io.BytesIO(output.getvalue().encode('utf-8')), media_type='text/csv', headers={"Content-Disposition": "attachment; filename=command_history.csv"})
+        return StreamingResponse(io.BytesIO(output.getvalue().encode('utf-8')), media_type='text/csv', headers={"Content-Disposition": "attachment; filename=command_history.csv", **headers})
     elif format == 'xlsx':
         wb = openpyxl.Workbook()
         ws = wb.active
@@ -628,10 +2066,55 @@ def api_command_history(
         output = io.BytesIO()
         wb.save(output)
         output.seek(0)
-        return StreamingResponse(output, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', headers={"Content-Disposition": "attachment; filename=command_history.xlsx"})
+        return StreamingResponse(output, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', headers={"Content-Disposition": "attachment; filename=command_history.xlsx", **headers})
     else:
         return JSONResponse({"error": "format must be json, csv or xlsx"}, status_code=400)
 
+def query_command_history(
+    server_id: Optional[str] = None,
+    device_id: Optional[str] = None,
+    command: Optional[str] = None,
+    status: Optional[str] = None,
+    text: Optional[str] = None,
+    created_at_from: Optional[str] = None,
+    created_at_to: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 1000
+):
+    """Страница истории команд (новые сверху): (записи, курсор следующей страницы или None)."""
+    query = 'SELECT id, server_id, device_id, command, params, status, created_at, created_ts FROM commands WHERE 1=1'
+    params = []
+    if server_id:
+        query += ' AND server_id=?'
+        params.append(server_id)
+    if device_id:
+        query += ' AND device_id=?'
+        params.append(device_id)
+    if command:
+        query += ' AND command=?'
+        params.append(command)
+    if status:
+        query += ' AND status=?'
+        params.append(status)
+    if text:
+        cond, cond_params = text_search_sql('commands', text)  # расширенный поиск: command/params/status/server_id/device_id
+        query += f' AND {cond}'
+        params.extend(cond_params)
+    cond, cond_params = created_range_sql(created_at_from, created_at_to)
+    keyset, keyset_params = keyset_sql(cursor)
+    query += ''.join(f' AND {c}' for c in cond + keyset)
+    params.extend(cond_params + keyset_params)
+    limit = page_limit(limit)
+    query += ' ORDER BY created_ts DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+    with db.connect() as conn:
+        c = conn.cursor()
+        c.execute(query, params)
+        rows = c.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1][7], rows[limit - 1][0]) if len(rows) > limit else None
+    columns = ["id", "server_id", "device_id", "command", "params", "status", "created_at"]
+    return [dict(zip(columns, r)) for r in rows[:limit]], next_cursor
+
 # --- UI: страница истории команд ---
 @app.get('/command_history', response_class=HTMLResponse)
 def command_history_page(
@@ -643,12 +2126,13 @@ def command_history_page(
     text: Optional[str] = Query(None),
     created_at_from: Optional[str] = Query(None),
     created_at_to: Optional[str] = Query(None),
-    limit: int = Query(1000)
+    limit: int = Query(1000),
+    cursor: Optional[str] = Query(None)
 ):
-    # Получаем историю команд для отображения
-    data = api_command_history(server_id, device_id, command, status, text, created_at_from, created_at_to, 'json', limit)
+    # Получаем страницу истории команд для отображения
+    data, next_cursor = query_command_history(server_id, device_id, command, status, text, created_at_from, created_at_to, cursor, limit)
     # Для фильтров — получить уникальные значения
-    with sqlite3.connect(DB_PATH) as conn:
+    with db.connect() as conn:
         c = conn.cursor()
         c.execute('SELECT DISTINCT server_id FROM commands ORDER BY server_id')
         servers = [r[0] for r in c.fetchall()]
@@ -672,7 +2156,8 @@ def command_history_page(
         "text": text,
         "created_at_from": created_at_from,
         "created_at_to": created_at_to,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": next_cursor
     })
 
 # --- UI: страница аналитики и графиков ---
@@ -687,16 +2172,22 @@ def parse_date(val):
     except Exception:
         return None
 
-def date_filter_sql(field, date_from, date_to):
-    cond = []
-    params = []
-    if date_from:
-        cond.append(f"{field} >= ?")
-        params.append(date_from + ' 00:00:00')
-    if date_to:
-        cond.append(f"{field} <= ?")
-        params.append(date_to + ' 23:59:59')
-    return cond, params
+def date_bounds(date_from, date_to):
+    """Даты YYYY-MM-DD (включительно) -> границы created_at."""
+    return date_from and date_from + ' 00:00:00', date_to and date_to + ' 23:59:59'
+
+def date_filter_sql(date_from, date_to):
+    """Условия по датам YYYY-MM-DD (включительно) — по индексируемому created_ts."""
+    return created_range_sql(*date_bounds(date_from, date_to))
+
+def count_partitioned(table: str, group: str, where: str, params: list, date_from=None, date_to=None, server_id=None) -> Counter:
+    """count(*) по группам (выражение group) со всех партиций диапазона дат."""
+    ts_from, ts_to = partition_range(*date_bounds(date_from, date_to))
+    counts = Counter()
+    for key, count in partitions.query(f'SELECT {group} AS k, count(*) AS n FROM {{p}}.{table} {where} GROUP BY k', params,
+                                       limit=None, ts_from=ts_from, ts_to=ts_to, server_id=server_id):
+        counts[key] += count
+    return counts
 
 @app.get('/api/analytics/summary')
 def analytics_summary(
@@ -713,17 +2204,15 @@ def analytics_summary(
     if device_id:
         cond.append('device_id=?')
         params.append(device_id)
-    date_cond, date_params = date_filter_sql('created_at', date_from, date_to)
+    date_cond, date_params = date_filter_sql(date_from, date_to)
     cond += date_cond
     params += date_params
     where = 'WHERE ' + ' AND '.join(cond) if cond else ''
-    # Скриншоты по дням
-    with sqlite3.connect(DB_PATH) as conn:
+    # Скриншоты и логи по дням — из партиций, статусы команд — из основной БД
+    screens = sorted(count_partitioned('screenshots', 'substr(created_at,1,10)', where, params, date_from, date_to, server_id).items())
+    logs = sorted(count_partitioned('messages', 'substr(created_at,1,10)', where, params, date_from, date_to, server_id).items())
+    with db.connect() as conn:
         c = conn.cursor()
-        c.execute(f'''SELECT substr(created_at,1,10) as day, count(*) FROM screenshots {where} GROUP BY day ORDER BY day''', params)
-        screens = c.fetchall()
-        c.execute(f'''SELECT substr(created_at,1,10) as day, count(*) FROM messages {where} GROUP BY day ORDER BY day''', params)
-        logs = c.fetchall()
         c.execute(f'''SELECT status, count(*) FROM commands {where} GROUP BY status''', params)
         cmd_status = c.fetchall()
     # Chart.js формат
@@ -767,14 +2256,11 @@ def analytics_device_activity(
     if server_id:
         cond.append('server_id=?')
         params.append(server_id)
-    date_cond, date_params = date_filter_sql('created_at', date_from, date_to)
+    date_cond, date_params = date_filter_sql(date_from, date_to)
     cond += date_cond
     params += date_params
     where = 'WHERE ' + ' AND '.join(cond) if cond else ''
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(f'''SELECT device_id, count(*) FROM screenshots {where} GROUP BY device_id ORDER BY count(*) DESC''', params)
-        rows = c.fetchall()
+    rows = count_partitioned('screenshots', 'device_id', where, params, date_from, date_to, server_id).most_common()
     labels = [r[0] for r in rows]
     data = [r[1] for r in rows]
     return {
@@ -801,14 +2287,11 @@ def analytics_errors(
     if device_id:
         cond.append('device_id=?')
         params.append(device_id)
-    date_cond, date_params = date_filter_sql('created_at', date_from, date_to)
+    date_cond, date_params = date_filter_sql(date_from, date_to)
     cond += date_cond
     params += date_params
     where = 'WHERE ' + ' AND '.join(cond) if cond else ''
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute(f'''SELECT substr(created_at,1,10) as day, count(*) FROM messages {where} GROUP BY day ORDER BY day''', params)
-        rows = c.fetchall()
+    rows = sorted(count_partitioned('messages', 'substr(created_at,1,10)', where, params, date_from, date_to, server_id).items())
     days = [r[0] for r in rows]
     data = [r[1] for r in rows]
     return {
@@ -835,11 +2318,11 @@ def analytics_commands_history(
     if device_id:
         cond.append('device_id=?')
         params.append(device_id)
-    date_cond, date_params = date_filter_sql('created_at', date_from, date_to)
+    date_cond, date_params = date_filter_sql(date_from, date_to)
     cond += date_cond
     params += date_params
     where = 'WHERE ' + ' AND '.join(cond) if cond else ''
-    with sqlite3.connect(DB_PATH) as conn:
+    with db.connect() as conn:
         c = conn.cursor()
         c.execute(f'''SELECT substr(created_at,1,10) as day, count(*) FROM commands {where} GROUP BY day ORDER BY day''', params)
         rows = c.fetchall()
@@ -853,4 +2336,34 @@ def analytics_commands_history(
             },
             "options": {"responsive": True, "plugins": {"legend": {"display": False}}}
         }
-    } 
\ No newline at end of file
+    } 
+@app.get('/api/analytics/telemetry')
+def analytics_telemetry(
+    metric: str = 'battery_pct',
+    server_id: Optional[str] = None,
+    device_id: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None
+):
+    dt_from, dt_to = parse_date(date_from) if date_from else None, parse_date(date_to) if date_to else None
+    ts_to = (dt_to + timedelta(days=1)).timestamp() if dt_to else time.time()
+    ts_from = dt_from.timestamp() if dt_from else ts_to - 86400
+    resolution, rows = query_telemetry(metric, server_id, device_id, ts_from, ts_to)
+    labels = sorted({r[1] for r in rows})
+    series = {}
+    for dev, ts, avg, vmin, vmax, cnt in rows:
+        series.setdefault(dev, {})[ts] = round(avg, 2)
+    fmt = '%H:%M' if resolution == 'raw' else '%d.%m %H:%M'
+    colors = ['#0077cc', '#c0392b', '#27ae60', '#8e44ad', '#d35400', '#16a085', '#2c3e50', '#f39c12']
+    return {
+        "telemetry": {
+            "resolution": resolution,
+            "data": {
+                "labels": [datetime.fromtimestamp(ts).strftime(fmt) for ts in labels],
+                "datasets": [{"label": dev, "data": [points.get(ts) for ts in labels], "borderColor": colors[i % len(colors)],
+                              "spanGaps": True, "tension": 0.2, "pointRadius": 0}
+                             for i, (dev, points) in enumerate(sorted(series.items())[:20])]
+            },
+            "options": {"responsive": True, "plugins": {"legend": {"display": True}}}
+        }
+    }
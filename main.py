@@ -18,6 +18,7 @@ import sqlite3
 from contextlib import closing
 import traceback
 import asyncio
+import hashlib
 
 # --- Автоматическое создание всех нужных папок, шаблонов и config.yaml ---
 def ensure_dirs():
@@ -121,6 +122,109 @@ def log(msg: str):
     print(msg)
     log_manager.log(msg)
 
+# --- Шардирование ADB: несколько adb server на разных портах (ANDROID_ADB_SERVER_PORT) ---
+def adb_shard_port(device_id: str, ports: List[int]) -> int:
+    """Стабильное распределение устройства по adb server (rendezvous hashing, как в agent/adb_shards.py)."""
+    return max(ports, key=lambda port: hashlib.md5(f'{port}|{device_id}'.encode()).hexdigest())
+
+class AdbShards:
+    """
+    Пул adb server (global.adb_server_ports в config.yaml, по умолчанию один сервер).
+    Каждое устройство всегда работает через свой шард; ошибки ADB учитываются по шардам,
+    и при серии ошибок нескольких устройств перезапускается только adb server этого шарда
+    (ошибки одного устройства — проблема устройства, а не adb server).
+    """
+    def __init__(self, global_cfg: Dict[str, Any]):
+        self.adb_path = global_cfg.get('adb_path', 'adb')
+        default_port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+        self.ports = [int(p) for p in global_cfg.get('adb_server_ports', [])] or [default_port]
+        self.max_failures = global_cfg.get('adb_shard_max_failures', 5)
+        self.min_devices = global_cfg.get('adb_shard_min_devices', 2)
+        self.failures = {p: {} for p in self.ports}   # ошибки подряд по устройствам шарда
+        self.seen = {p: set() for p in self.ports}
+        self.restarting = set()
+        self.restarts = {p: 0 for p in self.ports}
+        self.network_devices = {p: set() for p in self.ports}
+        self.lock = threading.Lock()
+
+    def port_for(self, device_id: str) -> int:
+        return adb_shard_port(device_id, self.ports)
+
+    def env_for(self, device_id: str) -> Dict[str, str]:
+        return dict(os.environ, ANDROID_ADB_SERVER_PORT=str(self.port_for(device_id)))
+
+    def run(self, port: int, *args) -> subprocess.CompletedProcess:
+        env = dict(os.environ, ANDROID_ADB_SERVER_PORT=str(port))
+        return subprocess.run([self.adb_path, *args], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=30)
+
+    def register(self, device_id: str):
+        if ':' in device_id:
+            self.network_devices[self.port_for(device_id)].add(device_id)
+
+    def start_shard(self, port: int):
+        try:
+            self.run(port, 'start-server')
+            for device_id in sorted(self.network_devices[port]):
+                self.run(port, 'connect', device_id)
+        except Exception as e:
+            log(f"[ADB:{port}] Ошибка запуска adb server: {e}")
+
+    def start(self):
+        for port in self.ports:
+            self.start_shard(port)
+
+    def restart_shard(self, port: int):
+        """Перезапуск одного adb server — устройства других шардов не затрагиваются."""
+        log(f"[ADB:{port}] Перезапуск adb server шарда")
+        self.restarts[port] += 1
+        try:
+            self.run(port, 'kill-server')
+        except Exception as e:
+            log(f"[ADB:{port}] Ошибка kill-server: {e}")
+        self.start_shard(port)
+
+    def record(self, device_id: str, ok: bool):
+        """
+        Учесть результат команды ADB. Шард перезапускается, когда без единого успеха на нём накопилось
+        max_failures ошибок от min_devices разных устройств (или от всех устройств шарда, если их меньше).
+        Перезапуск (kill-server, start-server, connect) идёт вне блокировки: другие потоки не ждут его.
+        """
+        port = self.port_for(device_id)
+        with self.lock:
+            self.seen[port].add(device_id)
+            if ok:
+                # шард отвечает — ошибки остальных устройств не говорят о проблеме adb server
+                self.failures[port].clear()
+                return
+            failures = self.failures[port]
+            failures[device_id] = failures.get(device_id, 0) + 1
+            if (sum(failures.values()) < self.max_failures or len(failures) < min(self.min_devices, len(self.seen[port]))
+                    or port in self.restarting):
+                return
+            failures.clear()
+            self.restarting.add(port)
+        try:
+            self.restart_shard(port)
+        finally:
+            with self.lock:
+                self.restarting.discard(port)
+
+    def devices(self) -> List[str]:
+        lines = []
+        for port in self.ports:
+            try:
+                out = self.run(port, 'devices').stdout.strip().split('\n')
+            except Exception as e:
+                out = [f"Ошибка: {e}"]
+            lines.append(f"# adb:{port}")
+            lines.extend(out)
+        return lines
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [{'port': p, 'failures': sum(self.failures[p].values()), 'failing_devices': sorted(self.failures[p]),
+                     'restarts': self.restarts[p], 'network_devices': sorted(self.network_devices[p])} for p in self.ports]
+
 # --- DeviceSession ---
 class DeviceSession:
     """
@@ -128,10 +232,12 @@ class DeviceSession:
     Поддерживает старт/стоп/пауза/резюм, выполнение шагов, хранит состояние.
     Поддерживает verify_screen и расширенные скриншоты.
     """
-    def __init__(self, device_id: str, scenario: List[Dict[str, Any]], global_cfg: Dict[str, Any]):
+    def __init__(self, device_id: str, scenario: List[Dict[str, Any]], global_cfg: Dict[str, Any], shards: Optional[AdbShards] = None):
         self.device_id = device_id
         self.scenario = scenario
         self.global_cfg = global_cfg
+        self.shards = shards
+        self.adb_env = shards.env_for(device_id) if shards else None
         self.state = 'stopped'  # running, paused, stopped
         self.current_step = 0
         self.lock = threading.Lock()
@@ -224,7 +330,7 @@ class DeviceSession:
         center_x = max_loc[0] + w // 2
         center_y = max_loc[1] + h // 2
         cmd = [self.global_cfg.get('adb_path', 'adb'), '-s', self.device_id, 'shell', 'input', 'tap', str(center_x), str(center_y)]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.adb_env)
         if result.returncode != 0:
             return StepResult(success=False, message=f"Ошибка ADB: {result.stderr}")
         log(f"[Device {self.device_id}] Клик по ({center_x},{center_y}) по шаблону {template}")
@@ -251,11 +357,11 @@ class DeviceSession:
         Path(screenshot_dir).mkdir(parents=True, exist_ok=True)
         final_path = Path(screenshot_dir) / f"{self.device_id}_{section}_{int(time.time())}.png"
         cmd = [self.global_cfg.get('adb_path', 'adb'), '-s', self.device_id, 'shell', 'screencap', '-p', '/sdcard/tmp_screen.png']
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.adb_env)
         if result.returncode != 0:
             return StepResult(success=False, message=f"Ошибка screencap: {result.stderr}")
         cmd = [self.global_cfg.get('adb_path', 'adb'), '-s', self.device_id, 'pull', '/sdcard/tmp_screen.png', str(final_path)]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.adb_env)
         if result.returncode != 0:
             return StepResult(success=False, message=f"Ошибка pull: {result.stderr}")
         log(f"[Device {self.device_id}] Верификация успешна, скриншот сохранён: {final_path}")
@@ -264,7 +370,7 @@ class DeviceSession:
     def input_text(self, step: Dict[str, Any]) -> StepResult:
         text = step.get('text', '')
         cmd = [self.global_cfg.get('adb_path', 'adb'), '-s', self.device_id, 'shell', 'input', 'text', text.replace(' ', '%s')]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.adb_env)
         if result.returncode != 0:
             return StepResult(success=False, message=f"Ошибка ADB: {result.stderr}")
         log(f"[Device {self.device_id}] Введён текст: {text}")
@@ -282,11 +388,13 @@ class DeviceSession:
         Path(screenshot_dir).mkdir(parents=True, exist_ok=True)
         screenshot_path = step.get('screenshot_path', str(Path(screenshot_dir) / f"{self.device_id}_{section}_{int(time.time())}.png"))
         cmd = [self.global_cfg.get('adb_path', 'adb'), '-s', self.device_id, 'shell', 'screencap', '-p', '/sdcard/tmp_screen.png']
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.adb_env)
+        if self.shards:
+            self.shards.record(self.device_id, result.returncode == 0)
         if result.returncode != 0:
             return StepResult(success=False, message=f"Ошибка screencap: {result.stderr}")
         cmd = [self.global_cfg.get('adb_path', 'adb'), '-s', self.device_id, 'pull', '/sdcard/tmp_screen.png', screenshot_path]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=self.adb_env)
         if result.returncode != 0:
             return StepResult(success=False, message=f"Ошибка pull: {result.stderr}")
         log(f"[Device {self.device_id}] Скриншот сохранён: {screenshot_path}")
@@ -315,6 +423,9 @@ class DeviceManager:
         self.sessions: Dict[str, DeviceSession] = {}
         self.global_cfg = config.get('global', {})
         self.buttons = {b['name']: b for b in config.get('buttons', [])}
+        self.adb_shards = AdbShards(self.global_cfg)
+        for dev in config.get('devices', []):
+            self.adb_shards.register(dev['id'])
         self.load_sessions()
 
     def load_sessions(self):
@@ -324,9 +435,10 @@ class DeviceManager:
                 continue
             scenario_name = dev.get('scenario', 'default')
             scenario = scenarios.get(scenario_name, {}).get('steps', [])
-            self.sessions[dev['id']] = DeviceSession(dev['id'], scenario, self.global_cfg)
+            self.sessions[dev['id']] = DeviceSession(dev['id'], scenario, self.global_cfg, self.adb_shards)
 
     def start_all(self):
+        self.adb_shards.start()
         for session in self.sessions.values():
             session.start()
 
@@ -382,10 +494,10 @@ class DeviceManager:
             if dev_id in self.sessions:
                 self.sessions[dev_id].stop()
                 time.sleep(0.2)
-                self.sessions[dev_id] = DeviceSession(dev_id, scenario, self.global_cfg)
+                self.sessions[dev_id] = DeviceSession(dev_id, scenario, self.global_cfg, self.adb_shards)
                 self.sessions[dev_id].start()
             else:
-                self.sessions[dev_id] = DeviceSession(dev_id, scenario, self.global_cfg)
+                self.sessions[dev_id] = DeviceSession(dev_id, scenario, self.global_cfg, self.adb_shards)
                 self.sessions[dev_id].start()
         log(f"Кнопка {button_name} запущена для устройств: {targets}")
         return f"Кнопка {button_name} запущена для устройств: {targets}"
@@ -407,7 +519,7 @@ manager: Optional[DeviceManager] = None
 MONITOR_SCREEN_DIR = Path('screenshots/monitor')
 MONITOR_SCREEN_DIR.mkdir(parents=True, exist_ok=True)
 
-def take_monitor_screenshot(device_id: str, adb_path: str = 'adb') -> Optional[str]:
+def take_monitor_screenshot(device_id: str, adb_path: str = 'adb', env: Optional[Dict[str, str]] = None) -> Optional[str]:
     """Делает мониторинговый скриншот для устройства и сохраняет как <device_id>.png"""
     safe_id = device_id.replace(':', '_')
     out_path = MONITOR_SCREEN_DIR / f"{safe_id}.png"
@@ -415,12 +527,12 @@ def take_monitor_screenshot(device_id: str, adb_path: str = 'adb') -> Optional[s
     try:
         # Снимаем скриншот через ADB
         cmd1 = [adb_path, '-s', device_id, 'shell', 'screencap', '-p', '/sdcard/tmp_monitor.png']
-        res1 = subprocess.run(cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=10)
+        res1 = subprocess.run(cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=10, env=env)
         if res1.returncode != 0:
             log(f"[MONITOR] Ошибка screencap {device_id}: {res1.stderr}")
             return None
         cmd2 = [adb_path, '-s', device_id, 'pull', '/sdcard/tmp_monitor.png', tmp_path]
-        res2 = subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=10)
+        res2 = subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=10, env=env)
         if res2.returncode != 0:
             log(f"[MONITOR] Ошибка pull {device_id}: {res2.stderr}")
             return None
@@ -442,7 +554,7 @@ def monitor_background_task():
             if manager is not None:
                 for dev in manager.sessions.keys():
                     adb_path = manager.global_cfg.get('adb_path', 'adb')
-                    take_monitor_screenshot(dev, adb_path)
+                    take_monitor_screenshot(dev, adb_path, manager.adb_shards.env_for(dev))
         except Exception as e:
             log(f"[MONITOR] Ошибка фоновой задачи: {e}")
         time.sleep(30)
@@ -613,8 +725,7 @@ def get_latest_screenshots(n: int = 10):
 
 def get_adb_devices():
     try:
-        result = subprocess.run([manager.global_cfg.get('adb_path', 'adb'), 'devices'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return result.stdout.strip().split('\n')
+        return manager.adb_shards.devices()
     except Exception as e:
         return [f"Ошибка: {e}"]
 
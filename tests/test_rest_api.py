@@ -4,6 +4,9 @@ import tempfile
 import os
 import time
 import yaml
+import hashlib
+import csv
+import io
 from pathlib import Path
 from subprocess import Popen
 from datetime import datetime
@@ -15,6 +18,7 @@ class TestRestAPI(unittest.TestCase):
         cls.server_dir = cls.project_root / 'central_server'
         cls.data_dir = cls.server_dir / 'data'
         cls.db_path = cls.server_dir / 'db.sqlite3'
+        cls.partitions_dir = cls.server_dir / 'partitions'
         # Создаём временный config.yaml
         cls.tmp_cfg = tempfile.NamedTemporaryFile('w+', suffix='.yaml', delete=False)
         cfg = {
@@ -47,9 +51,10 @@ class TestRestAPI(unittest.TestCase):
         except Exception:
             pass
         # Чистим тестовые данные
-        if cls.data_dir.exists():
-            import shutil
-            shutil.rmtree(cls.data_dir)
+        import shutil
+        for path in (cls.data_dir, cls.partitions_dir):
+            if path.exists():
+                shutil.rmtree(path)
         import time
         if cls.db_path.exists():
             for _ in range(5):
@@ -59,6 +64,10 @@ class TestRestAPI(unittest.TestCase):
                 except PermissionError:
                     time.sleep(0.5)
 
+    @classmethod
+    def current_partition(cls):
+        return cls.partitions_dir / (datetime.utcnow().strftime('%Y-%m') + '.sqlite3')
+
     @classmethod
     def wait_server_ready(cls, url, timeout=15):
         start = time.time()
@@ -83,7 +92,7 @@ class TestRestAPI(unittest.TestCase):
             'device_id': 'test_device',
             'meta': '{}'
         }
-        r = requests.post(url, files=files, data=data, headers=self.auth(), timeout=10)
+        r = requests.post(url, params={'durable': 1}, files=files, data=data, headers=self.auth(), timeout=10)
         self.assertTrue(r.ok)
 
     def test_02_send_log(self):
@@ -94,7 +103,7 @@ class TestRestAPI(unittest.TestCase):
             'type': 'info',
             'message': 'Test log'
         }
-        r = requests.post(url, json=payload, headers=self.auth(), timeout=10)
+        r = requests.post(url, params={'durable': 1}, json=payload, headers=self.auth(), timeout=10)
         self.assertTrue(r.ok)
 
     def test_03_export_screenshots_csv(self):
@@ -237,5 +246,482 @@ class TestRestAPI(unittest.TestCase):
         r = requests.post(url, data=data, headers={'Authorization': 'Bearer userkey'}, timeout=10, allow_redirects=False)
         self.assertIn(r.status_code, (303, 200))
 
+    def test_19_upload_webp_screenshot(self):
+        url = 'http://127.0.0.1:8000/upload_screenshot'
+        files = {'image': ('last.webp', b'RIFF\x00\x00\x00\x00WEBPVP8 ' + b'0'*2000, 'image/webp')}
+        data = {
+            'server_id': 'test-server',
+            'window': 'main',
+            'device_id': 'test_device_webp',
+            'section': 'monitor',
+            'meta': '{}'
+        }
+        r = requests.post(url, params={'durable': 1}, files=files, data=data, headers=self.auth(), timeout=10)
+        self.assertTrue(r.ok)
+        self.assertTrue(r.json()['path'].endswith('.webp'))
+        r = requests.get('http://127.0.0.1:8000/download_last/test-server/main/test_device_webp', timeout=10)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['content-type'], 'image/webp')
+        r = requests.get('http://127.0.0.1:8000/screenshots?device_id=test_device_webp', timeout=10)
+        self.assertEqual(r.json()[0]['content_type'], 'image/webp')
+
+    def test_20_agent_channel_push(self):
+        import json
+        from websockets.sync.client import connect
+        ws_url = 'ws://127.0.0.1:8000/ws/agent?server_id=ws-server'
+        with connect(ws_url, additional_headers=self.auth(), open_timeout=5) as ws:
+            ws.send(json.dumps({'type': 'heartbeat'}))
+            self.assertEqual(json.loads(ws.recv(timeout=5))['type'], 'heartbeat')
+            data = {'server_id': 'ws-server', 'device_id': 'ws_device', 'command': 'echo', 'params': '{"msg": "push"}'}
+            r = requests.post('http://127.0.0.1:8000/commands', data=data, headers=self.auth(), timeout=10, allow_redirects=False)
+            self.assertIn(r.status_code, (303, 200))
+            msg = json.loads(ws.recv(timeout=5))
+            self.assertEqual(msg['type'], 'command')
+            cmd = msg['command']
+            self.assertEqual(cmd['device_id'], 'ws_device')
+            self.assertEqual(cmd['params'], {'msg': 'push'})
+            # некорректные кадры пропускаются, канал остаётся открытым
+            for bad in ('not json', '[1]', '{"type": "ack"}', '{"type": "ack", "command_id": "x"}', '{"type": "result", "command_id": null}'):
+                ws.send(bad)
+            ws.send(json.dumps({'type': 'ack', 'command_id': cmd['id']}))
+            ws.send(json.dumps({'type': 'result', 'command_id': cmd['id'], 'status': 'done', 'result': 'ok'}))
+            ws.send(json.dumps({'type': 'heartbeat'}))
+            ws.recv(timeout=5)
+        r = requests.get('http://127.0.0.1:8000/api/command_history?server_id=ws-server', headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()[0]['status'], 'done')
+
+    def test_21_agent_channel_requires_auth(self):
+        from websockets.sync.client import connect
+        with self.assertRaises(Exception):
+            with connect('ws://127.0.0.1:8000/ws/agent?server_id=ws-server',
+                         additional_headers={'Authorization': 'Bearer guestkey'}, open_timeout=5) as ws:
+                ws.recv(timeout=5)
+
+    def test_22_upload_frames_batch(self):
+        import io
+        import json
+        import zipfile
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('1000.webp', b'RIFF')
+            zf.writestr('manifest.json', json.dumps([
+                {'ts': 1000.0, 'section': 'default', 'hash': 'a', 'file': '1000.webp'},
+                {'ts': 1005.0, 'section': 'default', 'hash': 'a', 'file': '1000.webp'}
+            ]))
+        files = {'archive': ('frames.zip', buf.getvalue(), 'application/zip')}
+        data = {'server_id': 'test-server', 'device_id': 'frames_device', 'command_id': '1', 'frames': '2'}
+        r = requests.post('http://127.0.0.1:8000/api/upload_frames', files=files, data=data, headers=self.auth(), timeout=10)
+        self.assertTrue(r.ok, r.text)
+        batch_id = r.json()['id']
+        r = requests.get('http://127.0.0.1:8000/api/frame_batches?device_id=frames_device', headers=self.auth(), timeout=10)
+        batch = r.json()[0]
+        self.assertEqual((batch['id'], batch['frames'], batch['first_ts'], batch['last_ts']), (batch_id, 2, 1000.0, 1005.0))
+        r = requests.get(f'http://127.0.0.1:8000/download_frames/{batch_id}', headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, buf.getvalue())
+        files = {'archive': ('bad.zip', b'not a zip', 'application/zip')}
+        r = requests.post('http://127.0.0.1:8000/api/upload_frames', files=files, data=data, headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 400)
+        # кадр манифеста без ts — 400, а не 500
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('manifest.json', json.dumps([{'section': 'default', 'file': '1000.webp'}]))
+        files = {'archive': ('no_ts.zip', buf.getvalue(), 'application/zip')}
+        r = requests.post('http://127.0.0.1:8000/api/upload_frames', files=files, data=data, headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 400)
+
+    def test_23_telemetry_downsampling(self):
+        base = int(time.time()) // 3600 * 3600 - 3600  # начало прошлого часа (старые сэмплы удаляются при сжатии)
+        samples = [{'device_id': 'tele_device', 'metric': 'battery_pct', 'value': v, 'ts': base + i * 20}
+                   for i, v in enumerate([90, 80, 70, 60])]
+        for status in ('ok', 'duplicate'):
+            # повторная доставка той же пачки (агент не получил ответ) не удваивает агрегаты
+            r = requests.post('http://127.0.0.1:8000/api/telemetry', json={'server_id': 'tele-server', 'batch_id': 'tele-batch-1', 'samples': samples},
+                              headers=self.auth(), timeout=10)
+            self.assertEqual(r.json()['status'], status)
+        self.assertEqual(r.json()['samples'], 0)
+        params = {'metric': 'battery_pct', 'device_id': 'tele_device', 'ts_from': base, 'ts_to': base + 3600}
+        r = requests.get('http://127.0.0.1:8000/api/telemetry', params=params, headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()['resolution'], 'raw')
+        self.assertEqual([p['avg'] for p in r.json()['points']], [90, 80, 70, 60])
+        r = requests.get('http://127.0.0.1:8000/api/telemetry', params=dict(params, resolution='1m'), headers=self.auth(), timeout=10)
+        points = r.json()['points']
+        # 4 сэмпла по 20 сек: первые три — одна минута, последний — следующая
+        self.assertEqual([(p['ts'], p['count'], p['min'], p['max']) for p in points], [(base, 3, 70, 90), (base + 60, 1, 60, 60)])
+        self.assertEqual(points[0]['avg'], 80)
+        r = requests.get('http://127.0.0.1:8000/api/telemetry', params=dict(params, resolution='1h'), headers=self.auth(), timeout=10)
+        self.assertEqual([p['count'] for p in r.json()['points']], [4])
+        r = requests.get('http://127.0.0.1:8000/api/telemetry/metrics?server_id=tele-server', timeout=10)
+        self.assertEqual(r.json()['metrics'], {'battery_pct': ['tele_device']})
+
+    def test_24_device_leases(self):
+        url = 'http://127.0.0.1:8000/api/agents/heartbeat'
+        shared = ['lease-d1', 'lease-d2', 'lease-d3', 'lease-d4']
+        r = requests.post(url, json={'agent_id': 'agent-a', 'capacity': 10, 'devices': shared}, headers=self.auth(), timeout=10)
+        self.assertEqual([l['device_id'] for l in r.json()['leases']], shared)
+        self.assertGreater(r.json()['leases'][0]['expires_in'], 0)
+        # второй агент видит те же устройства и ещё одно своё: своё получает сразу,
+        # а у первого часть аренд перестаёт продлеваться (draining) — без двойного захвата
+        r = requests.post(url, json={'agent_id': 'agent-b', 'capacity': 10, 'devices': shared + ['lease-d5']}, headers=self.auth(), timeout=10)
+        self.assertEqual([l['device_id'] for l in r.json()['leases']], ['lease-d5'])
+        for _ in range(2):
+            r = requests.post(url, json={'agent_id': 'agent-a', 'capacity': 10, 'devices': shared}, headers=self.auth(), timeout=10)
+            leases = r.json()['leases']
+            self.assertEqual(len(leases), 4)
+            self.assertEqual(sum(l['draining'] for l in leases), 1)
+        r = requests.get('http://127.0.0.1:8000/api/agents', headers=self.auth(), timeout=10)
+        agents = {a['agent_id']: a for a in r.json()}
+        self.assertTrue(agents['agent-b']['alive'])
+        self.assertEqual(len(agents['agent-a']['leases']), 4)
+        # эмулятор и loopback — локальные для хоста: у агентов разных хостов это разные устройства,
+        # а сетевое устройство одного server_id арендует только один агент
+        local = ['emulator-5554', '127.0.0.1:5555', '10.0.0.7:5555']
+        for agent, host in (('agent-h1', 'host-1'), ('agent-h2', 'host-2')):
+            r = requests.post(url, json={'agent_id': agent, 'server_id': 'lease-srv', 'host': host, 'capacity': 10, 'devices': local},
+                              headers=self.auth(), timeout=10)
+            self.assertEqual(r.status_code, 200)
+        r = requests.get('http://127.0.0.1:8000/api/agents', headers=self.auth(), timeout=10)
+        agents = {a['agent_id']: a for a in r.json()}
+        held = [sorted(l['device_id'] for l in agents[a]['leases']) for a in ('agent-h1', 'agent-h2')]
+        self.assertEqual(held, [['10.0.0.7:5555', '127.0.0.1:5555', 'emulator-5554'], ['127.0.0.1:5555', 'emulator-5554']])
+        self.assertEqual(agents['agent-h2']['host'], 'host-2')
+
+    def test_25_capture_plan(self):
+        url = 'http://127.0.0.1:8000/api/schedule/plan'
+        devices = [{'device_id': f'plan-d{i}', 'interval': 60} for i in range(4)]
+        r = requests.post(url, json={'agent_id': 'plan-a', 'devices': devices[:2]}, headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 200)
+        r = requests.post(url, json={'agent_id': 'plan-b', 'devices': devices[2:]}, headers=self.auth(), timeout=10)
+        data = r.json()
+        self.assertEqual(set(data['devices']), {'plan-d2', 'plan-d3'})
+        self.assertIn('capacity_per_sec', data['ingest'])
+        # фазы по всему парку: устройства разных агентов не попадают в один слот
+        offsets = {d['device_id']: None for d in devices}
+        r = requests.post(url, json={'agent_id': 'plan-a', 'devices': devices[:2]}, headers=self.auth(), timeout=10)
+        for source in (data['devices'], r.json()['devices']):
+            for device_id, p in source.items():
+                offsets[device_id] = p['offset'] / p['interval']
+        slots = sorted(offsets.values())
+        self.assertEqual(slots, [0.0, 0.25, 0.5, 0.75])
+
+    def test_26_chunked_artifact_upload(self):
+        base = 'http://127.0.0.1:8000/api/artifacts'
+        content = os.urandom(250 * 1024)
+        meta = {'upload_id': 'abc123resume', 'server_id': 'test_server', 'device_id': 'dev1', 'command_id': 7,
+                'kind': 'logcat', 'filename': 'dev1_logcat.txt', 'size': len(content), 'sha256': hashlib.sha256(content).hexdigest()}
+        def put(offset, chunk, checksum=None):
+            headers = dict(self.auth(), **{'X-Chunk-Sha256': checksum or hashlib.sha256(chunk).hexdigest()})
+            return requests.put(f'{base}/abc123resume/chunk', params={'offset': offset}, data=chunk, headers=headers, timeout=10)
+        r = requests.post(base + '/init', json=meta, headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()['offset'], 0)
+        self.assertEqual(put(0, content[:100 * 1024]).json()['offset'], 100 * 1024)
+        # обрыв: агент заново вызывает init и продолжает с принятого смещения
+        r = requests.post(base + '/init', json=meta, headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()['offset'], 100 * 1024)
+        self.assertEqual(put(200 * 1024, content[200 * 1024:]).status_code, 409)
+        self.assertEqual(put(100 * 1024, content[100 * 1024:], checksum='0' * 64).status_code, 422)
+        r = requests.post(f'{base}/abc123resume/complete', headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 409)
+        self.assertEqual(put(100 * 1024, content[100 * 1024:]).json()['offset'], len(content))
+        r = requests.post(f'{base}/abc123resume/complete', headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()['status'], 'ok')
+        artifact_id = r.json()['id']
+        r = requests.get(base, params={'device_id': 'dev1'}, headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()[0]['status'], 'complete')
+        r = requests.get(f'http://127.0.0.1:8000/download_artifact/{artifact_id}', headers=self.auth(), timeout=10)
+        self.assertEqual(r.content, content)
+
+    def test_27_wal_concurrent_writes(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from contextlib import closing
+        import sqlite3
+        def post(i):
+            data = {'server_id': 'test_server', 'device_id': f'wal-{i % 4}', 'type': 'info', 'message': f'msg {i}'}
+            return requests.post('http://127.0.0.1:8000/api/send_message', params={'durable': 1}, json=data, headers=self.auth(), timeout=30).status_code
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            codes = list(pool.map(post, range(64)))
+        self.assertEqual(codes, [200] * 64)
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        with closing(sqlite3.connect(self.current_partition())) as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(conn.execute("SELECT count(*) FROM messages WHERE device_id LIKE 'wal-%'").fetchone()[0], 64)
+
+    def test_28_migrations_and_indexes(self):
+        from contextlib import closing
+        import sqlite3
+        requests.post('http://127.0.0.1:8000/commands', data={'server_id': 'test_server', 'device_id': 'idx-dev', 'command': 'echo', 'params': '{}'},
+                      headers=self.auth(), timeout=10)
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            self.assertGreaterEqual(conn.execute('PRAGMA user_version').fetchone()[0], 2)
+            self.assertIsNotNone(conn.execute("SELECT created_ts FROM commands WHERE device_id='idx-dev'").fetchone()[0])
+            # опрос команд устройства идёт по составному индексу, без полного просмотра и сортировки
+            plan = ' '.join(r[3] for r in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM commands WHERE server_id=? AND device_id=? AND status='pending' ORDER BY created_ts, id",
+                ('test_server', 'idx-dev')))
+            self.assertIn('idx_commands_server_device_status_ts', plan)
+            self.assertNotIn('TEMP B-TREE', plan.replace('FOR RIGHT-MOST ORDER BY', ''))
+        # фильтр по дате через created_ts
+        r = requests.get('http://127.0.0.1:8000/screenshots', params={'created_at_from': '2000-01-01', 'created_at_to': '2000-01-02'},
+                         headers=self.auth(), timeout=10)
+        self.assertEqual(r.json(), [])
+        r = requests.get('http://127.0.0.1:8000/screenshots', params={'created_at_from': '2000-01-01'}, headers=self.auth(), timeout=10)
+        self.assertGreater(len(r.json()), 0)
+
+    def test_29_full_text_search(self):
+        for text in ['Ошибка подключения к серверу авторизации', 'connection refused by gateway', 'gateway timeout after retry']:
+            requests.post('http://127.0.0.1:8000/api/send_message', params={'durable': 1}, json={'server_id': 'fts', 'device_id': 'fts-dev', 'type': 'error', 'message': text},
+                          headers=self.auth(), timeout=10)
+        def search(text):
+            r = requests.get('http://127.0.0.1:8000/export/logs', params={'server_id': 'fts', 'text': text}, headers=self.auth(), timeout=10)
+            return [row['message'] for row in csv.DictReader(io.StringIO(r.text))]
+        # слова по префиксу, в любом порядке
+        self.assertEqual(sorted(search('gate')), ['connection refused by gateway', 'gateway timeout after retry'])
+        self.assertEqual(search('retry gateway'), ['gateway timeout after retry'])
+        self.assertEqual(search('ошиб авторизац'), ['Ошибка подключения к серверу авторизации'])
+        # фраза в кавычках
+        self.assertEqual(search('"refused by gateway"'), ['connection refused by gateway'])
+        self.assertEqual(search('"gateway refused"'), [])
+        # поиск по истории команд (в т.ч. по статусу после обновления)
+        requests.post('http://127.0.0.1:8000/commands', data={'server_id': 'fts', 'device_id': 'fts-dev', 'command': 'custom', 'params': '{"action": "reboot_modem"}'},
+                      headers=self.auth(), timeout=10)
+        r = requests.get('http://127.0.0.1:8000/api/command_history', params={'text': 'reboot_modem'}, headers=self.auth(), timeout=10)
+        self.assertEqual([c['command'] for c in r.json()], ['custom'])
+        cmd_id = r.json()[0]['id']
+        requests.post('http://127.0.0.1:8000/api/command_result', json={'command_id': cmd_id, 'status': 'done'}, headers=self.auth(), timeout=10)
+        r = requests.get('http://127.0.0.1:8000/api/command_history', params={'text': 'reboot done'}, headers=self.auth(), timeout=10)
+        self.assertEqual([c['id'] for c in r.json()], [cmd_id])
+
+    def test_30_structured_screenshot_fields(self):
+        from contextlib import closing
+        import sqlite3
+        url = 'http://127.0.0.1:8000/upload_screenshot'
+        files = {'image': ('s.png', b'\x89PNG' + b'0' * 2000, 'image/png')}
+        data = {'server_id': 'struct', 'window': 'main', 'device_id': 'struct-dev', 'section': 'ban_check',
+                'device_name': 'Pixel 7', 'ip': '10.0.0.7', 'port': '5555', 'meta': '{}'}
+        self.assertTrue(requests.post(url, params={'durable': 1}, files=files, data=data, headers=self.auth(), timeout=10).ok)
+        # старый формат: секция только в meta
+        files = {'image': ('s.png', b'\x89PNG' + b'0' * 2000, 'image/png')}
+        data = {'server_id': 'struct', 'window': 'main', 'device_id': 'struct-old', 'meta': '{"section": "ban_check"}'}
+        self.assertTrue(requests.post(url, params={'durable': 1}, files=files, data=data, headers=self.auth(), timeout=10).ok)
+        r = requests.get('http://127.0.0.1:8000/screenshots', params={'server_id': 'struct', 'section': 'ban_check'}, timeout=10)
+        rows = {s['device_id']: s for s in r.json()}
+        self.assertEqual(set(rows), {'struct-dev', 'struct-old'})
+        self.assertEqual((rows['struct-dev']['device_name'], rows['struct-dev']['ip'], rows['struct-dev']['port']), ('Pixel 7', '10.0.0.7', '5555'))
+        r = requests.get('http://127.0.0.1:8000/screenshots', params={'server_id': 'struct', 'section': 'main'}, timeout=10)
+        self.assertEqual(r.json(), [])
+        with closing(sqlite3.connect(self.current_partition())) as conn:
+            plan = ' '.join(row[3] for row in conn.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM screenshots WHERE server_id=? AND section=? ORDER BY created_ts DESC, id DESC', ('struct', 'ban_check')))
+        self.assertIn('idx_screenshots_server_section_ts', plan)
+
+    def test_31_keyset_pagination(self):
+        for i in range(5):
+            requests.post('http://127.0.0.1:8000/api/send_message', params={'durable': 1}, json={'server_id': 'page', 'device_id': 'page-dev', 'type': 'info', 'message': f'm{i}'},
+                          headers=self.auth(), timeout=10)
+        seen, cursor, pages = [], None, 0
+        while True:
+            params = {'server_id': 'page', 'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            r = requests.get('http://127.0.0.1:8000/api/messages', params=params, headers=self.auth(), timeout=10)
+            seen += [m['message'] for m in r.json()]
+            pages += 1
+            cursor = r.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        # все записи ровно один раз, новые сверху
+        self.assertEqual(seen, ['m4', 'm3', 'm2', 'm1', 'm0'])
+        self.assertEqual(pages, 3)
+        r = requests.get('http://127.0.0.1:8000/api/messages', params={'cursor': 'not-a-cursor'}, headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 400)
+        # HTML: ссылка на следующую страницу
+        r = requests.get('http://127.0.0.1:8000/logs', params={'server_id': 'page', 'limit': 2}, timeout=10)
+        self.assertIn('cursor=', r.text)
+        r = requests.get('http://127.0.0.1:8000/screenshots', params={'limit': 1}, timeout=10)
+        self.assertEqual(len(r.json()), 1)
+        r2 = requests.get('http://127.0.0.1:8000/screenshots', params={'limit': 1, 'cursor': r.headers['X-Next-Cursor']}, timeout=10)
+        self.assertNotEqual(r.json(), r2.json())
+
+    def test_32_group_commit(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from contextlib import closing
+        import sqlite3
+        def send(i):
+            data = {'server_id': 'gc', 'device_id': 'gc-dev', 'type': 'info', 'message': f'gc{i}'}
+            return requests.post('http://127.0.0.1:8000/api/send_message', json=data, headers=self.auth(), timeout=30).status_code
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            self.assertEqual(set(pool.map(send, range(40))), {200})
+        # без durable — ответ до коммита, строки появляются в списке после коммита пачки (список очередь не ждёт)
+        deadline = time.time() + 5
+        while True:
+            r = requests.get('http://127.0.0.1:8000/api/messages', params={'server_id': 'gc', 'limit': 100}, headers=self.auth(), timeout=10)
+            if len(r.json()) == 40 or time.time() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertEqual(len(r.json()), 40)
+        # durable — строка в БД уже к моменту ответа
+        r = requests.post('http://127.0.0.1:8000/api/send_message', params={'durable': 1}, json={'server_id': 'gc', 'device_id': 'gc-dev', 'type': 'info', 'message': 'durable'},
+                          headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 200)
+        with closing(sqlite3.connect(self.current_partition())) as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM messages WHERE server_id='gc' AND message='durable'").fetchone()[0], 1)
+
+    def test_33_month_partitions(self):
+        from contextlib import closing
+        import sqlite3
+        for i in range(3):
+            requests.post('http://127.0.0.1:8000/api/send_message', params={'durable': 1},
+                          json={'server_id': 'part', 'device_id': 'part-dev', 'type': 'info', 'message': f'new{i}'}, headers=self.auth(), timeout=10)
+        # партиция января 2000: снимок текущей партиции, в котором оставлены строки 'part' со старыми датами
+        old_path = self.partitions_dir / '2000-01.sqlite3'
+        with closing(sqlite3.connect(self.current_partition())) as src, closing(sqlite3.connect(old_path)) as dst:
+            src.backup(dst)
+            dst.execute("DELETE FROM messages WHERE server_id != 'part'")
+            dst.execute("UPDATE messages SET message = replace(message, 'new', 'old'), created_ts = 946684800 + id % 1000, created_at = '2000-01-01 00:00:00'")
+            dst.commit()
+        r = requests.get('http://127.0.0.1:8000/api/partitions', headers=self.auth(), timeout=10)
+        self.assertIn('2000-01', [p['month'] for p in r.json()])
+        # одна страница из двух партиций: сначала новые, затем январь 2000
+        r = requests.get('http://127.0.0.1:8000/api/messages', params={'server_id': 'part', 'limit': 4}, headers=self.auth(), timeout=10)
+        self.assertEqual([m['message'] for m in r.json()], ['new2', 'new1', 'new0', 'old2'])
+        r = requests.get('http://127.0.0.1:8000/api/messages', params={'server_id': 'part', 'cursor': r.headers['X-Next-Cursor']}, headers=self.auth(), timeout=10)
+        self.assertEqual([m['message'] for m in r.json()], ['old1', 'old0'])
+        # диапазон дат читает только свою партицию
+        r = requests.get('http://127.0.0.1:8000/api/messages', params={'server_id': 'part', 'created_at_to': '2000-12-31'}, headers=self.auth(), timeout=10)
+        self.assertEqual(len(r.json()), 3)
+        # удаление истории — удаление файла
+        r = requests.delete('http://127.0.0.1:8000/api/partitions', params={'before': '2000-13x'}, headers=self.auth(), timeout=10)
+        self.assertEqual(r.status_code, 400)
+        r = requests.delete('http://127.0.0.1:8000/api/partitions', params={'before': '2000-02'}, headers={'Authorization': 'Bearer userkey'}, timeout=10)
+        self.assertEqual(r.status_code, 403)
+        r = requests.delete('http://127.0.0.1:8000/api/partitions', params={'before': '2000-02'}, headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()['dropped'], [{'month': '2000-01', 'server_id': None}])
+        self.assertFalse(old_path.exists())
+        r = requests.get('http://127.0.0.1:8000/api/messages', params={'server_id': 'part'}, headers=self.auth(), timeout=10)
+        self.assertEqual(len(r.json()), 3)
+        # чтение подключает партиции только для чтения и не создаёт удалённый файл заново
+        self.assertFalse(old_path.exists())
+
+    def test_34_content_addressed_blobs(self):
+        import glob
+        frame = b'\x89PNG\r\n\x1a\n' + os.urandom(4096)
+        paths = []
+        for device_id in ('blob-a', 'blob-b', 'blob-a'):
+            r = requests.post('http://127.0.0.1:8000/upload_screenshot', params={'durable': 1}, files={'image': ('s.png', frame, 'image/png')},
+                              data={'server_id': 'blobs', 'window': 'main', 'device_id': device_id}, headers=self.auth(), timeout=10)
+            self.assertTrue(r.ok)
+            self.assertEqual(r.json()['blob'], hashlib.sha256(frame).hexdigest())
+            paths.append(r.json()['path'])
+        # одинаковый кадр хранится одним файлом, копий last и файлов в каталоге окна нет
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(glob.glob(str(self.data_dir / '.blobs' / '*' / (hashlib.sha256(frame).hexdigest() + '*'))), [paths[0]])
+        self.assertFalse((self.data_dir / 'blobs' / 'main').exists())
+        r = requests.get('http://127.0.0.1:8000/download_last/blobs/main/blob-b', timeout=10)
+        self.assertEqual((r.status_code, r.content), (200, frame))
+        self.assertEqual(r.headers['content-type'], 'image/png')
+        shots = requests.get('http://127.0.0.1:8000/screenshots', params={'server_id': 'blobs'}, timeout=10).json()
+        self.assertEqual(len(shots), 3)
+        # загрузки одной секунды не делят имя файла
+        self.assertEqual(len({s['filename'] for s in shots}), 3)
+        r = requests.get(f"http://127.0.0.1:8000/download/blobs/main/{shots[0]['filename']}", timeout=10)
+        self.assertEqual(r.content, frame)
+        # новый кадр сдвигает указатель last
+        frame2 = frame + b'x'
+        requests.post('http://127.0.0.1:8000/upload_screenshot', params={'durable': 1}, files={'image': ('s.png', frame2, 'image/png')},
+                      data={'server_id': 'blobs', 'window': 'main', 'device_id': 'blob-b'}, headers=self.auth(), timeout=10)
+        r = requests.get('http://127.0.0.1:8000/download_last/blobs/main/blob-b', timeout=10)
+        self.assertEqual(r.content, frame2)
+
+    def test_35_ingest_off_loop_timing(self):
+        from concurrent.futures import ThreadPoolExecutor
+        def upload(i):
+            return requests.post('http://127.0.0.1:8000/upload_screenshot', files={'image': ('s.png', os.urandom(2048), 'image/png')},
+                                 data={'server_id': 'ingest', 'window': 'main', 'device_id': f'ingest-{i % 4}'}, headers=self.auth(), timeout=30)
+        # пока идут загрузки, event loop отвечает на другие запросы
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            uploads = [pool.submit(upload, i) for i in range(24)]
+            self.assertEqual(requests.get('http://127.0.0.1:8000/screenshots', params={'limit': 1}, timeout=10).status_code, 200)
+            responses = [f.result() for f in uploads]
+        self.assertEqual({r.status_code for r in responses}, {200})
+        timing = responses[-1].headers['Server-Timing']
+        for phase in ('queue', 'store', 'db', 'integrations', 'total'):
+            self.assertIn(f'{phase};dur=', timing)
+        r = requests.get('http://127.0.0.1:8000/api/ingest', headers=self.auth(), timeout=10)
+        stats = r.json()
+        self.assertEqual(set(stats['phases_ms']), {'queue', 'store', 'db', 'integrations'})
+        self.assertGreaterEqual(stats['count'], 24)
+        self.assertEqual(stats['inflight'], 0)
+
+    def test_36_renditions(self):
+        try:
+            import cv2
+            import numpy as np
+        except ImportError:
+            self.skipTest('opencv не установлен')
+        img = np.random.randint(0, 255, (1600, 900, 3), dtype=np.uint8)
+        png = cv2.imencode('.png', img)[1].tobytes()
+        r = requests.post('http://127.0.0.1:8000/upload_screenshot', params={'durable': 1}, files={'image': ('s.png', png, 'image/png')},
+                          data={'server_id': 'rend', 'window': 'main', 'device_id': 'rend-dev'}, headers=self.auth(), timeout=10)
+        blob = r.json()['blob']
+        url = 'http://127.0.0.1:8000/download_last/rend/main/rend-dev'
+        sizes = {}
+        for rendition, max_dim in (('thumb', 440), ('preview', 1280)):
+            r = requests.get(url, params={'rendition': rendition}, timeout=10)
+            self.assertEqual(r.headers['content-type'], 'image/webp')
+            decoded = cv2.imdecode(np.frombuffer(r.content, np.uint8), cv2.IMREAD_COLOR)
+            self.assertEqual(max(decoded.shape[:2]), max_dim)
+            sizes[rendition] = len(r.content)
+            self.assertTrue((self.data_dir / '.blobs' / blob[:2] / f'{blob}.{rendition}.webp').exists())
+        self.assertLess(sizes['thumb'], sizes['preview'])
+        self.assertLess(sizes['preview'], len(png))
+        # кадр не менялся — 304 без тела
+        r = requests.get(url, params={'rendition': 'thumb'}, timeout=10)
+        r2 = requests.get(url, params={'rendition': 'thumb'}, headers={'If-None-Match': r.headers['ETag']}, timeout=10)
+        self.assertEqual((r2.status_code, r2.content), (304, b''))
+        self.assertEqual(requests.get(url, timeout=10).content, png)
+        self.assertEqual(requests.get(url, params={'rendition': 'huge'}, timeout=10).status_code, 400)
+        shot = requests.get('http://127.0.0.1:8000/screenshots', params={'server_id': 'rend'}, timeout=10).json()[0]
+        r = requests.get(f"http://127.0.0.1:8000/download/rend/main/{shot['filename']}", params={'rendition': 'thumb'}, timeout=10)
+        self.assertEqual(len(r.content), sizes['thumb'])
+        self.assertIn('immutable', r.headers['cache-control'])
+        # галерея загружает превью, а не оригиналы
+        page = requests.get('http://127.0.0.1:8000/', params={'server_id': 'rend'}, timeout=10).text
+        self.assertIn('/download_last/rend/main/rend-dev?rendition=thumb', page)
+
+    def test_37_blob_gc_after_drop(self):
+        from contextlib import closing
+        import sqlite3
+        blobs = {}
+        for name in ('old', 'new'):
+            r = requests.post('http://127.0.0.1:8000/upload_screenshot', params={'durable': 1},
+                              files={'image': ('s.png', b'\x89PNG\r\n\x1a\n' + os.urandom(4096), 'image/png')},
+                              data={'server_id': 'gc', 'window': 'main', 'device_id': 'gc-dev'}, headers=self.auth(), timeout=10)
+            blobs[name] = Path(r.json()['path'])
+        old_blob = blobs['old'].name.split('.')[0]
+        # строка старого кадра — только в партиции марта 2000, last указывает на новый кадр
+        old_path = self.partitions_dir / '2000-03.sqlite3'
+        with closing(sqlite3.connect(self.current_partition())) as src, closing(sqlite3.connect(old_path)) as dst:
+            src.backup(dst)
+            dst.execute('DELETE FROM screenshots WHERE blob IS NOT ? OR blob IS NULL', (old_blob,))
+            dst.execute("UPDATE screenshots SET created_ts = 952041600, created_at = '2000-03-03 00:00:00'")
+            dst.commit()
+            src.execute('DELETE FROM screenshots WHERE blob = ?', (old_blob,))
+            src.commit()
+        rendition = blobs['old'].with_name(f'{old_blob}.thumb.webp')
+        rendition.write_bytes(b'RIFF')
+        # оба кадра старше срока защиты свежих загрузок
+        hour_ago = time.time() - 7200
+        for path in blobs.values():
+            os.utime(path, (hour_ago, hour_ago))
+        r = requests.delete('http://127.0.0.1:8000/api/partitions', params={'before': '2000-04'}, headers=self.auth(), timeout=10)
+        self.assertEqual(r.json()['dropped'], [{'month': '2000-03', 'server_id': None}])
+        self.assertEqual(r.json()['blobs_removed'], 2)
+        self.assertFalse(blobs['old'].exists())
+        self.assertFalse(rendition.exists())
+        self.assertTrue(blobs['new'].exists())
+        r = requests.get('http://127.0.0.1:8000/download_last/gc/main/gc-dev', timeout=10)
+        self.assertEqual(r.status_code, 200)
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file